@@ -0,0 +1,198 @@
+import collections
+import functools
+import math
+import os
+import re
+
+# share of an objective's key terms the content must cover for it to clearly pass, and below which it clearly fails
+PASS_COVERAGE = float(os.getenv('LO_BUILDER_ALIGNMENT_PASS', '0.8'))
+FAIL_COVERAGE = float(os.getenv('LO_BUILDER_ALIGNMENT_FAIL', '0.2'))
+# whether validation skips the models when the quick check is conclusive for every objective
+FAST_PATH = os.getenv('LO_BUILDER_ALIGNMENT_FAST_PATH', '1') == '1'
+
+# action verbs of each level of Bloom's taxonomy
+BLOOM_VERBS = {
+    'Remember': ('define', 'describe', 'identify', 'label', 'list', 'locate', 'match', 'memorize', 'name', 'outline', 'recall', 'recite', 'recognize', 'repeat', 'reproduce', 'retrieve', 'select', 'state', 'tell'),
+    'Understand': ('articulate', 'clarify', 'classify', 'compare', 'contrast', 'discuss', 'distinguish', 'estimate', 'exemplify', 'explain', 'express', 'generalize', 'give', 'illustrate', 'infer', 'interpret', 'paraphrase', 'predict', 'report', 'restate', 'summarize', 'translate'),
+    'Apply': ('adapt', 'apply', 'calculate', 'change', 'compute', 'conduct', 'demonstrate', 'employ', 'execute', 'implement', 'modify', 'operate', 'perform', 'practice', 'prepare', 'produce', 'show', 'sketch', 'solve', 'use'),
+    'Analyze': ('analyze', 'attribute', 'break', 'categorize', 'deconstruct', 'determine', 'diagram', 'differentiate', 'discriminate', 'dissect', 'examine', 'explore', 'inspect', 'investigate', 'organize', 'relate', 'separate', 'trace'),
+    'Evaluate': ('appraise', 'argue', 'assess', 'conclude', 'criticize', 'critique', 'decide', 'defend', 'evaluate', 'judge', 'justify', 'measure', 'prioritize', 'rank', 'rate', 'recommend', 'reflect', 'support', 'test', 'validate', 'verify', 'weigh'),
+    'Create': ('assemble', 'author', 'build', 'combine', 'compose', 'construct', 'create', 'derive', 'design', 'develop', 'devise', 'formulate', 'generate', 'hypothesize', 'integrate', 'invent', 'model', 'plan', 'propose', 'reorganize', 'synthesize', 'write'),
+}
+# verbs the prompts already warn against, they can't be observed or measured
+VAGUE_VERBS = ('understand', 'know', 'learn', 'appreciate', 'grasp', 'realize', 'believe', 'familiarize', 'comprehend', 'master')
+
+_VERB_LEVELS = {verb: level for level, verbs in BLOOM_VERBS.items() for verb in verbs}
+# British spellings that the -ise/-yse rule doesn't cover
+_AMERICAN_SPELLINGS = {'practise': 'practice'}
+
+STOPWORDS = frozenset((
+    'a', 'about', 'after', 'all', 'also', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'been', 'being', 'between', 'both',
+    'but', 'by', 'can', 'could', 'do', 'does', 'each', 'either', 'for', 'from', 'has', 'have', 'how', 'in', 'into', 'is',
+    'it', 'its', 'more', 'most', 'of', 'on', 'one', 'or', 'other', 'own', 'same', 'so', 'some', 'such', 'than', 'that',
+    'the', 'their', 'them', 'these', 'they', 'this', 'those', 'through', 'to', 'two', 'use', 'used', 'using', 'various',
+    'was', 'way', 'ways', 'were', 'what', 'when', 'where', 'which', 'while', 'who', 'why', 'will', 'with', 'within', 'would',
+    'able', 'learner', 'learners', 'student', 'students', 'participant', 'participants', 'course', 'module', 'lesson',
+    'objective', 'objectives', 'end', 'key', 'basic', 'main', 'concept', 'concepts', 'different', 'given', 'specific',
+))
+
+_WORD = re.compile(r"[a-z][a-z0-9\-']*")
+_LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\(?[0-9]+[.):]|\(?[a-zA-Z][.)])\s*")
+# a Bloom level written before the objective, e.g. "Remember: Define ..." or "Level 4 (Analyze) - Compare ..."
+_LEVEL_LABEL = re.compile(r"^\W*(?:(?:level\s*\d+\s*)?\(?(?:remember(?:ing)?|understand(?:ing)?|apply(?:ing)?|application|analy[sz](?:e|is|ing)|evaluat(?:e|ion|ing)|creat(?:e|ion|ing)|knowledge|comprehension|synthesis)\)?(?:\s+level)?|level\s*\d+)\s*[:\-\u2013\u2014]\s*", re.IGNORECASE)
+# words that may come before the verb, besides adverbs ending in -ly
+_LEADING_WORDS = frozenset(('also', 'then', 'first', 'further', 'both', 'fully'))
+_PREAMBLE = re.compile(r"^(?:(?:by|at) the end of (?:this|the) \w+,?\s*)?(?:(?:the )?(?:learners?|students?|participants?|you) (?:will|should) )?(?:be able to\s*)?:?\s*", re.IGNORECASE)
+
+
+def stem(word):
+    """Crude suffix stripping, enough for "cells"/"cell" or "dividing"/"divide" to match"""
+    for suffix in ('ations', 'ation', 'ings', 'ing', 'ies', 'ied', 'ers', 'ed', 'es', 'er', 'ly', 's'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            break
+    return word.rstrip('e') if len(word) > 4 else word
+
+
+def terms(text):
+    return [stem(word) for word in _WORD.findall(text.lower()) if word not in STOPWORDS and len(word) > 2]
+
+
+def clean_objective(line):
+    """The objective without its list marker or "students will be able to" preamble"""
+    return _PREAMBLE.sub('', _LIST_MARKER.sub('', line, count=1), count=1).strip()
+
+
+def parse_objectives(text):
+    """One objective per non-empty line"""
+    return [objective for objective in map(clean_objective, text.splitlines()) if objective]
+
+
+def verb_level(word):
+    """Bloom level of a verb, also of its third person ("explains", "discusses", "identifies") and
+    British spelling ("analyse", "practise")"""
+    forms = [word]
+    if word.endswith('ies'):
+        forms.append(word[:-3] + 'y')
+    if word.endswith('es'):
+        forms.append(word[:-2])
+    if word.endswith('s'):
+        forms.append(word[:-1])
+    for verb in forms:
+        level = _VERB_LEVELS.get(verb) or _VERB_LEVELS.get(_AMERICAN_SPELLINGS.get(verb) or verb.replace('ise', 'ize').replace('yse', 'yze'))
+        if level is not None:
+            return level
+    return None
+
+
+def classify_verb(objective):
+    """(verb, Bloom level) of the objective's leading verb. The level is None for verbs not in the taxonomy.
+    A level label before the objective and adverbs before the verb ("critically evaluate") are skipped"""
+    words = _WORD.findall(_LEVEL_LABEL.sub('', objective, count=1).lower())
+    # at most a few words are skipped, an objective that starts with something else has no leading verb
+    for word in words[:4]:
+        level = verb_level(word)
+        if level is None and word not in VAGUE_VERBS and (word.endswith('ly') or word in _LEADING_WORDS):
+            continue
+        return word, level
+    return (words[0], None) if words else (None, None)
+
+
+class ContentIndex:
+    """TF-IDF weights of the terms of each paragraph of the learning content"""
+
+    def __init__(self, learning_content):
+        self.paragraphs = [paragraph.strip() for paragraph in re.split(r'\n\s*\n', learning_content) if paragraph.strip()]
+        counts = [collections.Counter(terms(paragraph)) for paragraph in self.paragraphs]
+        document_frequency = collections.Counter(term for paragraph_counts in counts for term in paragraph_counts)
+        # smoothed, so terms found in every paragraph still count for something
+        self.idf = {term: math.log((1 + len(counts)) / (1 + frequency)) + 1 for term, frequency in document_frequency.items()}
+        self.weights = [
+            {term: count * self.idf[term] for term, count in paragraph_counts.items()}
+            for paragraph_counts in counts
+        ]
+
+
+    def coverage(self, objective_terms):
+        """Share of the objective's terms found anywhere in the content, weighted by how rare they are there,
+        and the index of the paragraph that supports the objective best (None when none does)"""
+        if not objective_terms:
+            return 0.0, None
+        # terms missing from the content get the highest idf, they are what the objective is about
+        missing_weight = max(self.idf.values(), default=1.0)
+        total = sum(self.idf.get(term, missing_weight) for term in objective_terms)
+        found = sum(self.idf[term] for term in objective_terms if term in self.idf)
+
+        best_paragraph, best_score = None, 0.0
+        for index, weights in enumerate(self.weights):
+            score = sum(weights.get(term, 0.0) for term in objective_terms)
+            if score > best_score:
+                best_paragraph, best_score = index, score
+        return found / total, best_paragraph
+
+
+@functools.lru_cache(maxsize=32)
+def get_content_index(learning_content):
+    """Index of the content, built once however often the same content is checked (e.g. Streamlit reruns)"""
+    return ContentIndex(learning_content)
+
+
+def check_objective(index, objective):
+    """Checks one objective against the content index, returning a dict of the objective, its verb and
+    Bloom level, coverage, best supporting paragraph, verdict ('pass', 'fail' or 'unsure') and the reasons"""
+    verb, level = classify_verb(objective)
+    objective_terms = list(dict.fromkeys(term for term in terms(objective) if term != stem(verb or '')))
+    coverage, best_paragraph = index.coverage(objective_terms)
+
+    reasons = []
+    if verb in VAGUE_VERBS:
+        reasons.append(f"\"{verb}\" can't be observed or measured, use a verb from Bloom's taxonomy")
+    elif level is None:
+        reasons.append(f"\"{verb}\" is not a verb from Bloom's taxonomy")
+    if coverage < FAIL_COVERAGE:
+        reasons.append("the content barely mentions what it is about")
+    elif coverage < PASS_COVERAGE:
+        reasons.append("the content covers only part of what it is about")
+    if len(objective_terms) < 2:
+        reasons.append("it is too short to check")
+
+    if verb in VAGUE_VERBS or (coverage < FAIL_COVERAGE and objective_terms):
+        verdict = 'fail'
+    elif not reasons:
+        verdict = 'pass'
+    else:
+        verdict = 'unsure'
+    return {
+        'objective': objective,
+        'verb': verb,
+        'level': level,
+        'coverage': round(coverage, 2),
+        'best_paragraph': best_paragraph,
+        'verdict': verdict,
+        'reasons': reasons
+    }
+
+
+def check_alignment(learning_content, learning_objectives):
+    """Quick local check of every objective against the content. 'conclusive' tells whether each one
+    clearly passed or clearly failed, so the models don't need to be asked"""
+    index = get_content_index(learning_content)
+    checks = [check_objective(index, objective) for objective in parse_objectives(learning_objectives)]
+    return {
+        'objectives': checks,
+        'conclusive': bool(checks) and all(check['verdict'] != 'unsure' for check in checks)
+    }
+
+
+def format_report(report):
+    """Markdown summary of a check_alignment report"""
+    labels = {'pass': "Aligned", 'fail': "Not aligned", 'unsure': "Needs review"}
+    lines = []
+    for number, check in enumerate(report['objectives'], start=1):
+        line = f"{number}. **{labels[check['verdict']]}** ({int(check['coverage'] * 100)}% covered"
+        line += f", {check['level']})" if check['level'] else ")"
+        line += f": {check['objective']}"
+        if check['reasons']:
+            line += "  \n   _" + "; ".join(check['reasons']) + "_"
+        lines.append(line)
+    return "\n".join(lines)
@@ -1,23 +1,154 @@
 import openai 
-import streamlit as st 
 import datetime 
 import pytz 
 import time 
+import os 
+import threading 
+import concurrent.futures 
+import queue 
+import math 
+import hashlib 
+import functools 
+import contextlib 
+import logging 
+import requests 
+import cachetools 
+import cache_util 
+import metrics_util as metrics 
+import ratelimit_util as ratelimit 
+import keypool_util 
+import scheduler_util 
+import provider_util 
+from openai import api_requestor 
+
+try:
+    import tiktoken 
+except ImportError:
+    tiktoken = None
+
+MODEL_CONTEXT_SIZES = {'gpt-3.5-turbo': 4096, 'gpt-4': 8192}
+MODEL_CONTEXT_SIZES.update({model: provider_util.LOCAL_CONTEXT_SIZE for model in provider_util.local_models()})
+DEFAULT_CONTEXT_SIZE = 4096
+
+# OpenAI models served by the chat endpoint, any other OpenAI model goes to the legacy completions endpoint
+CHAT_MODELS = ('gpt-3.5-turbo', 'gpt-4')
+
+# USD per 1K prompt tokens and per 1K completion tokens
+MODEL_PRICING = {'gpt-3.5-turbo': (0.002, 0.002), 'gpt-4': (0.03, 0.06)}
+
+# every chat message is framed by a few extra tokens, and the reply is primed with a few more
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+MIN_COMPLETION_TOKENS = 64
+# alternative answers one request can ask for (the API's n)
+MAX_VARIANTS = 5
+
+# shared worker pool used to fan out requests to several models at once. Its workers mostly wait 
+# for a scheduler slot or on a stream, the scheduler caps the requests actually sent to the API
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(32, 4 * scheduler_util.MAX_CONCURRENT),
+    thread_name_prefix='open_ai'
+)
+# how often callers waiting in the scheduler queue are told their position
+QUEUE_POLL = 0.5
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+# model ids each verified key has access to, keyed by key fingerprint so raw keys are never kept
+_key_models = cachetools.TTLCache(maxsize=1024, ttl=int(os.getenv('LO_BUILDER_KEY_TTL', '3600')))
+_key_models_lock = threading.Lock()
+
+# moderation verdicts keyed by prompt digest, they don't depend on the key or model
+_moderations = cachetools.TTLCache(maxsize=1024, ttl=int(os.getenv('LO_BUILDER_MODERATION_TTL', '86400')))
+_moderations_lock = threading.Lock()
+
+# identical completion requests running at the same time, from any session, share one API call
+_in_flight = cache_util.SingleFlight()
 
 def get_current_time():
     return datetime.datetime.now(pytz.timezone('US/Pacific'))
 
-def escape_special_chars(text):
-    return (
-        text.replace("\\", "\\\\")
-        .replace("\"", "\\\"")
-        .replace("'", "\\'")
-        .replace("\n", "\\n")
-        .replace("\t", "\\t")
-        .replace("\r", "\\r")
-    )  
+def key_fingerprint(api_key):
+    """One-way fingerprint of an API key, safe to use as a cache key"""
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()
 
-class open_ai:
+def estimate_tokens(text):
+    """Rough token estimate (about 4 characters per token) for responses that don't report usage"""
+    return math.ceil(len(text) / 4)
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # the encoding files are downloaded on first use, which fails on machines without internet access
+        logging.warning(f"Tokenizer for {model} unavailable, estimating token counts instead: {e}")
+        return None
+
+def count_tokens(text, model='gpt-3.5-turbo'):
+    """Number of tokens in text for the given model, estimated when no tokenizer is available"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages, model='gpt-3.5-turbo'):
+    """Prompt tokens a list of chat messages costs, including message framing and reply priming"""
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message['message'], model) for message in messages) + TOKENS_PER_REPLY
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Cost in USD of a request, 0 for models without a known price"""
+    prompt_price, completion_price = MODEL_PRICING.get(model, (0, 0))
+    return prompt_price * prompt_tokens / 1000 + completion_price * completion_tokens / 1000
+
+def _scheduling_cost(model, budget, n=1):
+    """What a request costs for fair scheduling, priced like gpt-3.5-turbo when the model's price is unknown"""
+    prompt_price, completion_price = MODEL_PRICING.get(model, MODEL_PRICING['gpt-3.5-turbo'])
+    return prompt_price * budget['prompt_tokens'] / 1000 + completion_price * budget['max_tokens'] * n / 1000
+
+def _estimate_request_tokens(params):
+    """Tokens a request will count against the tokens per minute limit: its prompt plus max_tokens for each of its n choices"""
+    prompt_tokens = sum(estimate_tokens(message['content']) for message in params.get('messages', []))
+    prompt_tokens += estimate_tokens(params.get('prompt', ''))
+    return prompt_tokens + params.get('max_tokens', 0) * params.get('n', 1)
+
+def _is_quota_error(e):
+    code = getattr(e, 'code', None)
+    json_body = getattr(e, 'json_body', None)
+    if code is None and isinstance(json_body, dict):
+        code = (json_body.get('error') or {}).get('code')
+    return code == 'insufficient_quota' or 'exceeded your current quota' in str(e)
+
+def get_http_session():
+    """Process-wide HTTP session with keep-alive and connection pooling, shared by all API calls"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            pool_size = int(os.getenv('LO_BUILDER_HTTP_POOL_SIZE', '32'))
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=pool_size,
+                max_retries=api_requestor.MAX_CONNECTION_RETRIES
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+    return _http_session
+
+def _use_shared_http_session():
+    """The openai library keeps one session per thread, point it at the shared pooled session instead"""
+    session = get_http_session()
+    if getattr(api_requestor._thread_context, 'session', None) is not session:
+        api_requestor._thread_context.session = session
+
+class open_ai(provider_util.Provider):
 
     class BadRequest(Exception):
         pass
@@ -27,157 +158,468 @@ class open_ai:
             super().__init__(message)
             self.error_type = error_type 
 
-    def __init__(self, api_key, restart_sequence, stop_sequence):
+    def __init__(self, api_key, restart_sequence, stop_sequence, cache=None, key_pool=None, session=None):
+        """Calls are made with api_key, or when a keypool_util.KeyPool is given instead, with the key
+        of the pool that has the most headroom left. Completions of the same session (default the key) 
+        take turns with those of other sessions in the scheduler queue"""
         self.api_key = api_key
-        openai.api_key = api_key 
+        self.key_pool = key_pool
         self.stop_sequence = stop_sequence
         self.restart_sequence = restart_sequence
+        self.cache = cache
+        self.fingerprint = key_pool.fingerprint if key_pool is not None else key_fingerprint(api_key or '')
+        self.session = session if session is not None else self.fingerprint
 
 
-    def _invoke_call(self, call_string, max_tries=3, initial_backoff=1):
-        """Generic function to invoke openai calls"""
+    def _invoke_call(self, api_call, max_tries=3, initial_backoff=1, timings=None, **params):
+        """Generic function to invoke openai calls. Calls wait for room in the process-wide rate limits 
+        of their key and model, and retryable failures are retried with jittered backoff. With a key pool, 
+        a key that hits its limits is taken out of rotation and the call moves to another key right away,
+        once per key and try, so max_tries bounds the requests of a call however many keys fail. The time spent waiting and retrying is added to the timings dict, if given"""
         RETRY_EXCEPTIONS = (
             openai.error.APIError, 
             openai.error.Timeout, 
             openai.error.APIConnectionError, 
-            openai.error.ServiceUnavailableError
+            openai.error.ServiceUnavailableError,
+            openai.error.RateLimitError
         )
         tries = 0
-        backoff = initial_backoff
+        failovers = 0
+        model = params.get('model', 'default')
+        request_tokens = _estimate_request_tokens(params)
+
+        _use_shared_http_session()
 
         while True: 
+            key = self.key_pool.pick(model) if self.key_pool is not None else None
+            call_params = {'api_key': key.api_key if key is not None else self.api_key}
+            # the moderation endpoint takes no organization
+            if key is not None and key.organization and api_call != openai.Moderation.create:
+                call_params['organization'] = key.organization
+            limiter = ratelimit.get_limiter(key.fingerprint if key is not None else self.fingerprint, model)
+
+            queued = time.perf_counter()
+            try:
+                limiter.acquire(request_tokens)
+            except ratelimit.CircuitOpenError as e:
+                metrics.inc('lo_builder_api_errors_total', model=model, error_type=type(e).__name__)
+                raise self.OpenAIError(f"OpenAI API Error: {str(e)}", error_type=type(e).__name__) from e
+            if timings is not None:
+                timings['queue'] += time.perf_counter() - queued
+
             try:
-                result = eval(f"{call_string}")
+                # the key is passed per call so concurrent sessions with different keys don't share global state
+                result = api_call(**call_params, **params)
+                limiter.record_success()
+                if key is not None:
+                    self.key_pool.record(key, 'ok')
                 return result     
 
             except Exception as e:
-                if isinstance(e, RETRY_EXCEPTIONS) and tries < max_tries:
-                    time.sleep(backoff)
-                    backoff *= 2
+                metrics.inc('lo_builder_api_errors_total', model=model, error_type=type(e).__name__)
+                # an exhausted quota won't recover by retrying
+                quota_error = _is_quota_error(e)
+                retryable = isinstance(e, RETRY_EXCEPTIONS) and not quota_error
+                if isinstance(e, RETRY_EXCEPTIONS):
+                    limiter.record_failure(rate_limited=isinstance(e, openai.error.RateLimitError))
+
+                failover = False
+                if key is not None:
+                    if isinstance(e, (openai.error.RateLimitError, openai.error.AuthenticationError)):
+                        # the key sits out, and the call moves on to another key if one is left
+                        long_cooldown = quota_error or isinstance(e, openai.error.AuthenticationError)
+                        cooldown = keypool_util.QUOTA_COOLDOWN if long_cooldown else ratelimit.retry_after(e)
+                        self.key_pool.cool_down(key, keypool_util.KEY_COOLDOWN if cooldown is None else cooldown)
+                        # a try goes round the pool once, then it counts against max_tries like any retry
+                        failover = self.key_pool.available() > 0 and failovers < len(self.key_pool) - 1
+                    self.key_pool.record(key, 'rate_limited' if isinstance(e, openai.error.RateLimitError) else 'error')
+
+                if failover:
+                    failovers += 1
+                    metrics.inc('lo_builder_key_failovers_total', model=model)
+                elif retryable and tries < max_tries:
+                    delay = ratelimit.retry_delay(e, tries, initial_backoff)
+                    metrics.inc('lo_builder_retries_total', model=model, error_type=type(e).__name__)
+                    if timings is not None:
+                        timings['retries'] += 1
+                        timings['retry_wait'] += delay
+                    time.sleep(delay)
                     tries +=1
+                    failovers = 0
                 else:
                     raise self.OpenAIError(f"OpenAI API Error: {str(e)}", error_type=type(e).__name__) from e  
+            finally:
+                # a probe of a half-open circuit that failed with a non-retryable error recorded nothing
+                limiter.end_probe()
 
 
     def get_moderation(self, user_message):
         """Main function to get moderation on a user message"""
-        get_moderation_call_string = ("""openai.Moderation.create(input="{0}")""".format(escape_special_chars(user_message)))
+        prompt_digest = cache_util.make_key(user_message)
+        with _moderations_lock:
+            moderation_result = _moderations.get(prompt_digest)
+        if moderation_result is not None:
+            return moderation_result
 
         try:
-            moderation = self._invoke_call(get_moderation_call_string)
+            with metrics.span('moderation'):
+                moderation = self._invoke_call(openai.Moderation.create, input=user_message)
             moderation_result = moderation['results'][0]
             flagged_categories = [category for category, value in moderation_result['categories'].items() if value]
 
-            return {'flagged': moderation_result['flagged'], 'flagged_categories':flagged_categories}
+            moderation_result = {'flagged': moderation_result['flagged'], 'flagged_categories':flagged_categories}
+            with _moderations_lock:
+                _moderations[prompt_digest] = moderation_result
+            return moderation_result
         except Exception as e:
             raise 
 
 
+    def get_moderation_future(self, user_message):
+        """Starts moderating a user message in the background, so it can overlap with the completions. 
+        Returns a future of the get_moderation result, already resolved if the verdict is cached"""
+        prompt_digest = cache_util.make_key(user_message)
+        with _moderations_lock:
+            moderation_result = _moderations.get(prompt_digest)
+        if moderation_result is not None:
+            future = concurrent.futures.Future()
+            future.set_result(moderation_result)
+            return future
+        return _executor.submit(self.get_moderation, user_message)
+
+
     def get_models(self):
         """Main function to get models that the key has access to """
         try:
-            return self._invoke_call("openai.Model.list()")
+            return self._invoke_call(openai.Model.list)
         except Exception as e:
             raise
 
 
-    def get_ai_response(self, model_config_dict, init_prompt_msg, messages):
+    def get_available_models(self):
+        """Ids of the models the key has access to. Verified keys are cached process-wide for 
+        LO_BUILDER_KEY_TTL seconds, so repeated checks don't cost a round-trip"""
+        fingerprint = self.fingerprint
+        with _key_models_lock:
+            model_ids = _key_models.get(fingerprint)
+        if model_ids is None:
+            with metrics.span('key_verification'):
+                models = self.get_models()
+            model_ids = frozenset(m['id'] for m in models['data'])
+            with _key_models_lock:
+                _key_models[fingerprint] = model_ids
+        # the local model needs no key, it is available to everyone
+        return model_ids | provider_util.local_models()
+
+
+    def models(self):
+        return self.get_available_models()
+
+
+    def complete(self, model_config_dict, messages, stream=False, timings=None):
+        """Sends a request to the OpenAI API, to the chat or the legacy completions endpoint"""
+        if model_config_dict['model'] in CHAT_MODELS:
+            return self._get_chat_completion(model_config_dict, messages, stream=stream, timings=timings)
+        return self._get_completion(model_config_dict, messages, stream=stream, timings=timings)
+
+
+    def _provider(self, model):
+        """The backend serving the model: the local provider for the local model, the OpenAI API otherwise"""
+        if model in provider_util.local_models():
+            return provider_util.get_local_provider()
+        return self
+
+
+    def get_ai_response(self, model_config_dict, init_prompt_msg, messages, use_cache=True, queued_at=None):
+        """The model's response to the prompt and history. Its 'timings' tell where the time went: 
+        'queue' waiting for a worker and the rate limits, 'retries' and their 'retry_wait', and the 
+        'total' since the request was queued (queued_at, a time.perf_counter() value). With 'n' > 1 in
+        model_config_dict, one request asks for n alternative answers: the first is the message and
+        'variants' lists all of them, and the token usage covers all of them"""
+        model = model_config_dict['model']
+        started = time.perf_counter()
+        timings = _new_timings(started, queued_at)
+        try:
+            b_r = self._get_ai_response(model_config_dict, init_prompt_msg, messages, use_cache, timings)
+        except Exception:
+            metrics.inc('lo_builder_requests_total', model=model, outcome='error')
+            raise
+        return {**b_r, 'timings':_finish_timings(model, b_r, timings, queued_at or started)}
 
-        submit_messages = [{'role':'system','message':init_prompt_msg,'current_date':get_current_time()}]+ messages
 
-        new_messages = [] 
-        bot_message = ''
-        total_tokens = 0
+    def _get_ai_response(self, model_config_dict, init_prompt_msg, messages, use_cache, timings):
 
-        if model_config_dict['model'] in ('gpt-3.5-turbo', 'gpt-4'):
-            try:
-                response = self._get_chat_completion(model_config_dict, submit_messages)
-                bot_message = response['choices'][0]['message']['content']
-                total_tokens = response['usage']['total_tokens']
-                prompt_tokens = response['usage']['prompt_tokens']
-                completion_tokens = response['usage']['completion_tokens']
-            except Exception as e:
-                raise 
+        cache_key = self._response_cache_key(model_config_dict, init_prompt_msg, messages)
+        if self.cache is not None and use_cache:
+            cached_response = self.cache.get(cache_key)
+            if cached_response is not None:
+                return self._cached_ai_response(messages, cached_response)
+
+        request_ai_response = functools.partial(self._request_ai_response, model_config_dict, init_prompt_msg, messages, cache_key, timings)
+        if use_cache:
+            response, shared = _in_flight.do(cache_key, request_ai_response)
         else:
-            try:
-                response = self._get_completion(model_config_dict, submit_messages)
-                bot_message = response['choices'][0]['text']
-                total_tokens = response['usage']['total_tokens']
-                prompt_tokens = response['usage']['prompt_tokens']
-                completion_tokens = response['usage']['completion_tokens']
-            except Exception as e:
-                raise
-        
-        new_messages = messages + [{'role':'assistant','message':bot_message.strip(),'created_date':get_current_time()}]
+            response, shared = request_ai_response(), False
+        if shared:
+            return {**self._cached_ai_response(messages, response), 'shared':True}
+
+        new_messages = messages + [{'role':'assistant','message':response['message'],'created_date':get_current_time()}]
+        return {'messages':new_messages, 'total_tokens':response['total_tokens'], 'prompt_tokens':response['prompt_tokens'], 'completion_tokens':response['completion_tokens'], 'cached':False, **_variants(response)}   
+
+
+    def _request_ai_response(self, model_config_dict, init_prompt_msg, messages, cache_key, timings=None):
+        """Requests the completion from the API and stores it in the response cache"""
+
+        # leave out the oldest history if needed, so the request fits the model's context window
+        budget = fit_to_context(model_config_dict, init_prompt_msg, messages)
+        model_config_dict = {**model_config_dict, 'max_tokens':budget['max_tokens']}
+        submit_messages = [{'role':'system','message':init_prompt_msg,'current_date':get_current_time()}]+ budget['messages']
+
+        provider = self._provider(model_config_dict['model'])
+        with self._scheduled(model_config_dict['model'], budget, timings, model_config_dict.get('n', 1)) if provider.scheduled else contextlib.nullcontext():
+            response = provider.complete(model_config_dict, submit_messages, timings=timings)
+
+        # chat responses carry a message, legacy completions a text. With n choices the usage covers
+        # all of them, the prompt is billed once
+        choices = sorted(response['choices'], key=lambda choice: choice.get('index', 0))
+        bot_messages = [(choice['message']['content'] if 'message' in choice else choice['text']).strip() for choice in choices]
+        total_tokens = response['usage']['total_tokens']
+        prompt_tokens = response['usage']['prompt_tokens']
+        completion_tokens = response['usage']['completion_tokens']
+
+        response = {'message':bot_messages[0], 'total_tokens':total_tokens, 'prompt_tokens':prompt_tokens, 'completion_tokens':completion_tokens}
+        if len(bot_messages) > 1:
+            response['variants'] = bot_messages
+        if self.cache is not None:
+            self.cache.set(cache_key, response)
+        return response
+
+
+    @contextlib.contextmanager
+    def _scheduled(self, model, budget, timings=None, n=1):
+        """Holds one of the scheduler's slots for the enclosed request, queueing for it first"""
+        queued = time.perf_counter()
+        with scheduler_util.get_scheduler().slot(self.session, _scheduling_cost(model, budget, n)):
+            if timings is not None:
+                timings['queue'] += time.perf_counter() - queued
+            yield
+
+
+    def get_ai_responses(self, model_config_dicts, init_prompt_msg, messages_by_model, use_cache=True, on_queue=None, routes=None):
+        """Send the prompt to every model at once, yielding (model, response, error) as each model answers. 
+        While requests of the session wait in the scheduler queue, on_queue is called with the queue 
+        position and estimated wait in seconds. routes maps model names answered by something other than 
+        get_ai_response, like the router, to a function with its arguments"""
+        futures = {}
+        for model_config_dict in model_config_dicts:
+            model = model_config_dict['model']
+            get_response = (routes or {}).get(model, self.get_ai_response)
+            future = _executor.submit(get_response, model_config_dict, init_prompt_msg, messages_by_model[model], use_cache, time.perf_counter())
+            futures[future] = model
+
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=QUEUE_POLL if on_queue else None, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                model = futures[future]
+                try:
+                    yield model, future.result(), None
+                except Exception as e:
+                    yield model, None, e
+            if pending and on_queue is not None:
+                queue_status = scheduler_util.get_scheduler().status(self.session)
+                if queue_status is not None:
+                    on_queue(*queue_status)
+
+
+    def stream_ai_response(self, model_config_dict, init_prompt_msg, messages, use_cache=True, queued_at=None):
+        """Generator of response events: {'model', 'delta'} for each piece of text as it arrives, 
+        then a final {'model', 'done', 'messages', *_tokens, 'timings'} once the stream ends. The timings 
+        are those of get_ai_response, plus the time to the first token ('ttft'). With 'n' > 1 only the 
+        first answer is streamed, the final event carries all of them in 'variants'"""
+        model = model_config_dict['model']
+        started = time.perf_counter()
+        timings = _new_timings(started, queued_at)
+        try:
+            for event in self._stream_ai_response(model_config_dict, init_prompt_msg, messages, use_cache, timings):
+                if 'delta' in event and 'ttft' not in timings:
+                    timings['ttft'] = time.perf_counter() - (queued_at or started)
+                if 'done' in event:
+                    event = {**event, 'timings':_finish_timings(model, event, timings, queued_at or started)}
+                yield event
+        except Exception:
+            metrics.inc('lo_builder_requests_total', model=model, outcome='error')
+            raise
 
-        return {'messages':new_messages, 'total_tokens':total_tokens, 'prompt_tokens':prompt_tokens, 'completion_tokens': completion_tokens}   
 
+    def _stream_ai_response(self, model_config_dict, init_prompt_msg, messages, use_cache, timings):
+
+        model = model_config_dict['model']
+        cache_key = self._response_cache_key(model_config_dict, init_prompt_msg, messages)
+        if self.cache is not None and use_cache:
+            cached_response = self.cache.get(cache_key)
+            if cached_response is not None:
+                yield {'model':model, 'delta':cached_response['message']}
+                yield {'model':model, 'done':True, **self._cached_ai_response(messages, cached_response)}
+                return
+
+        leader = False
+        if use_cache:
+            # an identical request already running in another session is waited for instead of repeated
+            future, leader = _in_flight.begin(cache_key)
+            if not leader:
+                response = _in_flight.wait(future)
+                if response is not None:
+                    yield {'model':model, 'delta':response['message']}
+                    yield {'model':model, 'done':True, **self._cached_ai_response(messages, response), 'shared':True}
+                    return
+
+        ticket = None
+        try:
+            budget = fit_to_context(model_config_dict, init_prompt_msg, messages)
+            model_config_dict = {**model_config_dict, 'max_tokens':budget['max_tokens']}
+            submit_messages = [{'role':'system','message':init_prompt_msg,'current_date':get_current_time()}]+ budget['messages']
+            bot_messages = {}
+
+            provider = self._provider(model)
+            if provider.scheduled:
+                # the slot is held until the stream ends, the queue position is reported while waiting for it
+                scheduler = scheduler_util.get_scheduler()
+                queued = time.perf_counter()
+                ticket = scheduler.enqueue(self.session, _scheduling_cost(model, budget, model_config_dict.get('n', 1)))
+                while not ticket.wait(QUEUE_POLL):
+                    position = scheduler.position(ticket)
+                    yield {'model':model, 'progress':0.0, 'status':scheduler_util.format_wait(position, scheduler.estimate_wait(position))}
+                timings['queue'] += time.perf_counter() - queued
+
+            response = provider.complete(model_config_dict, submit_messages, stream=True, timings=timings)
 
-    def _get_chat_completion(self, model_config_dict, messages):
+            try:
+                for chunk in response:
+                    choice = chunk['choices'][0]
+                    if 'delta' in choice:
+                        delta = choice['delta'].get('content', '')
+                    else:
+                        delta = choice.get('text', '')
+                    if not delta:
+                        continue
+                    # with n choices the chunks of all of them arrive interleaved, the first one is shown as it comes
+                    index = choice.get('index', 0)
+                    bot_messages[index] = bot_messages.get(index, '') + delta
+                    if index == 0:
+                        yield {'model':model, 'delta':delta}
+            except Exception as e:
+                raise self.OpenAIError(f"OpenAI API Error: {str(e)}", error_type=type(e).__name__) from e
+
+            # streamed responses carry no usage block, so tokens are counted locally, the prompt once for all choices
+            bot_messages = [bot_messages.get(index, '').strip() for index in range(max(bot_messages, default=0) + 1)]
+            prompt_tokens = budget['prompt_tokens']
+            completion_tokens = sum(count_tokens(bot_message, model) for bot_message in bot_messages)
+            response = {'message':bot_messages[0], 'total_tokens':prompt_tokens + completion_tokens, 'prompt_tokens':prompt_tokens, 'completion_tokens':completion_tokens}
+            if len(bot_messages) > 1:
+                response['variants'] = bot_messages
+            if self.cache is not None:
+                self.cache.set(cache_key, response)
+        except BaseException as e:
+            if leader:
+                # waiting requests make their own call when this one fails or is abandoned
+                _in_flight.finish(cache_key, error=e if isinstance(e, Exception) else self.OpenAIError("Request cancelled", error_type='Cancelled'))
+            raise
+        finally:
+            if ticket is not None:
+                scheduler.release(ticket)
+
+        if leader:
+            _in_flight.finish(cache_key, result=response)
+
+        new_messages = messages + [{'role':'assistant','message':response['message'],'created_date':get_current_time()}]
+        yield {
+            'model':model, 
+            'done':True, 
+            'messages':new_messages, 
+            'total_tokens':response['total_tokens'], 
+            'prompt_tokens':response['prompt_tokens'], 
+            'completion_tokens':response['completion_tokens'],
+            'cached':False,
+            **_variants(response)
+        }
+
+
+    def stream_ai_responses(self, model_config_dicts, init_prompt_msg, messages_by_model, use_cache=True, routes=None):
+        """Stream every model at once, yielding the events of all streams interleaved as they arrive. 
+        A model that fails yields a final {'model', 'error'} event instead of 'done'. routes maps model 
+        names to a function streaming like stream_ai_response, as for get_ai_responses"""
+        return merge_streams({
+            model_config_dict['model']: functools.partial((routes or {}).get(model_config_dict['model'], self.stream_ai_response), model_config_dict, init_prompt_msg, messages_by_model[model_config_dict['model']], use_cache, time.perf_counter())
+            for model_config_dict in model_config_dicts
+        })
+
+
+    def _get_chat_completion(self, model_config_dict, messages, stream=False, timings=None):
         self._validate_model_config(model_config_dict)
         oai_messages = self._messages_to_oai_messages(messages)
 
-        get_completion_call_string = (
-        """openai.ChatCompletion.create(
-            model="{0}",
-            messages={1},
-            temperature={2},
-            max_tokens={3},
-            top_p={4},
-            frequency_penalty={5},
-            presence_penalty={6},
-            stop=['{7}']
-            )""").format(
-                model_config_dict['model'],
-                oai_messages,
-                model_config_dict['temperature'],
-                model_config_dict['max_tokens'],
-                model_config_dict['top_p'],
-                model_config_dict['frequency_penalty'],
-                model_config_dict['presence_penalty'],
-                self.stop_sequence
-            )            
-        
         try:
-            completions = self._invoke_call(get_completion_call_string)
+            completions = self._invoke_call(
+                openai.ChatCompletion.create,
+                model=model_config_dict['model'],
+                messages=oai_messages,
+                temperature=model_config_dict['temperature'],
+                max_tokens=model_config_dict['max_tokens'],
+                top_p=model_config_dict['top_p'],
+                frequency_penalty=model_config_dict['frequency_penalty'],
+                presence_penalty=model_config_dict['presence_penalty'],
+                n=model_config_dict.get('n', 1),
+                stop=[self.stop_sequence],
+                stream=stream,
+                timings=timings
+            )
             return completions
         except Exception as e:
             raise 
 
 
-    def _get_completion(self, model_config_dict, messages):
+    def _get_completion(self, model_config_dict, messages, stream=False, timings=None):
         self._validate_model_config(model_config_dict)
         oai_message = self._messages_to_oai_prompt_str(messages)
 
-        get_completion_call_string = (
-        """openai.Completion.create(
-            model="{0}",
-            prompt="{1}",
-            temperature={2},
-            max_tokens={3},
-            top_p={4},
-            frequency_penalty={5},
-            presence_penalty={6},
-            stop=['{7}']
-            )""").format(
-                model_config_dict['model'],
-                oai_message,
-                model_config_dict['temperature'],
-                model_config_dict['max_tokens'],
-                model_config_dict['top_p'],
-                model_config_dict['frequency_penalty'],
-                model_config_dict['presence_penalty'],
-                self.stop_sequence
-            )            
-        
         try:
-            completions = self._invoke_call(get_completion_call_string)
+            completions = self._invoke_call(
+                openai.Completion.create,
+                model=model_config_dict['model'],
+                prompt=oai_message,
+                temperature=model_config_dict['temperature'],
+                max_tokens=model_config_dict['max_tokens'],
+                top_p=model_config_dict['top_p'],
+                frequency_penalty=model_config_dict['frequency_penalty'],
+                presence_penalty=model_config_dict['presence_penalty'],
+                n=model_config_dict.get('n', 1),
+                stop=[self.stop_sequence],
+                stream=stream,
+                timings=timings
+            )
             return completions
         except Exception as e:
             raise 
 
 
     # helper functions 
+    def _response_cache_key(self, model_config_dict, init_prompt_msg, messages):
+        return cache_util.make_key(model_config_dict, init_prompt_msg, [(message['role'], message['message']) for message in messages])
+
+
+    def _cached_ai_response(self, messages, cached_response):
+        new_messages = messages + [{'role':'assistant','message':cached_response['message'],'created_date':get_current_time()}]
+        return {
+            'messages':new_messages, 
+            'total_tokens':cached_response['total_tokens'], 
+            'prompt_tokens':cached_response['prompt_tokens'], 
+            'completion_tokens':cached_response['completion_tokens'], 
+            'cached':True,
+            **_variants(cached_response)
+        }
+
+
     def _validate_model_config(self, model_config_dict):
         required_fields = ['model', 'temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty']
 
@@ -191,9 +633,9 @@ class open_ai:
         msg_string = ""
         for message in messages:
             if message['role'] == 'user' or message['role'] == 'system':
-                msg_string += escape_special_chars(message['message']) + self.stop_sequence
+                msg_string += message['message'] + self.stop_sequence
             else:
-                msg_string += escape_special_chars(message['message']) + self.restart_sequence
+                msg_string += message['message'] + self.restart_sequence
         return msg_string
 
 
@@ -201,8 +643,87 @@ class open_ai:
         oai_messages = []
         if len(messages) > 0:
             for message in messages:
-                oai_messages.append({'role':message['role'], 'content':escape_special_chars(message['message'])})
+                oai_messages.append({'role':message['role'], 'content':message['message']})
         return oai_messages 
 
 
+def _variants(response):
+    """The 'variants' of a response that asked for n > 1 choices, all choices' messages with the first one also in 'messages'"""
+    return {'variants':response['variants']} if 'variants' in response else {}
+
+
+def _new_timings(started, queued_at=None):
+    return {'queue':started - queued_at if queued_at else 0.0, 'retries':0, 'retry_wait':0.0}
 
+
+def _finish_timings(model, b_r, timings, started):
+    """Completes the timings of a response and records them as metrics"""
+    timings['total'] = time.perf_counter() - started
+    outcome = 'shared' if b_r.get('shared') else 'cached' if b_r['cached'] else 'ok'
+    metrics.inc('lo_builder_requests_total', model=model, outcome=outcome)
+    metrics.observe('queue', timings['queue'], model=model)
+    if timings['retries']:
+        metrics.observe('retry_wait', timings['retry_wait'], model=model)
+    if 'ttft' in timings:
+        metrics.observe('ttft', timings['ttft'], model=model)
+    metrics.observe('completion', timings['total'], model=model, outcome=outcome)
+    return timings
+
+
+def calls_saved():
+    """Number of completion requests answered by sharing an identical request already in flight"""
+    return _in_flight.saved
+
+
+def merge_streams(stream_factories):
+    """Runs several response event streams on the shared worker pool, given as {model: function returning 
+    the stream}, and yields their events interleaved as they arrive. A stream that raises ends with an 
+    {'model', 'error'} event instead of 'done'"""
+    events = queue.Queue()
+
+    def pump(model, stream_factory):
+        try:
+            for event in stream_factory():
+                events.put(event)
+        except Exception as e:
+            events.put({'model':model, 'error':e})
+
+    for model, stream_factory in stream_factories.items():
+        _executor.submit(pump, model, stream_factory)
+
+    remaining = len(stream_factories)
+    while remaining > 0:
+        event = events.get()
+        if 'done' in event or 'error' in event:
+            remaining -= 1
+        yield event
+
+
+def fit_to_context(model_config_dict, init_prompt_msg, messages):
+    """Budgets a request against the model's context window before it is sent. The oldest history 
+    messages are left out until the prompt leaves room for max_tokens of response, and max_tokens is 
+    clamped when even the system prompt alone doesn't leave that much. 
+    Returns the messages to send, the max_tokens to use, the prompt tokens and the number of messages left out"""
+    model = model_config_dict['model']
+    context_size = MODEL_CONTEXT_SIZES.get(model, DEFAULT_CONTEXT_SIZE)
+    prompt_tokens = count_message_tokens([{'role':'system','message':init_prompt_msg}], model)
+
+    reserved_tokens = min(model_config_dict['max_tokens'], context_size - prompt_tokens)
+    if reserved_tokens < min(MIN_COMPLETION_TOKENS, model_config_dict['max_tokens']):
+        raise open_ai.BadRequest(f"The prompt is too long for {model}: it is about {prompt_tokens} tokens, and the model accepts {context_size} tokens including its response. Please shorten the content.")
+
+    kept_messages = []
+    for message in reversed(messages):
+        message_tokens = TOKENS_PER_MESSAGE + count_tokens(message['message'], model)
+        if prompt_tokens + message_tokens + reserved_tokens > context_size:
+            break
+        kept_messages.append(message)
+        prompt_tokens += message_tokens
+    kept_messages.reverse()
+
+    return {
+        'messages':kept_messages, 
+        'max_tokens':min(model_config_dict['max_tokens'], context_size - prompt_tokens), 
+        'prompt_tokens':prompt_tokens, 
+        'dropped_messages':len(messages) - len(kept_messages)
+    }
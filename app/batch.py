@@ -0,0 +1,273 @@
+"""Bulk generation of learning objectives for whole course catalogs.
+
+Reads modules from a CSV (with a header row) or JSONL file with module_title, learning_content and
+learning_objectives fields, and optionally id and request. Results are appended to a JSONL file as
+they arrive, rerunning the same command resumes an interrupted run.
+
+    python batch.py modules.csv results.jsonl --model gpt-3.5-turbo --workers 4 --rpm 60
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import time
+
+import api_util as api
+import cache_util
+import keypool_util
+import objective_util
+import prompt_util as prompt
+import ratelimit_util as ratelimit
+import router_util
+
+MODULE_FIELDS = ('module_title', 'learning_content', 'learning_objectives')
+
+
+def parse_modules(lines, fmt):
+    """Yields module dicts from an iterable of CSV or JSONL lines"""
+    if fmt == 'jsonl':
+        rows = (json.loads(line) for line in lines if line.strip())
+    else:
+        rows = csv.DictReader(lines)
+
+    for index, row in enumerate(rows):
+        module = {field: row.get(field) or '' for field in MODULE_FIELDS}
+        module['id'] = str(row.get('id') or index)
+        module['request'] = row.get('request') or prompt.suggest_request(module['module_title'], module['learning_content'], module['learning_objectives'])
+        yield module
+
+
+class ModuleFile:
+    """Modules of a CSV or JSONL file, parsed from disk each time they are iterated instead of held in memory"""
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def __iter__(self):
+        with open(self.path, newline='', encoding='utf-8') as f:
+            yield from parse_modules(f, 'jsonl' if self.path.endswith('.jsonl') else 'csv')
+
+
+def read_modules(path):
+    return ModuleFile(path)
+
+
+def job_id(module, model_config_dict):
+    return f"{module['id']}:{model_config_dict['model']}"
+
+
+def completed_job_ids(output_path):
+    """Ids of the jobs that already succeeded in an earlier run writing to the same output file"""
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a partially written last line from an interrupted run
+                    continue
+                if not record.get('error'):
+                    done.add(record['job_id'])
+    return done
+
+
+def _drop_partial_line(output_path):
+    """Cuts a partially written last line from an interrupted run off the output file, so the
+    results appended next start on a line of their own"""
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b'\n':
+            return
+        # the start of the partial line, searched backwards block by block
+        position = end
+        while position > 0:
+            block_start = max(0, position - 65536)
+            f.seek(block_start)
+            newline = f.read(position - block_start).rfind(b'\n')
+            if newline >= 0:
+                f.truncate(block_start + newline + 1)
+                return
+            position = block_start
+        f.truncate(0)
+
+
+def run_job(o, module, model_config_dict, options, limiter):
+    """Moderates and generates the learning objectives for one module with one model"""
+    lo_prompt = prompt.build_lo_prompt(
+        request=module['request'],
+        lo_quantity=options['lo_quantity'],
+        cognition_goals=options['cognition_goals'],
+        learning_preferences=options['learning_preferences'],
+        relevance=options['relevance'],
+        module_title=module['module_title'],
+        learning_content=module['learning_content'],
+        learning_objectives=module['learning_objectives']
+    )
+    record = {
+        'job_id': job_id(module, model_config_dict),
+        'id': module['id'],
+        'model': model_config_dict['model'],
+        'module_title': module['module_title'],
+        'request': module['request']
+    }
+    started = time.monotonic()
+
+    try:
+        moderation_result = o.get_moderation(user_message=lo_prompt)
+        if moderation_result['flagged']:
+            record['error'] = "Prompt flagged by content moderation: " + ", ".join(moderation_result['flagged_categories'])
+        else:
+            if limiter is not None:
+                limiter.acquire()
+            lo_request = {**options, 'request': module['request'], 'module_title': module['module_title']}
+            repair = options.get('repair', objective_util.REPAIR_OBJECTIVES)
+            if model_config_dict['model'] == router_util.ROUTER_MODEL:
+                b_r = router_util.get_response(o, lo_request, model_config_dict, lo_prompt, [], repair=repair)
+                record.update({'routed_model': b_r['routed_model'], 'escalated': b_r['escalated'], 'cost': b_r['cost']})
+            else:
+                b_r = o.get_ai_response(model_config_dict=model_config_dict, init_prompt_msg=lo_prompt, messages=[])
+                if repair:
+                    b_r = objective_util.repair_response(o, model_config_dict, lo_request, b_r)
+            record.update({
+                'response': b_r['messages'][-1]['message'],
+                'total_tokens': b_r['total_tokens'],
+                'prompt_tokens': b_r['prompt_tokens'],
+                'completion_tokens': b_r['completion_tokens'],
+                'cached': b_r['cached'],
+                'repaired': b_r.get('repaired', 0)
+            })
+    except Exception as e:
+        logging.error(f"{record['job_id']}: {e}")
+        record['error'] = str(e)
+
+    record['latency'] = round(time.monotonic() - started, 3)
+    return record
+
+
+def run_batch(o, modules, model_config_dicts, output_path, options, workers=4, rpm=60, on_progress=None):
+    """Runs every (module, model) job through a bounded worker pool, appending the results to output_path.
+    Jobs that already succeeded in output_path are skipped. modules is iterated twice, once to count the
+    jobs and once to run them, so it can be read_modules of a file too big to hold in memory. Returns
+    throughput and latency statistics"""
+    done_ids = completed_job_ids(output_path)
+    _drop_partial_line(output_path)
+
+    def jobs():
+        return ((module, model_config_dict) for module in modules for model_config_dict in model_config_dicts)
+
+    total = skipped = 0
+    for job in jobs():
+        total += 1
+        skipped += job_id(*job) in done_ids
+    todo = total - skipped
+
+    # the run's own request budget, evenly spaced; the API limits of the key are enforced by open_ai
+    limiter = ratelimit.TokenBucket(rpm, capacity=1) if rpm else None
+    latencies = []
+    failed = 0
+    started = time.monotonic()
+
+    def write_results(futures):
+        nonlocal failed
+        for future in futures:
+            record = future.result()
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            latencies.append(record['latency'])
+            if record.get('error'):
+                failed += 1
+            if on_progress:
+                on_progress(len(latencies), todo)
+
+    with open(output_path, 'a', encoding='utf-8') as out, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        for module, model_config_dict in jobs():
+            if job_id(module, model_config_dict) in done_ids:
+                continue
+            # keep only a couple of jobs queued per worker, so huge catalogs aren't all held in memory
+            if len(in_flight) >= workers * 2:
+                finished, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                write_results(finished)
+            in_flight.add(pool.submit(run_job, o, module, model_config_dict, options, limiter))
+        write_results(concurrent.futures.as_completed(in_flight))
+
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        'completed': len(latencies) - failed,
+        'failed': failed,
+        'skipped': skipped,
+        'elapsed': round(elapsed, 1),
+        'modules_per_minute': round(len(latencies) / elapsed * 60, 1) if elapsed > 0 else 0,
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p95': _percentile(latencies, 0.95),
+        'latency_max': latencies[-1] if latencies else 0
+    }
+
+
+def _percentile(values, q):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def format_stats(stats):
+    return (
+        f"{stats['completed']} completed, {stats['failed']} failed, {stats['skipped']} skipped (already done) in {stats['elapsed']}s\n"
+        f"Throughput: {stats['modules_per_minute']} modules/minute\n"
+        f"Latency per item: p50 {stats['latency_p50']}s, p95 {stats['latency_p95']}s, max {stats['latency_max']}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate learning objectives for a CSV or JSONL file of course modules")
+    parser.add_argument('input', help="CSV or JSONL file of modules")
+    parser.add_argument('output', help="JSONL file the results are appended to, rerun with the same file to resume")
+    parser.add_argument('--model', action='append', help="model to use, can be repeated, \"auto\" for the router (default gpt-3.5-turbo)")
+    parser.add_argument('--api-key', help="default the keys in OPENAI_API_KEYS or OPENAI_API_KEY")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rpm', type=int, default=60, help="maximum completion requests per minute for this run, 0 for no limit besides the key's own limits")
+    parser.add_argument('--quantity', type=int, default=4, help="number of learning objectives per module")
+    parser.add_argument('--cognition-goal', action='append', choices=prompt.COGNITION_GOALS, help="can be repeated (default all)")
+    parser.add_argument('--learning-preferences', action='store_true')
+    parser.add_argument('--relevance', action='store_true')
+    parser.add_argument('--max-tokens', type=int, default=1000)
+    parser.add_argument('--temperature', type=float, default=0.7)
+    parser.add_argument('--repair', action='store_true', default=objective_util.REPAIR_OBJECTIVES, help="have objectives that break the rules of the prompt rewritten by a short follow-up request (default LO_BUILDER_REPAIR_OBJECTIVES, off)")
+    parser.add_argument('--no-repair', action='store_false', dest='repair', help="keep the objectives as the models wrote them, when LO_BUILDER_REPAIR_OBJECTIVES turned repair on")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    key_pool = keypool_util.get_key_pool() if not args.api_key else None
+    o = api.open_ai(api_key=args.api_key, restart_sequence='|UR|', stop_sequence='|SP|', cache=cache_util.get_response_cache(), key_pool=key_pool)
+    model_config_dicts = [
+        {'model': model, 'max_tokens': args.max_tokens, 'temperature': args.temperature, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+        for model in (args.model or ['gpt-3.5-turbo'])
+    ]
+    options = {
+        'lo_quantity': args.quantity,
+        'cognition_goals': args.cognition_goal or prompt.COGNITION_GOALS,
+        'learning_preferences': args.learning_preferences,
+        'relevance': args.relevance,
+        'repair': args.repair
+    }
+
+    def on_progress(done, total):
+        logging.info(f"{done}/{total} jobs done")
+
+    stats = run_batch(o, read_modules(args.input), model_config_dicts, args.output, options, workers=args.workers, rpm=args.rpm, on_progress=on_progress)
+    print(format_stats(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Latency and throughput benchmark of the request path, against the local mock OpenAI server.
+
+Runs offline, so it can guard against performance regressions in CI:
+
+    python benchmark.py --scenario generate --concurrency 1 8 32 --requests 64 --latency 0.2 --max-p95 1.5
+
+Every simulated session has its own key and sends unique prompts, so nothing is answered from the
+cache. Scenarios:
+
+    completion   open_ai.get_ai_response for one model
+    stream       open_ai.stream_ai_response for one model, read to the end
+    generate     what a click on Generate does: moderation, then both models at once
+
+For each concurrency level it reports p50/p95/p99 latency, calls per second, retries (the error
+responses the mock answered, each one retried or failed) and the peak memory allocated per session.
+With any of the --max-*/--min-* budgets it exits with status 1 when a level misses them.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import math
+import sys
+import threading
+import time
+import tracemalloc
+
+import openai
+
+import api_util as api
+import batch
+import cache_util
+import mock_server
+import prompt_util as prompt
+
+MODEL_CONFIG_DEFAULTS = {'max_tokens': 200, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+MODELS = ('gpt-3.5-turbo', 'gpt-4')
+
+
+def _lo_prompt(run, session, index):
+    return prompt.build_lo_prompt(
+        request=prompt.REQUEST_CONTENT,
+        lo_quantity=4,
+        cognition_goals=prompt.COGNITION_GOALS,
+        learning_preferences=False,
+        relevance=True,
+        module_title=f"Cell Biology {run}-{session}-{index}",
+        learning_content="Cells divide through mitosis and meiosis. Checkpoints regulate the cell cycle. " * 20,
+        learning_objectives=''
+    )
+
+
+def scenario_completion(o, lo_prompt):
+    o.get_ai_response({'model': MODELS[0], **MODEL_CONFIG_DEFAULTS}, lo_prompt, [])
+
+
+def scenario_stream(o, lo_prompt):
+    for event in o.stream_ai_response({'model': MODELS[0], **MODEL_CONFIG_DEFAULTS}, lo_prompt, []):
+        pass
+
+
+def scenario_generate(o, lo_prompt):
+    moderation = o.get_moderation_future(user_message=lo_prompt)
+    if moderation.result()['flagged']:
+        raise o.BadRequest("Prompt flagged by content moderation")
+    responses = o.get_ai_responses([{'model': model, **MODEL_CONFIG_DEFAULTS} for model in MODELS], lo_prompt, {model: [] for model in MODELS})
+    for model, b_r, e in responses:
+        if e is not None:
+            raise e
+
+
+SCENARIOS = {'completion': scenario_completion, 'stream': scenario_stream, 'generate': scenario_generate}
+
+
+def _run_sessions(scenario, run, concurrency, requests_per_session):
+    """Runs concurrent sessions, returning the latency of every successful request and the number of failures"""
+    cache = cache_util.ResponseCache()
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency)
+
+    def session(session_index):
+        nonlocal failures
+        o = api.open_ai(api_key=f"sk-bench-{run}-{session_index}", restart_sequence='|UR|', stop_sequence='|SP|', cache=cache)
+        barrier.wait()
+        for index in range(requests_per_session):
+            lo_prompt = _lo_prompt(run, session_index, index)
+            started = time.perf_counter()
+            try:
+                scenario(o, lo_prompt)
+            except Exception as e:
+                logging.debug(f"session {session_index}: {e}")
+                with lock:
+                    failures += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(session, session_index) for session_index in range(concurrency)]:
+            future.result()
+    return latencies, failures
+
+
+def run_level(mock, scenario_name, concurrency, requests, run):
+    """Benchmarks one concurrency level"""
+    scenario = SCENARIOS[scenario_name]
+    requests_per_session = max(1, math.ceil(requests / concurrency))
+    mock_errors = mock.stats['rate_limited'] + mock.stats['errors']
+
+    started = time.perf_counter()
+    latencies, failures = _run_sessions(scenario, f"{run}-latency", concurrency, requests_per_session)
+    elapsed = time.perf_counter() - started
+    retries = mock.stats['rate_limited'] + mock.stats['errors'] - mock_errors
+
+    # allocations are traced in a separate pass, tracing slows everything down
+    tracemalloc.start()
+    _run_sessions(scenario, f"{run}-memory", concurrency, 1)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'scenario': scenario_name,
+        'concurrency': concurrency,
+        'requests': len(latencies) + failures,
+        'failed': failures,
+        'latency_p50': round(batch._percentile(latencies, 0.5), 4),
+        'latency_p95': round(batch._percentile(latencies, 0.95), 4),
+        'latency_p99': round(batch._percentile(latencies, 0.99), 4),
+        'calls_per_second': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0,
+        'retries': retries,
+        'memory_per_session_kb': round(peak / concurrency / 1024, 1)
+    }
+
+
+def check_budgets(results, max_p95=None, max_p99=None, min_throughput=None, max_session_memory=None, max_failure_rate=None):
+    """Messages for every level that misses a budget"""
+    violations = []
+    for result in results:
+        level = f"{result['scenario']} at concurrency {result['concurrency']}"
+        if max_p95 is not None and result['latency_p95'] > max_p95:
+            violations.append(f"{level}: p95 latency {result['latency_p95']}s is above {max_p95}s")
+        if max_p99 is not None and result['latency_p99'] > max_p99:
+            violations.append(f"{level}: p99 latency {result['latency_p99']}s is above {max_p99}s")
+        if min_throughput is not None and result['calls_per_second'] < min_throughput:
+            violations.append(f"{level}: {result['calls_per_second']} calls/s is below {min_throughput}")
+        if max_session_memory is not None and result['memory_per_session_kb'] > max_session_memory:
+            violations.append(f"{level}: {result['memory_per_session_kb']} KB per session is above {max_session_memory} KB")
+        if max_failure_rate is not None and result['failed'] > max_failure_rate * result['requests']:
+            violations.append(f"{level}: {result['failed']} of {result['requests']} requests failed")
+    return violations
+
+
+RESULT_HEADER = f"{'scenario':<11}{'conc':>5}{'reqs':>6}{'fail':>6}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'calls/s':>9}{'retries':>9}{'KB/session':>12}"
+
+
+def format_result(r):
+    return (
+        f"{r['scenario']:<11}{r['concurrency']:>5}{r['requests']:>6}{r['failed']:>6}{r['latency_p50']:>9}{r['latency_p95']:>9}"
+        f"{r['latency_p99']:>9}{r['calls_per_second']:>9}{r['retries']:>9}{r['memory_per_session_kb']:>12}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the request path against a local mock OpenAI server")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="can be repeated (default all)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help="concurrent sessions per level")
+    parser.add_argument('--requests', type=int, default=64, help="requests per level, spread over the sessions")
+    parser.add_argument('--latency', type=float, default=0.1, help="mock response latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0, help="mock delay between streamed words")
+    parser.add_argument('--rpm', type=int, default=None, help="mock requests per minute per key")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of mock responses that fail with 500")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--max-p95', type=float, help="budget: p95 latency in seconds")
+    parser.add_argument('--max-p99', type=float, help="budget: p99 latency in seconds")
+    parser.add_argument('--min-throughput', type=float, help="budget: calls per second")
+    parser.add_argument('--max-session-memory', type=float, help="budget: peak KB allocated per session")
+    parser.add_argument('--max-failure-rate', type=float, help="budget: share of requests allowed to fail")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('openai').setLevel(logging.ERROR)
+
+    mock = mock_server.MockOpenAI(latency=args.latency, jitter=args.jitter, token_latency=args.token_latency, rpm=args.rpm, error_rate=args.error_rate, seed=args.seed)
+    openai.api_base = mock_server.start_in_thread(mock)
+
+    results = []
+    print(RESULT_HEADER)
+    for scenario_name in args.scenario or sorted(SCENARIOS):
+        for concurrency in args.concurrency:
+            results.append(run_level(mock, scenario_name, concurrency, args.requests, run=f"{scenario_name}-{concurrency}"))
+            print(format_result(results[-1]), flush=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+    violations = check_budgets(results, args.max_p95, args.max_p99, args.min_throughput, args.max_session_memory, args.max_failure_rate)
+    for violation in violations:
+        print(f"Budget exceeded: {violation}", file=sys.stderr)
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import cachetools
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# how often, in seconds, expired rows are deleted from the SQLite file
+PURGE_INTERVAL = 600
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def make_key(*parts):
+    """Stable digest of any JSON-serialisable key parts"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Two tier cache for model responses: an in-process LRU with a TTL, and an optional SQLite
+    file shared by every Streamlit session and surviving restarts"""
+
+    def __init__(self, maxsize=256, ttl=86400, db_path=None):
+        self.ttl = ttl
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._memory = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+            self._purge()
+
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+        if value is None and self.db_path:
+            value = self._get_from_disk(key)
+            if value is not None:
+                with self._lock:
+                    self._memory[key] = value
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+
+    def set(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time())
+                )
+            if time.time() - self._purged_at > PURGE_INTERVAL:
+                self._purge()
+
+
+    def _get_from_disk(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > self.ttl:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM responses WHERE key = ? AND created = ?", (key, row[1]))
+            return None
+        return json.loads(row[0])
+
+
+    def _purge(self):
+        """Deletes the expired rows, so the file doesn't grow without bound"""
+        self._purged_at = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses WHERE created < ?", (self._purged_at - self.ttl,))
+
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: the first caller (the leader) does the work,
+    callers arriving while it runs wait for and share its result instead of repeating it"""
+
+    def __init__(self):
+        self.saved = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+
+    def begin(self, key):
+        """Returns (future, leader). Only the leader runs the call, and must then call finish"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            return future, True
+
+
+    def finish(self, key, result=None, error=None):
+        with self._lock:
+            future = self._calls.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+    def wait(self, future):
+        """The leader's result for a waiting caller, or None if the leader failed. Failures aren't
+        shared, the caller should then make the call itself"""
+        try:
+            result = future.result()
+        except Exception:
+            return None
+        with self._lock:
+            self.saved += 1
+        return result
+
+
+    def do(self, key, fn):
+        """Runs fn, or waits for the identical call already running. Returns (result, shared)"""
+        future, leader = self.begin(key)
+        if not leader:
+            result = self.wait(future)
+            if result is not None:
+                return result, True
+            return self.do(key, fn)
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result=result)
+        return result, False
+
+
+def get_response_cache():
+    """Process-wide response cache, configured through LO_BUILDER_CACHE_* environment variables"""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                maxsize=int(os.getenv('LO_BUILDER_CACHE_SIZE', '256')),
+                ttl=int(os.getenv('LO_BUILDER_CACHE_TTL', '86400')),
+                db_path=os.getenv('LO_BUILDER_CACHE_DB')
+            )
+    return _response_cache
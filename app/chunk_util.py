@@ -0,0 +1,165 @@
+import concurrent.futures
+import hashlib
+import os
+import re
+import threading
+import time
+
+import cachetools
+
+import api_util as api
+import metrics_util as metrics
+import prompt_util as prompt
+
+# content longer than this is read section by section and the results merged
+CHUNK_TOKENS = int(os.getenv('LO_BUILDER_CHUNK_TOKENS', '1500'))
+# responses for single sections are drafts, they don't need the full response budget
+SECTION_MAX_TOKENS = 400
+
+# separate from the api_util pool, whose workers wait on these section requests
+_map_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('LO_BUILDER_MAP_WORKERS', '8')),
+    thread_name_prefix='map_reduce'
+)
+
+# token counts and sections of recent content, so Streamlit reruns don't tokenize the same content again
+_content_cache = cachetools.LRUCache(maxsize=64)
+_content_cache_lock = threading.Lock()
+
+
+def _memoized(kind, text, model, compute, *args):
+    """compute(text, *args, model), remembered by a hash of the text. Hashing is much cheaper than tokenizing"""
+    key = (kind, hashlib.sha256(text.encode('utf-8')).hexdigest(), model, *args)
+    with _content_cache_lock:
+        value = _content_cache.get(key)
+    if value is None:
+        value = compute(text, *args, model)
+        with _content_cache_lock:
+            _content_cache[key] = value
+    return value
+
+
+def needs_chunking(learning_content, model='gpt-3.5-turbo'):
+    return bool(learning_content) and _memoized('tokens', learning_content, model, api.count_tokens) > CHUNK_TOKENS
+
+
+def split_content(text, max_tokens=CHUNK_TOKENS, model='gpt-3.5-turbo'):
+    """Splits text into sections of at most max_tokens, breaking on paragraphs (blank lines) where
+    possible and on sentences inside paragraphs that are too long on their own"""
+    return list(_memoized('sections', text, model, _split_content, max_tokens))
+
+
+def _split_content(text, max_tokens, model):
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        if not paragraph.strip():
+            continue
+        if api.count_tokens(paragraph, model) <= max_tokens:
+            pieces.append(paragraph.strip())
+        else:
+            pieces.extend(_split_long_paragraph(paragraph.strip(), max_tokens, model))
+
+    sections = []
+    section, section_tokens = [], 0
+    for piece in pieces:
+        piece_tokens = api.count_tokens(piece, model)
+        if section and section_tokens + piece_tokens > max_tokens:
+            sections.append('\n\n'.join(section))
+            section, section_tokens = [], 0
+        section.append(piece)
+        section_tokens += piece_tokens
+    if section:
+        sections.append('\n\n'.join(section))
+    return tuple(sections)
+
+
+def _split_long_paragraph(paragraph, max_tokens, model):
+    pieces = []
+    piece = ''
+    for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+        # a single sentence longer than a section is cut by characters
+        while api.count_tokens(sentence, model) > max_tokens:
+            cut = len(sentence) * max_tokens // api.count_tokens(sentence, model)
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:]
+        if piece and api.count_tokens(piece + ' ' + sentence, model) > max_tokens:
+            pieces.append(piece)
+            piece = sentence
+        else:
+            piece = (piece + ' ' + sentence).strip()
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def stream_map_reduce(o, model_config_dict, lo_request, messages, use_cache=True):
+    """Response events for a request whose content is too long to send at once. Every section of the
+    content is moderated and answered in parallel (map), yielding {'model', 'progress', 'status'} events,
+    then the section answers are merged into the final response (reduce), which is streamed like
+    open_ai.stream_ai_response. Token usage of the final 'done' event covers all requests, and its
+    timings those of the merge request plus the time spent on the 'sections' and the overall 'total'"""
+    model = model_config_dict['model']
+    started = time.perf_counter()
+    sections = split_content(lo_request['learning_content'], model=model)
+    # alternatives are only asked of the final merge, the sections are read once
+    section_config_dict = {**model_config_dict, 'max_tokens': min(model_config_dict['max_tokens'], SECTION_MAX_TOKENS), 'n': 1}
+    usage = {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached': True}
+
+    futures = {
+        _map_executor.submit(_get_section_response, o, section_config_dict, prompt.build_section_prompt(lo_request, section, index, len(sections)), index, use_cache): index
+        for index, section in enumerate(sections)
+    }
+    section_results = [None] * len(sections)
+    yield {'model': model, 'progress': 0.0, 'status': f"Reading {len(sections)} sections of content"}
+
+    try:
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            b_r = future.result()
+            section_results[futures[future]] = b_r['messages'][-1]['message']
+            _add_usage(usage, b_r)
+            yield {'model': model, 'progress': done / len(sections), 'status': f"Read {done} of {len(sections)} sections"}
+    finally:
+        for future in futures:
+            future.cancel()
+
+    merge_prompt = _merge_prompt(o, model_config_dict, lo_request, section_results, use_cache, usage)
+    sections_seconds = time.perf_counter() - started
+    metrics.observe('sections', sections_seconds, model=model)
+    for event in o.stream_ai_response(model_config_dict, merge_prompt, messages, use_cache):
+        if 'done' in event:
+            _add_usage(usage, event)
+            timings = {**event['timings'], 'sections': sections_seconds, 'total': time.perf_counter() - started}
+            event = {**event, **usage, 'timings': timings}
+        yield event
+
+
+def _get_section_response(o, model_config_dict, section_prompt, index, use_cache):
+    moderation_result = o.get_moderation(user_message=section_prompt)
+    if moderation_result['flagged']:
+        raise o.BadRequest(f"Section {index + 1} of the content has been flagged by OpenAI's content moderation endpoint due to the following categories: {', '.join(moderation_result['flagged_categories'])}.")
+    return o.get_ai_response(model_config_dict, section_prompt, [], use_cache)
+
+
+def _merge_prompt(o, model_config_dict, lo_request, section_results, use_cache, usage):
+    """Reduce prompt for the section answers. When they don't fit into one request, each half is
+    merged on its own first"""
+    model = model_config_dict['model']
+    merge_prompt = prompt.build_merge_prompt(lo_request, section_results)
+    context_size = api.MODEL_CONTEXT_SIZES.get(model, api.DEFAULT_CONTEXT_SIZE)
+    if len(section_results) <= 2 or api.count_tokens(merge_prompt, model) + model_config_dict['max_tokens'] <= context_size:
+        return merge_prompt
+
+    half = len(section_results) // 2
+    merged_results = []
+    for group in (section_results[:half], section_results[half:]):
+        b_r = o.get_ai_response({**model_config_dict, 'n': 1}, _merge_prompt(o, model_config_dict, lo_request, group, use_cache, usage), [], use_cache)
+        _add_usage(usage, b_r)
+        merged_results.append(b_r['messages'][-1]['message'])
+    return prompt.build_merge_prompt(lo_request, merged_results)
+
+
+def _add_usage(usage, b_r):
+    for key in ('total_tokens', 'prompt_tokens', 'completion_tokens'):
+        usage[key] += b_r[key]
+    # only a response that was entirely answered from the cache is free
+    usage['cached'] = usage['cached'] and b_r['cached']
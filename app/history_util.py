@@ -0,0 +1,189 @@
+import collections
+import contextlib
+import functools
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# turns kept in memory per session and model, older ones are moved to SQLite
+HISTORY_TURNS = int(os.getenv('LO_BUILDER_HISTORY_TURNS', '20'))
+HISTORY_DB = os.getenv('LO_BUILDER_HISTORY_DB') or os.path.join(tempfile.gettempdir(), 'lo-builder-history.sqlite3')
+# moved turns of sessions that are gone are deleted after this many seconds
+HISTORY_TTL = int(os.getenv('LO_BUILDER_HISTORY_TTL', '86400'))
+
+_db_lock = threading.Lock()
+_db_ready = set()
+
+
+class Turn:
+    """One message of a chat history. Reads like the message dicts of api_util (turn['message']),
+    so histories can be sent to the models as they are"""
+    __slots__ = ('role', 'message', 'created')
+
+    def __init__(self, role, message, created=None):
+        self.role = role
+        self.message = message
+        self.created = created if created is not None else time.time()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+class ModelUsage:
+    """Token usage, cost and timings of the latest response of a model"""
+    __slots__ = ('total_tokens', 'prompt_tokens', 'completion_tokens', 'cost', 'cached', 'shared', 'timings', 'repaired', 'routed_model', 'escalated', 'variants', 'selected')
+
+    def __init__(self):
+        self.total_tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0
+        self.cached = False
+        self.shared = False
+        self.timings = None
+        self.repaired = 0
+        self.routed_model = None
+        self.escalated = False
+        self.variants = []
+        self.selected = 0
+
+
+class SessionHistory:
+    """Chat histories and usage of one session, per model. Only the latest max_turns turns of each
+    model stay in memory, older turns are moved to a SQLite file shared by all sessions"""
+
+    def __init__(self, max_turns=HISTORY_TURNS, db_path=HISTORY_DB):
+        self.session_id = uuid.uuid4().hex
+        self.max_turns = max_turns
+        self.db_path = db_path
+        self.turns = {}
+        self.usage = {}
+        self.archived = collections.Counter()
+        # markdown of the moved turns of each model, with the number of turns moved when it was read
+        self._archived_markdown = {}
+
+
+    def add_models(self, models):
+        """Adds empty histories for newly selected models, keeping those of the others"""
+        for model in models:
+            self.turns.setdefault(model, collections.deque())
+            self.usage.setdefault(model, ModelUsage())
+
+
+    def messages(self, model):
+        return list(self.turns.get(model, ()))
+
+
+    def messages_by_model(self):
+        return {model: list(turns) for model, turns in self.turns.items()}
+
+
+    def append(self, model, message):
+        turns = self.turns[model]
+        turns.append(Turn(message['role'], message['message']))
+        while len(turns) > self.max_turns:
+            self._archive(model, turns.popleft())
+
+
+    def record_usage(self, model, b_r, cost):
+        usage = self.usage[model]
+        usage.total_tokens = b_r['total_tokens']
+        usage.prompt_tokens = b_r['prompt_tokens']
+        usage.completion_tokens = b_r['completion_tokens']
+        usage.cost = cost
+        usage.cached = b_r['cached']
+        usage.shared = b_r.get('shared', False)
+        usage.timings = b_r.get('timings')
+        usage.repaired = b_r.get('repaired', 0)
+        usage.routed_model = b_r.get('routed_model')
+        usage.escalated = b_r.get('escalated', False)
+        usage.variants = b_r.get('variants', [])
+        usage.selected = 0
+
+
+    def select_variant(self, model, index):
+        """Makes another of the alternatives of the latest response the one the conversation goes on with"""
+        usage = self.usage[model]
+        turns = self.turns[model]
+        if turns and turns[-1].role == 'assistant' and 0 <= index < len(usage.variants):
+            turns[-1].message = usage.variants[index]
+            usage.selected = index
+
+
+    def archived_turns(self, model):
+        """Turns of the model that were moved out of memory, oldest first"""
+        if not self.archived[model]:
+            return []
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT role, message, created FROM history WHERE session = ? AND model = ? ORDER BY created",
+                (self.session_id, model)
+            ).fetchall()
+        return [Turn(*row) for row in rows]
+
+
+    def archived_markdown(self, model):
+        """Markdown of the turns moved out of memory, read from disk again only when more were moved"""
+        archived, markdown = self._archived_markdown.get(model, (None, None))
+        if archived != self.archived[model]:
+            markdown = history_markdown(self.archived_turns(model))
+            self._archived_markdown[model] = (self.archived[model], markdown)
+        return markdown
+
+
+    def clear(self):
+        for model in self.turns:
+            self.turns[model] = collections.deque()
+            self.usage[model] = ModelUsage()
+        if sum(self.archived.values()):
+            with self._connect() as conn:
+                conn.execute("DELETE FROM history WHERE session = ?", (self.session_id,))
+        self.archived.clear()
+        self._archived_markdown.clear()
+
+
+    def _archive(self, model, turn):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO history (session, model, role, message, created) VALUES (?, ?, ?, ?, ?)",
+                (self.session_id, model, turn.role, turn.message, turn.created)
+            )
+            # sessions don't say when they end, so their turns expire instead
+            conn.execute("DELETE FROM history WHERE created < ?", (time.time() - HISTORY_TTL,))
+        self.archived[model] += 1
+
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with _db_lock:
+                if self.db_path not in _db_ready:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("CREATE TABLE IF NOT EXISTS history (session TEXT, model TEXT, role TEXT, message TEXT, created REAL)")
+                    conn.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session, model)")
+                    _db_ready.add(self.db_path)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def history_markdown(turns):
+    """Markdown of a chat history, one element for all of its turns"""
+    return _history_markdown(tuple((turn.role, turn.message) for turn in turns))
+
+
+@functools.lru_cache(maxsize=256)
+def _history_markdown(turns):
+    # kept here rather than in the app script, which Streamlit runs as a new module on every rerun.
+    # The messages are the same string objects each time, so their hashes are cached and a lookup is cheap
+    return "\n\n".join(
+        f"**User:**  \n{message}" if role == 'user' else f"**AI Response:**  \n{message}"
+        for role, message in turns
+    )
@@ -0,0 +1,312 @@
+import functools
+import hashlib
+import html.parser
+import json
+import os
+import re
+import tempfile
+import time
+import zipfile
+from xml.etree import ElementTree
+
+import metrics_util as metrics
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# uploads are spilled here while they are read, next to the text extracted from them, named by file hash
+INGEST_DIR = os.getenv('LO_BUILDER_INGEST_DIR') or os.path.join(tempfile.gettempdir(), 'lo-builder-ingest')
+# extracted text kept in INGEST_DIR, the least recently uploaded is deleted beyond this many bytes
+INGEST_MAX_BYTES = int(os.getenv('LO_BUILDER_INGEST_MAX_BYTES', str(512 << 20)))
+# temporary files older than this many seconds were left behind by a process that stopped while reading
+STALE_SECONDS = 3600
+# formats that can be uploaded as learning content
+FORMATS = ('pdf', 'docx', 'html', 'htm', 'srt', 'txt', 'md')
+# bytes read from an upload at a time, so a large file is never held twice
+READ_BLOCK = 1 << 20
+# formats without pages of their own are cut into pages of about this many characters
+PAGE_CHARS = 4000
+
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_SRT_TIMESTAMP = re.compile(r"^\d{1,2}:\d{2}:\d{2}[,.]\d{1,3}\s*-->")
+_SRT_TAG = re.compile(r"</?[a-zA-Z][^>]*>|\{\\[^}]*\}")
+# a page break marker in the paragraphs of a document
+_PAGE_BREAK = None
+
+
+class Document:
+    """Text extracted from an uploaded file. Only its path is kept, the text is read when needed"""
+    __slots__ = ('name', 'digest', 'text_path', 'pages', 'cached')
+
+    def __init__(self, name, digest, text_path, pages, cached):
+        self.name = name
+        self.digest = digest
+        self.text_path = text_path
+        self.pages = pages
+        self.cached = cached
+
+
+def file_format(name):
+    fmt = os.path.splitext(name)[1].lower().lstrip('.')
+    if fmt not in FORMATS:
+        raise ValueError(f"Can't read {name}: upload one of {', '.join(FORMATS)}")
+    return fmt
+
+
+def spill(stream, suffix='.upload'):
+    """Copies a file object to a temporary file block by block, returning (sha256 digest, path). The
+    suffix keeps it apart from the extracted texts, also for an uploaded .txt file"""
+    os.makedirs(INGEST_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=INGEST_DIR, suffix=suffix, delete=False) as f:
+        for block in iter(lambda: stream.read(READ_BLOCK), b''):
+            digest.update(block)
+            f.write(block)
+    return digest.hexdigest(), f.name
+
+
+def ingest(name, stream, on_page=None):
+    """Extracts the text of an uploaded file page by page into INGEST_DIR. The upload is spilled to disk
+    first, and the text is written as each page is read, so neither is held in memory in full. Text is
+    cached by the file's hash: the same file uploaded again isn't read again. on_page is called with the
+    number of pages read so far"""
+    fmt = file_format(name)
+    digest, source_path = spill(stream)
+    text_path = os.path.join(INGEST_DIR, digest + '.txt')
+    # every upload extracts into a file of its own, the same file uploaded twice at once doesn't mix
+    out_path = None
+    try:
+        try:
+            # marks the text as recently used, for evict
+            os.utime(text_path)
+            with open(text_path + '.json', encoding='utf-8') as f:
+                pages = json.load(f)['pages']
+            metrics.inc('lo_builder_ingest_total', format=fmt, outcome='cached')
+            return Document(name, digest, text_path, pages, cached=True)
+        except FileNotFoundError:
+            # not extracted yet, or evicted meanwhile
+            pass
+
+        pages = 0
+        with metrics.span('ingest', format=fmt), tempfile.NamedTemporaryFile('w', dir=INGEST_DIR, suffix='.tmp', encoding='utf-8', delete=False) as out:
+            out_path = out.name
+            for page in extract_pages(source_path, fmt):
+                page = page.strip()
+                if not page:
+                    continue
+                out.write(("\n\n" if pages else "") + page)
+                pages += 1
+                if on_page is not None:
+                    on_page(pages)
+        with tempfile.NamedTemporaryFile('w', dir=INGEST_DIR, suffix='.tmp', encoding='utf-8', delete=False) as f:
+            json.dump({'name': name, 'format': fmt, 'pages': pages}, f)
+        os.replace(f.name, text_path + '.json')
+        # only complete extractions end up in the cache
+        os.replace(out_path, text_path)
+        metrics.inc('lo_builder_ingest_total', format=fmt, outcome='extracted')
+        return Document(name, digest, text_path, pages, cached=False)
+    except Exception:
+        if out_path is not None and os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    finally:
+        _remove(source_path)
+        evict(keep=text_path)
+
+
+def evict(keep=None):
+    """Deletes temporary files left behind in INGEST_DIR, then the least recently uploaded extracted
+    texts until those left take at most INGEST_MAX_BYTES. The text at keep stays"""
+    now = time.time()
+    texts, total = [], 0
+    try:
+        entries = list(os.scandir(INGEST_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            # deleted by another session meanwhile
+            continue
+        if entry.name.endswith('.txt'):
+            texts.append((stat.st_mtime, entry.path, stat.st_size))
+            total += stat.st_size
+        elif not entry.name.endswith('.txt.json') and now - stat.st_mtime > STALE_SECONDS:
+            _remove(entry.path)
+    for _, path, size in sorted(texts):
+        if total <= INGEST_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        # the text goes first, a cache lookup only trusts the page count when the text is there
+        _remove(path)
+        _remove(path + '.json')
+        total -= size
+        metrics.inc('lo_builder_ingest_evictions_total')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@functools.lru_cache(maxsize=4)
+def load_text(text_path):
+    """The extracted text of a document, read from disk once however often the app reruns"""
+    with open(text_path, encoding='utf-8') as f:
+        return f.read()
+
+
+def extract_pages(path, fmt):
+    """Generator of the text of a file, one page at a time"""
+    if fmt == 'pdf':
+        return _pdf_pages(path)
+    if fmt == 'docx':
+        return _paginate(_docx_paragraphs(path))
+    if fmt in ('html', 'htm'):
+        return _paginate(_html_paragraphs(path))
+    if fmt == 'srt':
+        return _paginate(_srt_paragraphs(path))
+    return _paginate(_text_paragraphs(path))
+
+
+def _pdf_pages(path):
+    if pypdf is None:
+        raise ValueError("Reading PDF files needs pypdf, install it with pip install pypdf")
+    # the reader loads each page's content only when it is extracted
+    reader = pypdf.PdfReader(path)
+    for page in reader.pages:
+        yield page.extract_text() or ''
+
+
+def _paginate(paragraphs, page_chars=PAGE_CHARS):
+    """Groups paragraphs into pages of about page_chars, or at the page breaks of the document"""
+    page, size = [], 0
+    for paragraph in paragraphs:
+        if paragraph is _PAGE_BREAK or size >= page_chars:
+            if page:
+                yield "\n\n".join(page)
+            page, size = [], 0
+        if paragraph:
+            page.append(paragraph)
+            size += len(paragraph)
+    if page:
+        yield "\n\n".join(page)
+
+
+def _docx_paragraphs(path):
+    """Paragraphs of a Word document, parsed as they are read from the archive. Page breaks set in the
+    document, and those Word recorded when it last laid it out, are kept"""
+    with zipfile.ZipFile(path) as docx, docx.open('word/document.xml') as document:
+        # a break before any text of the paragraph starts a new page with it, a later one after it
+        text, break_before, break_after = [], False, False
+        for _, element in ElementTree.iterparse(document, events=('end',)):
+            if element.tag == _WORD_NS + 't':
+                text.append(element.text or '')
+            elif element.tag == _WORD_NS + 'tab':
+                text.append('\t')
+            elif element.tag == _WORD_NS + 'lastRenderedPageBreak' or (element.tag == _WORD_NS + 'br' and element.get(_WORD_NS + 'type') == 'page'):
+                if ''.join(text).strip():
+                    break_after = True
+                else:
+                    break_before = True
+            elif element.tag == _WORD_NS + 'p':
+                if break_before:
+                    yield _PAGE_BREAK
+                yield ''.join(text).strip()
+                if break_after:
+                    yield _PAGE_BREAK
+                text, break_before, break_after = [], False, False
+                # parsed paragraphs are dropped, so the tree stays small
+                element.clear()
+
+
+class _HTMLText(html.parser.HTMLParser):
+    """Collects the visible text of an HTML page, a paragraph per block element"""
+
+    _BLOCKS = frozenset(('p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'blockquote', 'pre', 'table'))
+    _HIDDEN = frozenset(('script', 'style', 'head', 'noscript', 'template'))
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self._text = []
+        self._hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._HIDDEN:
+            self._hidden += 1
+        elif tag in self._BLOCKS:
+            self._end_paragraph()
+
+    def handle_endtag(self, tag):
+        if tag in self._HIDDEN:
+            self._hidden = max(0, self._hidden - 1)
+        elif tag in self._BLOCKS:
+            self._end_paragraph()
+
+    def handle_data(self, data):
+        if not self._hidden:
+            self._text.append(data)
+
+    def close(self):
+        super().close()
+        self._end_paragraph()
+
+    def _end_paragraph(self):
+        paragraph = ' '.join(''.join(self._text).split())
+        if paragraph:
+            self.paragraphs.append(paragraph)
+        self._text = []
+
+
+def _html_paragraphs(path):
+    parser = _HTMLText()
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for block in iter(lambda: f.read(READ_BLOCK), ''):
+            parser.feed(block)
+            yield from parser.paragraphs
+            parser.paragraphs = []
+    parser.close()
+    yield from parser.paragraphs
+
+
+def _srt_paragraphs(path):
+    """Spoken text of a subtitle file, without cue numbers, timestamps or styling. Cues are joined
+    into running text, a paragraph per PAGE_CHARS / 4, and lines repeated by consecutive cues are
+    kept once"""
+    paragraph, size, previous = [], 0, None
+    with open(path, encoding='utf-8-sig', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.isdigit() or _SRT_TIMESTAMP.match(line):
+                continue
+            line = _SRT_TAG.sub('', line).strip()
+            if not line or line == previous:
+                continue
+            previous = line
+            paragraph.append(line)
+            size += len(line)
+            if size >= PAGE_CHARS // 4:
+                yield ' '.join(paragraph)
+                paragraph, size = [], 0
+    if paragraph:
+        yield ' '.join(paragraph)
+
+
+def _text_paragraphs(path):
+    paragraph = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.strip():
+                paragraph.append(line.rstrip())
+            elif paragraph:
+                yield "\n".join(paragraph)
+                paragraph = []
+    if paragraph:
+        yield "\n".join(paragraph)
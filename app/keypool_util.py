@@ -0,0 +1,91 @@
+import hashlib
+import os
+import random
+import threading
+import time
+
+import metrics_util as metrics
+import ratelimit_util as ratelimit
+
+# how long a key sits out after a rate limit error, and after its quota ran out or it was rejected
+KEY_COOLDOWN = int(os.getenv('LO_BUILDER_KEY_COOLDOWN', '60'))
+QUOTA_COOLDOWN = int(os.getenv('LO_BUILDER_QUOTA_COOLDOWN', '3600'))
+
+_key_pool = None
+_key_pool_lock = threading.Lock()
+
+
+class PooledKey:
+    __slots__ = ('api_key', 'organization', 'fingerprint', 'label', 'cooldown_until')
+
+    def __init__(self, api_key, organization=None):
+        self.api_key = api_key
+        self.organization = organization
+        self.fingerprint = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        # short enough to be safe in logs and metrics, long enough to tell keys apart
+        self.label = self.fingerprint[:8]
+        self.cooldown_until = 0.0
+
+
+class KeyPool:
+    """API keys of the deployment, shared by all sessions. Each request goes to the key with the most
+    rate limit headroom left for its model, and keys that hit their limits sit out for a while"""
+
+    def __init__(self, keys):
+        self.keys = [PooledKey(api_key, organization) for api_key, organization in keys]
+        self.fingerprint = hashlib.sha256(''.join(key.fingerprint for key in self.keys).encode('utf-8')).hexdigest()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def pick(self, model):
+        """The key to send the next request for the model with. When every key is cooling down,
+        the one that is back first"""
+        now = time.monotonic()
+        with self._lock:
+            ready = [key for key in self.keys if key.cooldown_until <= now]
+            if not ready:
+                return min(self.keys, key=lambda key: key.cooldown_until)
+        # random tie-breaks keep idle keys from all sending to the first one
+        return max(ready, key=lambda key: (ratelimit.get_limiter(key.fingerprint, model).headroom(), random.random()))
+
+
+    def available(self):
+        """Number of keys not cooling down"""
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for key in self.keys if key.cooldown_until <= now)
+
+
+    def cool_down(self, key, seconds):
+        with self._lock:
+            key.cooldown_until = max(key.cooldown_until, time.monotonic() + seconds)
+        metrics.inc('lo_builder_key_cooldowns_total', key=key.label)
+
+
+    def record(self, key, outcome):
+        metrics.inc('lo_builder_key_requests_total', key=key.label, outcome=outcome)
+
+
+def parse_keys(value):
+    """(api_key, organization) pairs from "sk-a:org-1,sk-b" """
+    keys = []
+    for item in value.split(','):
+        api_key, _, organization = item.strip().partition(':')
+        if api_key:
+            keys.append((api_key, organization or None))
+    return keys
+
+
+def get_key_pool():
+    """Process-wide pool of the keys in OPENAI_API_KEYS, or of OPENAI_API_KEY alone. None without keys"""
+    global _key_pool
+    with _key_pool_lock:
+        if _key_pool is None:
+            keys = parse_keys(os.getenv('OPENAI_API_KEYS') or os.getenv('OPENAI_API_KEY') or '')
+            if keys:
+                _key_pool = KeyPool(keys)
+    return _key_pool
@@ -1,6 +1,23 @@
 import os
+import io 
+import functools 
+import hashlib 
+import tempfile 
 import streamlit as st  
 import api_util as api 
+import cache_util 
+import prompt_util as prompt 
+import batch 
+import chunk_util 
+import metrics_util as metrics 
+import history_util 
+import keypool_util 
+import scheduler_util 
+import alignment_util 
+import objective_util 
+import provider_util 
+import router_util 
+import ingest_util 
 import logging 
 
 logging.basicConfig(level=logging.INFO)
@@ -16,8 +33,14 @@ st.set_page_config(
     initial_sidebar_state="collapsed")
 
 ## helper strings
-help_msg_model_option = "Controls which OpenAI model(s) to use. GPT-4 is more capable, but more expensive."
+help_msg_model_option = "Controls which OpenAI model(s) to use. GPT-4 is more capable, but more expensive. Auto picks the cheaper and faster model that suits each request, and asks GPT-4 only when the answer of GPT-3.5-turbo breaks the rules of the prompt."
+help_msg_local_model = "Also answer with a small model running on this server. It has no rate limits or cost, but is less capable than the OpenAI models."
 help_msg_show_usage = "Display token usage and cost estimates for each query."
+help_msg_bypass_cache = "Identical requests are answered from a cache. With a temperature above 0, tick this to ask the models for a new answer instead."
+help_msg_repair_objectives = "Check the generated objectives against the rules of the prompt (quantity, Bloom's verbs, cognition goals) and have only the ones that break them rewritten, with a short follow-up request. Skipped when you edited the prompt."
+help_msg_variants = "How many alternative sets of objectives each model writes. They come from one request, so the prompt is only paid for once, and you can pick the set to continue with."
+help_msg_content_file = "Read the learning content from a course file instead of pasting it: a PDF, Word document, web page, subtitles (SRT) or plain text. Large files are read page by page on the server, and a file read before is not read again."
+help_msg_stream_responses = "Show the responses word by word as the models write them, instead of waiting for the full answer."
 help_msg_api_key = "This app runs by default on GPT 3.5-turbo, for free. To add the option to retreive responses using GPT-4, add your own key. If you add your own key, both GPT-3.5 and GPT-4 will use your key. Your API key is not stored. If you refresh the page, you'll need to enter your key again. "
 help_msg_model_temperature = "Controls how creativity in AI's response"
 help_msg_model_top_p = "Prevents AI from giving certain answers that are too obvious"
@@ -36,6 +59,14 @@ helper_app_contact = "Developed by John Swope @ [Curricu.me](https://curricu.me)
 helper_app_need_api_key = "Welcome! This app allows you to test the effectiveness of your prompts using OpenAI's text models: gpt-3.5-turbo, and gpt-4 (if you have access to it). To get started, simply enter your OpenAI API Key below."
 helper_api_key_prompt = "The model comparison tool works best with pay-as-you-go API keys. Free trial API keys are limited to 3 requests a minute, not enough to test your prompts. For more information on OpenAI API rate limits, check [this link](https://platform.openai.com/docs/guides/rate-limits/overview).\n\n- Don't have an API key? No worries! Create one [here](https://platform.openai.com/account/api-keys).\n- Want to upgrade your free-trial API key? Just enter your billing information [here](https://platform.openai.com/account/billing/overview)."
 helper_api_key_placeholder = "Paste your OpenAI API key here (sk-...)"
+helper_bulk_generation = "Generate learning objectives for many modules at once. Upload a CSV (with a header row) or JSONL file with the columns `module_title`, `learning_content` and `learning_objectives`, and optionally `id` and `request`. The options above and the AI configuration in the sidebar apply to every module. If a run is interrupted, run the same file again to pick up where it stopped."
+
+# start completions while the prompt is still being moderated, see _fetch_responses
+speculative_moderation = os.getenv('LO_BUILDER_SPECULATIVE_MODERATION', '1') == '1'
+
+# Prometheus-style metrics of all sessions, served once per process
+if os.getenv('LO_BUILDER_METRICS_PORT'):
+    metrics.start_http_server(int(os.getenv('LO_BUILDER_METRICS_PORT')))
 
 ## Temporary testing values
 test_vals = {
@@ -47,34 +78,34 @@ test_vals = {
 # Handlers 
 def handler_verify_key():
     """Handle OpenAI key verification"""
-    # oai_api_key = st.session_state.open_ai_key_input
-    oai_api_key = os.getenv('OPENAI_API_KEY')
-    o = api.open_ai(api_key=oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|')
+    # the app's own keys, requests are balanced over them by the key pool
+    oai_api_key = None
+    o = api.open_ai(api_key=oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|', key_pool=keypool_util.get_key_pool())
     try: 
-        # make a call to get available models 
-        open_ai_models = o.get_models()
-        st.session_state.openai_model_params = [('gpt-3.5-turbo', 4096)]
+        # get available models, verified keys are cached so this is usually free
+        with metrics.span('key_check') as key_check:
+            o.get_available_models()
+        st.session_state.phase_timings = {'key_check': key_check['seconds']}
+        st.session_state.openai_model_params = [('gpt-3.5-turbo', api.MODEL_CONTEXT_SIZES['gpt-3.5-turbo'])]
+        st.session_state.openai_model_params += _local_model_params()
         
         st.session_state.openai_models=[model_name for model_name, _ in st.session_state.openai_model_params]            
         st.session_state.openai_models_str = ', '.join(st.session_state.openai_models)
 
-        st.session_state.chat_histories = {model: [] for model in st.session_state.openai_models}
-        st.session_state.total_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.prompt_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.completion_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.conversation_cost = {model: 0 for model in st.session_state.openai_models}
-
+        _init_model_state()
 
         # store OpenAI API key in session states 
         st.session_state.oai_api_key = oai_api_key
 
         # enable the test
         st.session_state.test_disabled = False 
+        return True
 
     except Exception as e: 
         with openai_key_container: 
             st.error(f"{e}")
         logging.error(f"{e}")
+        return False
 
 
 def handler_verify_gpt4_key():
@@ -84,210 +115,279 @@ def handler_verify_gpt4_key():
     o = api.open_ai(api_key=oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|')
 
     try: 
-        # make a call to get available models 
-        open_ai_models = o.get_models()
-        st.session_state.openai_model_params = [('gpt-3.5-turbo', 4096), ('gpt-4', 8000)]
+        # get available models, verified keys are cached so this is usually free
+        with metrics.span('key_check') as key_check:
+            open_ai_models = o.get_available_models()
+        st.session_state.phase_timings = {'key_check': key_check['seconds']}
+        st.session_state.openai_model_params = [('gpt-3.5-turbo', api.MODEL_CONTEXT_SIZES['gpt-3.5-turbo']), ('gpt-4', api.MODEL_CONTEXT_SIZES['gpt-4'])]
 
         # check to see if the API key has access to gpt-4
-        for m in open_ai_models['data']: 
-            if m['id'] == 'gpt-4':
-                if st.session_state.model_options == ["GPT-4"]:
-                    st.session_state.openai_model_params = [('gpt-4', 8000)]
-                elif st.session_state.model_options == ["GPT 3.5-turbo"]:
-                    st.session_state.openai_model_params = [('gpt-3.5-turbo', 4096)]
-                elif st.session_state.model_options == ["GPT-4", "GPT 3.5-turbo"] or ["GPT 3.5-turbo", "GPT-4"]:
-                    st.session_state.openai_model_params = [('gpt-3.5-turbo', 4096),('gpt-4', 8000)]
+        if 'gpt-4' in open_ai_models:
+            # the router gets a column of its own, next to the models picked by hand
+            model_options = [option for option in st.session_state.model_options if option != "Auto"]
+            if model_options == ["GPT-4"]:
+                st.session_state.openai_model_params = [('gpt-4', api.MODEL_CONTEXT_SIZES['gpt-4'])]
+            elif model_options == ["GPT 3.5-turbo"]:
+                st.session_state.openai_model_params = [('gpt-3.5-turbo', api.MODEL_CONTEXT_SIZES['gpt-3.5-turbo'])]
+            elif not model_options and "Auto" in st.session_state.model_options:
+                st.session_state.openai_model_params = []
+            elif model_options == ["GPT-4", "GPT 3.5-turbo"] or ["GPT 3.5-turbo", "GPT-4"]:
+                st.session_state.openai_model_params = [('gpt-3.5-turbo', api.MODEL_CONTEXT_SIZES['gpt-3.5-turbo']),('gpt-4', api.MODEL_CONTEXT_SIZES['gpt-4'])]
+            if "Auto" in st.session_state.model_options:
+                st.session_state.openai_model_params += [(router_util.ROUTER_MODEL, api.MODEL_CONTEXT_SIZES['gpt-4'])]
+        st.session_state.openai_model_params += _local_model_params()
         
         st.session_state.openai_models=[model_name for model_name, _ in st.session_state.openai_model_params]            
         st.session_state.openai_models_str = ', '.join(st.session_state.openai_models)
 
-        st.session_state.chat_histories = {model: [] for model in st.session_state.openai_models}
-        st.session_state.total_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.prompt_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.completion_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.conversation_cost = {model: 0 for model in st.session_state.openai_models}
-
+        _init_model_state()
 
         # store OpenAI API key in session states 
         st.session_state.oai_api_key = oai_api_key
 
         # enable the test
         st.session_state.test_disabled = False 
+        return True
 
     except Exception as e: 
         with openai_key_container: 
             st.error(f"{e}")
         logging.error(f"{e}")
+        return False
+
+
+def _local_model_params():
+    """The local model, shown in its own column next to the OpenAI models when the user picked it"""
+    if not st.session_state.get('use_local_model'):
+        return []
+    return [(model_name, api.MODEL_CONTEXT_SIZES[model_name]) for model_name in sorted(provider_util.local_models())]
+
+
+def _open_ai():
+    """Client for the key entered by the user, or for the app's key pool when none was entered. 
+    Each browser session takes its own turns in the request scheduler"""
+    key_pool = None if st.session_state.oai_api_key else keypool_util.get_key_pool()
+    return api.open_ai(api_key=st.session_state.oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|', cache=cache_util.get_response_cache(), key_pool=key_pool, session=st.session_state.history.session_id)
+
+
+def _init_model_state():
+    """Adds empty history and usage entries for newly selected models, keeping the results of the others"""
+    if 'history' not in st.session_state:
+        st.session_state.history = history_util.SessionHistory()
+    st.session_state.history.add_models(st.session_state.openai_models)
 
 
 def handler_fetch_model_responses():
-    handler_verify_key()
     """Fetches model responses"""
+    if handler_verify_key():
+        _fetch_responses()
+
+
+def handler_fetch_gpt4_model_responses():
+    """Fetches model responses"""
+    if handler_verify_gpt4_key():
+        _fetch_responses()
+
+
+def _fetch_responses():
+    """Moderates the prompt, then fetches the responses of all selected models concurrently"""
 
     model_config_template = {
         'max_tokens': st.session_state.model_max_tokens,
         'temperature': st.session_state.model_temperature,
         'top_p': st.session_state.model_top_p,
         'frequency_penalty': st.session_state.model_frequency_penalty,
-        'presence_penalty': st.session_state.model_presence_penalty
+        'presence_penalty': st.session_state.model_presence_penalty,
+        'n': st.session_state.get('variants', 1)
     }
 
-    o = api.open_ai(api_key=st.session_state.oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|')
-    progress = 0 
-    user_query_moderated = True
+    # objectives that all clearly pass or clearly fail the quick local check need no review by the models
+    st.session_state.alignment_skipped = bool(
+        lo_request['request'] == prompt.REQUEST_VALIDATE and st.session_state.get('alignment_fast_path')
+        and alignment_util.check_alignment(lo_request['learning_content'], lo_request['learning_objectives'])['conclusive']
+    )
+    if st.session_state.alignment_skipped:
+        return
+
+    o = _open_ai()
+    use_cache = not (st.session_state.get('bypass_cache', False) and st.session_state.model_temperature > 0)
+    st.session_state.response_errors = {}
 
-    init_prompt = st.session_state.init_prompt
+    # long content is read section by section, and each section is moderated on its own
+    map_reduce_request = lo_request if use_map_reduce else None
+    init_prompt = lo_prompt if use_map_reduce else st.session_state.init_prompt
 
-    # Moderate prompt  
     if init_prompt and init_prompt != '':
-        try:
-            moderation_result = o.get_moderation(user_message = init_prompt)
-            if moderation_result['flagged'] == True:
-                user_query_moderated = False 
-                flagged_categories_str = ", ".join(moderation_result['flagged_categories'])
-                with openai_key_container:
-                    st.error(f"⚠️ Your prompt has been flagged by OpenAI's content moderation endpoint due to the following categories: {flagged_categories_str}.  \n" +
-                    "In order to comply with [OpenAI's usage policy](https://openai.com/policies/usage-policies), we cannot send this prompt to the models. Please modify your prompt and try again.")
-        except Exception as e: 
-            logging.error(f"{e}")
-            with openai_key_container:
-                st.error(f"{e}")
-
-
-    if init_prompt and init_prompt != '' and user_query_moderated == True:
-        for index, m in enumerate(st.session_state.openai_models): 
-            progress_bar_container.progress(progress, text=f"Getting {m} responses")
-            
-            try:
-                b_r = o.get_ai_response(
-                    model_config_dict={**model_config_template, 'model':m}, 
-                    init_prompt_msg=lo_prompt, 
-                    messages=st.session_state.chat_histories[m]
-                )
-
-                st.session_state.chat_histories[m].append(b_r['messages'][-1])
-                st.session_state.total_tokens[m]=b_r['total_tokens']
-                st.session_state.prompt_tokens[m]=b_r['prompt_tokens']
-                st.session_state.completion_tokens[m]=b_r['completion_tokens']
-
-                if m == 'gpt-4':
-                    # $0.03 / 1K prompt tokens + $0.06 / 1K completion tokens
-                    st.session_state.conversation_cost[m] = 0.03 * st.session_state.prompt_tokens[m] / 1000 + 0.06 * st.session_state.completion_tokens[m] / 1000
-                elif m == 'gpt-3.5-turbo':
-                    # 0.002 / 1K total tokens 
-                    st.session_state.conversation_cost[m] = 0.002 * st.session_state.total_tokens[m] / 1000
-
-                # update the progress bar 
-                progress = (index + 1) / len(st.session_state.openai_models)
-                progress_bar_container.progress(progress, text=f"Getting {m} responses")
-
-            except o.OpenAIError as e:
-                logging.error(f"{e}")
+        # Moderate prompt. Verdicts are cached, and in speculative mode the completions start
+        # while moderation is still running and their output is held back until it passes
+        moderation = None
+        if map_reduce_request is None:
+            moderation = o.get_moderation_future(user_message = init_prompt)
+            if not speculative_moderation or moderation.done():
+                if not _moderation_passed(moderation):
+                    return
+                moderation = None
+
+        models = st.session_state.openai_models
+
+        if st.session_state.get('stream_responses'):
+            # the responses are streamed into the result columns by ui_test_result
+            st.session_state.pending_responses = {
+                'model_config_dicts': [{**model_config_template, 'model':m} for m in models],
+                'init_prompt_msg': lo_prompt,
+                'use_cache': use_cache,
+                'moderation': moderation,
+                'map_reduce_request': map_reduce_request,
+                'lo_request': lo_request
+            }
+            return
+
+        progress_bar_container.progress(0, text=f"Getting {st.session_state.openai_models_str} responses")
+
+        # all models are queried at once, results come back in the order the models answer
+        if map_reduce_request is None:
+            responses = o.get_ai_responses(
+                model_config_dicts=[{**model_config_template, 'model':m} for m in models],
+                init_prompt_msg=lo_prompt,
+                messages_by_model=st.session_state.history.messages_by_model(),
+                use_cache=use_cache,
+                on_queue=lambda position, seconds: progress_bar_container.progress(0, text=scheduler_util.format_wait(position, seconds)),
+                routes=_routes(o, lo_request, use_cache)
+            )
+        else:
+            events = _stream_map_reduce_responses(o, [{**model_config_template, 'model':m} for m in models], map_reduce_request, use_cache)
+            responses = (
+                (event['model'], event, None) if 'done' in event else (event['model'], None, event['error']) 
+                for event in events if 'done' in event or 'error' in event
+            )
+
+        for index, (m, b_r, e) in enumerate(responses):
+            if moderation is not None:
+                if not _moderation_passed(moderation):
+                    # the prompt was flagged, responses still in flight are thrown away
+                    break
+                moderation = None
+
+            if e is None:
+                _update_usage(m, _repair_objectives(o, {**model_config_template, 'model':m}, lo_request, b_r, use_cache))
+            else:
+                logging.error(f"{m}: {e}")
                 with openai_key_container:
-                    if e.error_type == "RateLimitError" and str(e) == "OpenAI API Error: You exceeded your current quota, please check your plan and billing details.":
-                        st.error(f"{e}  \n  \n**Friendly reminder:** If you are using a free-trial OpenAI API key, this error is caused by the limited rate limits associated with the key. To optimize your experience, we recommend upgrading to the pay-as-you-go OpenAI plan.")
-                    else:
-                        st.error(f"{e}")
+                    st.error(_format_error(m, e))
 
-            except Exception as e: 
-                with openai_key_container:
-                    st.error(f"{e}")
-                logging.error(f"{e}")
+            # update the progress bar 
+            progress = (index + 1) / len(models)
+            progress_bar_container.progress(progress, text=f"Received {m} response ({index + 1}/{len(models)})")
                     
     progress_bar_container.empty()
 
 
-def handler_fetch_gpt4_model_responses():
-    handler_verify_gpt4_key()
-    """Fetches model responses"""
+def _stream_map_reduce_responses(o, model_config_dicts, map_reduce_request, use_cache):
+    """Response events of all models for content that is read section by section"""
+    repair = st.session_state.get('repair_objectives', objective_util.REPAIR_OBJECTIVES)
+    return api.merge_streams({
+        model_config_dict['model']: functools.partial(
+            chunk_util.stream_map_reduce, o, model_config_dict, map_reduce_request, st.session_state.history.messages(model_config_dict['model']), use_cache
+        ) if model_config_dict['model'] != router_util.ROUTER_MODEL else functools.partial(
+            router_util.stream_map_reduce, o, model_config_dict, map_reduce_request, st.session_state.history.messages(model_config_dict['model']), use_cache, repair
+        )
+        for model_config_dict in model_config_dicts
+    })
 
-    model_config_template = {
-        'max_tokens': st.session_state.model_max_tokens,
-        'temperature': st.session_state.model_temperature,
-        'top_p': st.session_state.model_top_p,
-        'frequency_penalty': st.session_state.model_frequency_penalty,
-        'presence_penalty': st.session_state.model_presence_penalty
-    }
 
-    o = api.open_ai(api_key=st.session_state.oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|')
-    progress = 0 
-    user_query_moderated = True
+def _routes(o, lo_request, use_cache, stream=False):
+    """The router, answering for the Auto model. It repairs the objectives itself, with the model that wrote them"""
+    repair = _repair_enabled(lo_request)
+    route = router_util.stream_response if stream else router_util.get_response
+    return {router_util.ROUTER_MODEL: functools.partial(route, o, lo_request, repair=repair)}
 
-    init_prompt = st.session_state.init_prompt
 
-    # Moderate prompt  
-    if init_prompt and init_prompt != '':
-        try:
-            moderation_result = o.get_moderation(user_message = init_prompt)
-            if moderation_result['flagged'] == True:
-                user_query_moderated = False 
-                flagged_categories_str = ", ".join(moderation_result['flagged_categories'])
-                with openai_key_container:
-                    st.error(f"⚠️ Your prompt has been flagged by OpenAI's content moderation endpoint due to the following categories: {flagged_categories_str}.  \n" +
-                    "In order to comply with [OpenAI's usage policy](https://openai.com/policies/usage-policies), we cannot send this prompt to the models. Please modify your prompt and try again.")
-        except Exception as e: 
-            logging.error(f"{e}")
+def _moderation_passed(moderation):
+    """Waits for the moderation verdict on the prompt, showing why it was rejected if it was flagged"""
+    try:
+        with metrics.span('moderation_wait') as moderation_wait:
+            moderation_result = moderation.result()
+        st.session_state.setdefault('phase_timings', {})['moderation_wait'] = moderation_wait['seconds']
+        if moderation_result['flagged'] == True:
+            flagged_categories_str = ", ".join(moderation_result['flagged_categories'])
             with openai_key_container:
-                st.error(f"{e}")
-
-
-    if init_prompt and init_prompt != '' and user_query_moderated == True:
-        for index, m in enumerate(st.session_state.openai_models): 
-            progress_bar_container.progress(progress, text=f"Getting {m} responses")
-            
-            try:
-                b_r = o.get_ai_response(
-                    model_config_dict={**model_config_template, 'model':m}, 
-                    init_prompt_msg=lo_prompt, 
-                    messages=st.session_state.chat_histories[m]
-                )
-
-                st.session_state.chat_histories[m].append(b_r['messages'][-1])
-                st.session_state.total_tokens[m]=b_r['total_tokens']
-                st.session_state.prompt_tokens[m]=b_r['prompt_tokens']
-                st.session_state.completion_tokens[m]=b_r['completion_tokens']
-
-                if m == 'gpt-4':
-                    # $0.03 / 1K prompt tokens + $0.06 / 1K completion tokens
-                    st.session_state.conversation_cost[m] = 0.03 * st.session_state.prompt_tokens[m] / 1000 + 0.06 * st.session_state.completion_tokens[m] / 1000
-                elif m == 'gpt-3.5-turbo':
-                    # 0.002 / 1K total tokens 
-                    st.session_state.conversation_cost[m] = 0.002 * st.session_state.total_tokens[m] / 1000
-
-                # update the progress bar 
-                progress = (index + 1) / len(st.session_state.openai_models)
-                progress_bar_container.progress(progress, text=f"Getting {m} responses")
-
-            except o.OpenAIError as e:
-                logging.error(f"{e}")
-                with openai_key_container:
-                    if e.error_type == "RateLimitError" and str(e) == "OpenAI API Error: You exceeded your current quota, please check your plan and billing details.":
-                        st.error(f"{e}  \n  \n**Friendly reminder:** If you are using a free-trial OpenAI API key, this error is caused by the limited rate limits associated with the key. To optimize your experience, we recommend upgrading to the pay-as-you-go OpenAI plan.")
-                    else:
-                        st.error(f"{e}")
+                st.error(f"⚠️ Your prompt has been flagged by OpenAI's content moderation endpoint due to the following categories: {flagged_categories_str}.  \n" +
+                "In order to comply with [OpenAI's usage policy](https://openai.com/policies/usage-policies), we cannot send this prompt to the models. Please modify your prompt and try again.")
+            return False
+    except Exception as e: 
+        logging.error(f"{e}")
+        with openai_key_container:
+            st.error(f"{e}")
+    return True
+
+
+def _repair_enabled(lo_request):
+    """Whether the user asked for repairs. Objectives are checked against the request the prompt was
+    built from, so there are none when the prompt was edited by hand"""
+    if not st.session_state.get('repair_objectives', objective_util.REPAIR_OBJECTIVES):
+        return False
+    edited_prompt = st.session_state.get('init_prompt')
+    return edited_prompt is None or edited_prompt == prompt.build_lo_prompt(**lo_request)
 
-            except Exception as e: 
-                with openai_key_container:
-                    st.error(f"{e}")
-                logging.error(f"{e}")
-                    
-    progress_bar_container.empty()
+
+def _repair_objectives(o, model_config_dict, lo_request, b_r, use_cache):
+    """Has only the generated objectives that fail validation rewritten, when the user asked for it"""
+    if 'routed_model' in b_r or not _repair_enabled(lo_request):
+        return b_r
+    return objective_util.repair_response(o, model_config_dict, lo_request, b_r, use_cache)
+
+
+def _update_usage(m, b_r):
+    """Stores a model response and its token usage and cost in the session"""
+    st.session_state.history.append(m, b_r['messages'][-1])
+
+    if 'cost' in b_r:
+        # routed responses were priced by the models that wrote them
+        cost = b_r['cost']
+    elif b_r['cached']:
+        # answered from the response cache or by an identical request in flight, nothing was billed
+        cost = 0
+    else:
+        cost = api.estimate_cost(m, b_r['prompt_tokens'], b_r['completion_tokens'])
+    st.session_state.history.record_usage(m, b_r, cost)
+
+
+def _format_timings(timings, phase_timings):
+    """One line telling where the time of a response went"""
+    parts = []
+    if 'key_check' in phase_timings:
+        parts.append(f"key check {phase_timings['key_check']:.2f}s")
+    if 'moderation_wait' in phase_timings:
+        parts.append(f"moderation wait {phase_timings['moderation_wait']:.2f}s")
+    parts.append(f"queue {timings['queue']:.2f}s")
+    if timings['retries']:
+        parts.append(f"{timings['retries']} retries {timings['retry_wait']:.2f}s")
+    if 'sections' in timings:
+        parts.append(f"sections {timings['sections']:.2f}s")
+    if 'ttft' in timings:
+        parts.append(f"first token {timings['ttft']:.2f}s")
+    parts.append(f"total {timings['total']:.2f}s")
+    return 'Timings: ' + ', '.join(parts)
+
+
+def _format_error(m, e):
+    """Error message shown for a model whose request failed"""
+    if isinstance(e, api.open_ai.OpenAIError) and e.error_type == "RateLimitError" and str(e) == "OpenAI API Error: You exceeded your current quota, please check your plan and billing details.":
+        return f"{m}: {e}  \n  \n**Friendly reminder:** If you are using a free-trial OpenAI API key, this error is caused by the limited rate limits associated with the key. To optimize your experience, we recommend upgrading to the pay-as-you-go OpenAI plan."
+    return f"{m}: {e}"
 
 
 def handler_start_new_test():
     """Start new test"""
-    st.session_state.chat_histories = {model: [] for model in st.session_state.openai_models}
-    st.session_state.total_tokens = {model: 0 for model in st.session_state.openai_models}
-    st.session_state.prompt_tokens = {model: 0 for model in st.session_state.openai_models}
-    st.session_state.completion_tokens = {model: 0 for model in st.session_state.openai_models}
-    st.session_state.conversation_cost = {model: 0 for model in st.session_state.openai_models}
+    st.session_state.history.clear()
+    st.session_state.response_errors = {}
 
 def ui_sidebar():
     with st.sidebar:
 
         st.sidebar.title("OpenAI Configuration")
 
-        if "chat_histories" in st.session_state and len(st.session_state.chat_histories[st.session_state.openai_models[-1]]) > 0: 
+        if "history" in st.session_state and len(st.session_state.history.messages(st.session_state.openai_models[-1])) > 0: 
             st.button(label="Clear Results", on_click=handler_start_new_test)
 
             st.write("---")
@@ -295,15 +395,24 @@ def ui_sidebar():
         model_options = st.text_input("Enter API Key to use GPT-4:", key="custom_question_level", on_change=handler_verify_gpt4_key, placeholder=helper_api_key_placeholder, help= help_msg_api_key)
 
         if model_options:
-            st.multiselect(label="OpenAI Models", options=["GPT-4", "GPT 3.5-turbo"], key='model_options', default=['GPT 3.5-turbo','GPT-4'], help=help_msg_model_option, disabled=st.session_state.test_disabled)
+            st.multiselect(label="OpenAI Models", options=["GPT-4", "GPT 3.5-turbo", "Auto"], key='model_options', default=['GPT 3.5-turbo','GPT-4'], help=help_msg_model_option, disabled=st.session_state.test_disabled)
         else:
             st.multiselect(label="OpenAI Models", options=["GPT 3.5-turbo"], default="GPT 3.5-turbo", key='model_options', help=help_msg_model_option, disabled=st.session_state.test_disabled)
         
         
 
+        if provider_util.local_models():
+            st.checkbox(label=f"Compare with the local model ({provider_util.LOCAL_MODEL_NAME})", key='use_local_model', value=False, help=help_msg_local_model, disabled=st.session_state.test_disabled)
+
         st.checkbox(label="Show usage and cost estimate", key='show_usage', value=True, help=help_msg_show_usage, disabled=st.session_state.test_disabled)
+        st.checkbox(label="Stream responses", key='stream_responses', value=True, help=help_msg_stream_responses, disabled=st.session_state.test_disabled)
+        st.checkbox(label="Repair objectives that break the rules", key='repair_objectives', value=objective_util.REPAIR_OBJECTIVES, help=help_msg_repair_objectives, disabled=st.session_state.test_disabled)
+        st.number_input(label="Alternatives per model", key='variants', min_value=1, max_value=api.MAX_VARIANTS, value=1, step=1, help=help_msg_variants, disabled=st.session_state.test_disabled)
         st.number_input(label="Response Token Limit", key='model_max_tokens', min_value=0, max_value=1500, value=1000, step=50, help=help_msg_max_token, disabled=st.session_state.test_disabled)
         st.slider(label="Temperature", min_value=0.0, max_value=1.0, step=0.1, value=0.7, key='model_temperature', help=help_msg_model_temperature, disabled=st.session_state.test_disabled)
+        st.checkbox(label="Fresh sample (skip cache)", key='bypass_cache', value=False, help=help_msg_bypass_cache, disabled=st.session_state.test_disabled or st.session_state.model_temperature == 0)
+        if api.calls_saved():
+            st.caption(f"{api.calls_saved()} API calls saved by sharing identical requests across sessions")
         st.slider(label="Top P", min_value=0.0, max_value=1.0, step=0.1, value=1.0, key='model_top_p', help=help_msg_model_top_p, disabled=st.session_state.test_disabled)
         st.slider(label="Frequency penalty", min_value=0.0, max_value=1.0, step=0.1, value=0.0, key='model_frequency_penalty', help=help_msg_model_freq_penalty, disabled=st.session_state.test_disabled)
         st.slider(label="Presence penalty", min_value=0.0, max_value=1.0, step=0.1, value=0.0, key='model_presence_penalty', help=help_msg_model_presence_penalty, disabled=st.session_state.test_disabled)   
@@ -317,28 +426,241 @@ def ui_introduction():
     
 
 def ui_test_result(progress_bar_container):
-
+    """The model columns: usage, history and the response being streamed"""
     progress_bar_container.empty()
 
-    if "openai_models" in st.session_state:
-        columns = st.columns(len(st.session_state.openai_models))
-
-        for index, model_name in enumerate(st.session_state.openai_models):
-            if len(st.session_state.chat_histories[model_name])>0:
-                with columns[index]:
-                    if 'show_usage' in st.session_state and st.session_state.show_usage:
-                        st.write(f'_Usage Statistics: {model_name}_')
-                        st.write(f'Total tokens: {st.session_state.total_tokens[model_name]}')
-                        st.write(f'Prompt tokens: {st.session_state.prompt_tokens[model_name]}')
-                        st.write(f'Completion tokens: {st.session_state.completion_tokens[model_name]}')
-                        st.write(f'Total cost: ${st.session_state.conversation_cost[model_name]}')
-                        st.write("---")
-                    for message in st.session_state.chat_histories[model_name]:
-                        # st.write(st.session_state.chat_histories[model_name])
-                        if message['role'] == 'user': 
-                            st.markdown(f"**User:**  \n{message['message']}")
-                        else:
-                            st.markdown(f"**AI Response:**  \n{message['message']}")
+    if "openai_models" not in st.session_state:
+        return
+
+    columns = st.columns(len(st.session_state.openai_models))
+    pending = st.session_state.get('pending_responses')
+    response_errors = st.session_state.get('response_errors', {})
+    stream_placeholders = {}
+
+    history = st.session_state.history
+
+    for index, model_name in enumerate(st.session_state.openai_models):
+        turns = history.messages(model_name)
+        if len(turns)>0 or pending or model_name in response_errors:
+            with columns[index]:
+                if model_name in response_errors:
+                    st.error(response_errors[model_name])
+                if 'show_usage' in st.session_state and st.session_state.show_usage and len(turns)>0:
+                    st.markdown(_format_usage(model_name, history.usage[model_name], st.session_state.get('phase_timings', {})))
+                    st.write("---")
+                if history.archived[model_name]:
+                    # older turns are only read back from disk when asked for
+                    with st.expander(f"Show {history.archived[model_name]} earlier responses"):
+                        st.markdown(history.archived_markdown(model_name))
+                # one element for the whole history, rendered once per change of it
+                st.markdown(history_util.history_markdown(turns))
+                if len(turns) > 0 and len(history.usage[model_name].variants) > 1:
+                    ui_variant_picker(model_name)
+                if pending:
+                    stream_placeholders[model_name] = st.empty()
+
+    if pending:
+        st.session_state.pending_responses = None
+        _ui_stream_responses(pending, stream_placeholders)
+
+
+def _format_usage(model_name, usage, phase_timings):
+    """Usage statistics of a model's latest response, as one block of markdown"""
+    lines = [
+        f'_Usage Statistics: {model_name}_',
+        f'Total tokens: {usage.total_tokens}',
+        f'Prompt tokens: {usage.prompt_tokens}',
+        f'Completion tokens: {usage.completion_tokens}',
+        f'Total cost: \\${usage.cost}'
+    ]
+    if usage.timings:
+        lines.append(_format_timings(usage.timings, phase_timings))
+    if usage.routed_model:
+        lines.append(f"_Answered by {usage.routed_model}{', after the cheaper model wrote too few objectives' if usage.escalated else ''}_")
+    if len(usage.variants) > 1:
+        lines.append(f'_{len(usage.variants)} alternatives from one request_')
+    if usage.repaired:
+        lines.append(f'_{usage.repaired} objective(s) repaired with a short follow-up request_')
+    if usage.shared:
+        lines.append('_Shared with an identical request from another session, no tokens billed_')
+    elif usage.cached:
+        lines.append('_Served from cache, no tokens billed_')
+    return "  \n".join(lines)
+
+
+def ui_variant_picker(model_name):
+    """Lets the user pick which alternative of the latest response the conversation goes on with"""
+    history = st.session_state.history
+    usage = history.usage[model_name]
+    # a new key for every response, so a new set of alternatives starts on the first one
+    key = f"variant_{model_name}_{history.archived[model_name] + len(history.turns[model_name])}"
+    st.radio(
+        label="Alternatives", options=range(len(usage.variants)), index=usage.selected, key=key, horizontal=True,
+        format_func=lambda index: f"Set {index + 1}", on_change=handler_select_variant, args=(model_name, key)
+    )
+
+
+def handler_select_variant(model_name, key):
+    st.session_state.history.select_variant(model_name, st.session_state[key])
+
+
+def _ui_stream_responses(pending, stream_placeholders):
+    """Streams the pending model responses into their result columns, then reruns to show the final usage"""
+    o = _open_ai()
+    streamed_text = {model_name: '' for model_name in stream_placeholders}
+    st.session_state.response_errors = {}
+
+    if pending['map_reduce_request'] is None:
+        events = o.stream_ai_responses(
+            model_config_dicts=pending['model_config_dicts'],
+            init_prompt_msg=pending['init_prompt_msg'],
+            messages_by_model=st.session_state.history.messages_by_model(),
+            use_cache=pending['use_cache'],
+            routes=_routes(o, pending['lo_request'], pending['use_cache'], stream=True)
+        )
+    else:
+        events = _stream_map_reduce_responses(o, pending['model_config_dicts'], pending['map_reduce_request'], pending['use_cache'])
+
+    moderation = pending['moderation']
+
+    for event in events:
+        m = event['model']
+
+        # output stays hidden until the prompt has passed moderation
+        if moderation is not None and (moderation.done() or 'done' in event):
+            if not _moderation_passed(moderation):
+                for placeholder in stream_placeholders.values():
+                    placeholder.empty()
+                return
+            moderation = None
+            for model_name, text in streamed_text.items():
+                if text:
+                    stream_placeholders[model_name].markdown(f"**AI Response:**  \n{text}▌")
+
+        if 'progress' in event:
+            if event.get('restart'):
+                # the router asks a stronger model, whose answer replaces the text so far
+                streamed_text[m] = ''
+            stream_placeholders[m].progress(event['progress'], text=event['status'])
+        elif 'delta' in event:
+            streamed_text[m] += event['delta']
+            if moderation is None:
+                stream_placeholders[m].markdown(f"**AI Response:**  \n{streamed_text[m]}▌")
+        elif 'done' in event:
+            model_config_dict = next(cfg for cfg in pending['model_config_dicts'] if cfg['model'] == m)
+            _update_usage(m, _repair_objectives(o, model_config_dict, pending['lo_request'], event, pending['use_cache']))
+        else:
+            logging.error(f"{m}: {event['error']}")
+            st.session_state.response_errors[m] = _format_error(m, event['error'])
+
+    if moderation is not None and not _moderation_passed(moderation):
+        return
+
+    st.experimental_rerun()
+
+
+def ui_bulk_generation(options):
+    st.markdown(helper_bulk_generation)
+    bulk_file = st.file_uploader("Upload modules", type=['csv', 'jsonl'], key='bulk_file')
+    if bulk_file is None:
+        return
+
+    if st.button("Run bulk generation"):
+        verified = handler_verify_gpt4_key() if st.session_state.custom_question_level else handler_verify_key()
+        if verified:
+            model_config_dicts = [{
+                'model': m,
+                'max_tokens': st.session_state.model_max_tokens,
+                'temperature': st.session_state.model_temperature,
+                'top_p': st.session_state.model_top_p,
+                'frequency_penalty': st.session_state.model_frequency_penalty,
+                'presence_penalty': st.session_state.model_presence_penalty
+            } for m in st.session_state.openai_models]
+
+            # the same file with the same settings always writes to the same output, so reruns resume
+            file_digest = hashlib.sha256(bulk_file.getvalue()).hexdigest()
+            output_path = os.path.join(tempfile.gettempdir(), f"lo-builder-bulk-{cache_util.make_key(file_digest, options, model_config_dicts)}.jsonl")
+            fmt = 'jsonl' if bulk_file.name.endswith('.jsonl') else 'csv'
+            modules = list(batch.parse_modules(io.StringIO(bulk_file.getvalue().decode('utf-8')), fmt))
+
+            progress = st.progress(0.0, text=f"Generating learning objectives for {len(modules)} modules")
+            def on_progress(done, total):
+                progress.progress(done / total, text=f"{done}/{total} done")
+
+            o = _open_ai()
+            st.session_state.bulk_stats = batch.run_batch(o, modules, model_config_dicts, output_path, options, on_progress=on_progress)
+            st.session_state.bulk_output_path = output_path
+            progress.empty()
+
+    if st.session_state.get('bulk_output_path') and os.path.exists(st.session_state.bulk_output_path):
+        st.text(batch.format_stats(st.session_state.bulk_stats))
+        with open(st.session_state.bulk_output_path, 'rb') as f:
+            st.download_button("Download results (JSONL)", data=f.read(), file_name="learning_objectives.jsonl", mime="application/jsonl")
+
+
+def ui_content_upload():
+    """File upload for the learning content. The extracted text stays on disk, the session only keeps
+    where it is, and the same upload isn't read again on reruns. Returns None when no file is uploaded"""
+    content_file = st.file_uploader("Or upload your learning content", type=list(ingest_util.FORMATS), key='content_file', help=help_msg_content_file)
+    if content_file is None:
+        st.session_state.content_document = None
+        return None
+
+    upload_key = (content_file.id, content_file.name, content_file.size)
+    uploaded = st.session_state.get('content_document')
+    # the text is read again when it was evicted from the ingest folder since
+    if uploaded is None or uploaded[0] != upload_key or not os.path.exists(uploaded[1].text_path):
+        progress = st.progress(0.0, text=f"Reading {content_file.name}")
+        def on_page(pages):
+            progress.progress(0.0, text=f"Reading {content_file.name}: {pages} pages")
+        try:
+            content_file.seek(0)
+            document = ingest_util.ingest(content_file.name, content_file, on_page=on_page)
+        except Exception as e:
+            logging.error(f"{content_file.name}: {e}")
+            st.error(f"Couldn't read {content_file.name}: {e}")
+            st.session_state.content_document = None
+            return None
+        finally:
+            progress.empty()
+        uploaded = st.session_state.content_document = (upload_key, document)
+
+    document = uploaded[1]
+    source = "read before, not extracted again" if document.cached else "extracted"
+    st.caption(f"Learning content from {document.name}: {document.pages} pages, {len(ingest_util.load_text(document.text_path)):,} characters ({source})")
+    return document
+
+
+def ui_prompt_estimate(lo_prompt):
+    """Shows the prompt tokens and maximum cost of the next request per model, before it is sent"""
+    estimates = []
+    for m in st.session_state.get('openai_models', ['gpt-3.5-turbo']):
+        model_config_dict = {'model': m, 'max_tokens': st.session_state.get('model_max_tokens', 1000)}
+        try:
+            budget = api.fit_to_context(model_config_dict, lo_prompt, st.session_state.history.messages(m) if 'history' in st.session_state else [])
+        except api.open_ai.BadRequest as e:
+            st.warning(f"{e}")
+            continue
+        # the prompt is paid once however many alternatives are asked for
+        max_cost = api.estimate_cost(m, budget['prompt_tokens'], budget['max_tokens'] * st.session_state.get('variants', 1))
+        estimate = f"{m}: ~{budget['prompt_tokens']} prompt tokens, up to ${max_cost:.4f}"
+        if budget['dropped_messages'] > 0:
+            estimate += f" ({budget['dropped_messages']} oldest messages left out to fit the context window)"
+        estimates.append(estimate)
+    if estimates:
+        st.caption("Estimated request: " + " | ".join(estimates))
+
+
+def ui_alignment_check(learning_content, learning_objectives):
+    """Shows the quick local alignment check of the objectives, it takes milliseconds and needs no key"""
+    report = alignment_util.check_alignment(learning_content, learning_objectives)
+    if not report['objectives']:
+        return
+    with st.expander("Quick alignment check", expanded=True):
+        st.markdown(alignment_util.format_report(report))
+        st.checkbox("Skip the AI review when every objective clearly passes or fails", key="alignment_fast_path", value=alignment_util.FAST_PATH)
+        if report['conclusive'] and st.session_state.get('alignment_skipped'):
+            st.success("Every objective was clearly decided by the quick check, so no AI review was requested.")
 
 
 def _ui_link(url, label, font_awesome_icon):
@@ -371,28 +693,17 @@ st.write("---")
 
 # User input sections
 module_title = st.text_input("Enter the title for your course or module (optional)", max_chars=200, key="module_title")
-learning_content = st.text_area("Enter your learning content", key="learning_content")
+content_document = ui_content_upload()
+if content_document is None:
+    learning_content = st.text_area("Enter your learning content", key="learning_content")
+else:
+    learning_content = ingest_util.load_text(content_document.text_path)
 learning_objectives = st.text_area("Enter your learning objectives (optional)", key="learning_objectives")
 
-request_index = 0
-if learning_content and learning_objectives:
-    request_index = 2
-elif learning_content and module_title and not learning_objectives:
-    request_index = 0
-elif learning_content and not learning_objectives:
-    request_index = 0
-elif module_title and not learning_objectives:
-    request_index = 1
-elif module_title and learning_objectives:
-    request_index = 1
-elif learning_content and learning_objectives:
-    request_index = 2
-
-
 request = st.radio(
     "What would you like to do?",
-    ["Provide learning objectives based on the content","Suggest learning objectives based on the title","Validate alignment between learning content and objectives"],
-    index=request_index)
+    prompt.REQUEST_OPTIONS,
+    index=prompt.REQUEST_OPTIONS.index(prompt.suggest_request(module_title, learning_content, learning_objectives)))
 
 lo_quantity = st.slider("How many Learning Objectives would you like to generate?",min_value=1, max_value=8,value=4,)
 
@@ -418,66 +729,40 @@ with col3:
     "Create": st.checkbox("Create",key="blooms_create",value="true")
     })
 
-cognition_checkboxes_count = sum(value == True for value in cognition_checkboxes.values())
-
 cognition_goals = [label for label, checked in cognition_checkboxes.items() if checked]
 
-cognition_goals_string = ""
-for label in cognition_goals:
-    cognition_goals_string += label + "; "
-
+lo_request = {
+    'request': request,
+    'lo_quantity': lo_quantity,
+    'cognition_goals': cognition_goals,
+    'learning_preferences': learning_preferences,
+    'relevance': relevance,
+    'module_title': module_title,
+    'learning_content': learning_content,
+    'learning_objectives': learning_objectives
+}
+lo_prompt = prompt.build_lo_prompt(**lo_request)
 
+if request == prompt.REQUEST_VALIDATE and learning_content and learning_objectives:
+    ui_alignment_check(learning_content, learning_objectives)
 
-lo_prompt = ""
-if request == "Validate alignment between learning content and objectives":
-    lo_prompt = (
-        "Please validate the alignment between the provided learning content and the learning objectives provided.\n"
-        + "Be extremely strict and make sure that A) specific content exists that can be assessed to meet the learning objective and B) the learning objective is reasonable for an online course.")
-    if learning_objectives:
-        lo_prompt += (
-        "Here are my learning objectives: \n"
-        + learning_objectives + "\n"
-        )
-    if learning_content:
-        lo_prompt += (
-        "Here is the content: \n"
-        + "===============\n"
-        + learning_content + "\n"
-        )
+# content too long for one request is read in sections in parallel, and the results merged
+use_map_reduce = chunk_util.needs_chunking(learning_content)
 
+if use_map_reduce:
+    sections = chunk_util.split_content(learning_content)
+    st.info(f"Your content is long, so it will be read in {len(sections)} sections at once and the results merged into one answer. The prompt can't be edited in this mode.")
 else:
-    if request == "Suggest learning objectives based on the title":
-        lo_prompt = "Please suggest " + str(lo_quantity) + " learning objectives for the provided course. \n"    
-    else:
-        lo_prompt = "Please write " + str(lo_quantity) + " learning objectives based on the provided content. \n"
-    
-    lo_prompt += "Provide learning objectives that are specific, measurable, easy to understand, and suitable for an online course. \n"
-    if cognition_checkboxes_count > 0 and cognition_checkboxes_count < 6:
-        lo_prompt += "Focus specifically on these cognitive goals: " + cognition_goals_string + "\n"
-    lo_prompt += "Start each learning objective with a verb from Bloom's taxonomy. Avoid verbs like \"understand\", \"learn\", or \"know\".\n"
-    if learning_preferences:
-        lo_prompt += "Try to engage a variety of learning modalities (e.g. Visual, Auditory, Kinesthetic) \n"
-    if relevance:
-        lo_prompt += "Try to provide learning objectives that are relevant in the real world. \n"
-    if module_title:
-        lo_prompt += "Here is the title of the course: " + module_title + "\n"
-    if learning_content:
-        lo_prompt += (
-        "Here is the content: \n"
-        + "===============\n"
-        + learning_content
-        )
+    with st.expander("View/edit full prompt"):
+        lo_prompt = st.text_area(
+                label="Prompt",
+                height=100,
+                value=lo_prompt,
+                key="init_prompt",
+                disabled=st.session_state.test_disabled
+            )
 
-
-with st.expander("View/edit full prompt"):
-    lo_prompt = st.text_area(
-            label="Prompt",
-            height=100,
-            max_chars=2000,
-            value=lo_prompt,
-            key="init_prompt",
-            disabled=st.session_state.test_disabled
-        )
+    ui_prompt_estimate(lo_prompt)
 
 
 progress_bar_container = st.empty()
@@ -495,4 +780,13 @@ st.write("##### AI Response:")
 progress_bar_container = st.empty()
 ui_test_result(progress_bar_container)
 
+with st.expander("Bulk generation"):
+    ui_bulk_generation({
+        'lo_quantity': lo_quantity,
+        'cognition_goals': cognition_goals,
+        'learning_preferences': learning_preferences,
+        'relevance': relevance,
+        'repair': st.session_state.get('repair_objectives', objective_util.REPAIR_OBJECTIVES)
+    })
+
 
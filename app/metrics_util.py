@@ -0,0 +1,131 @@
+import bisect
+import collections
+import contextlib
+import http.server
+import json
+import os
+import threading
+import time
+
+# time spent in each phase of a request, e.g. moderation or time to first token
+PHASE_METRIC = 'lo_builder_phase_seconds'
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+# (metric, labels) -> [count per bucket..., count above the last bucket], sum
+_histograms = {}
+_counters = collections.Counter()
+
+# every span and count is also appended to this JSONL file when set
+_log_path = os.getenv('LO_BUILDER_METRICS_LOG')
+_log_file = None
+_log_lock = threading.Lock()
+
+_http_server = None
+_http_server_lock = threading.Lock()
+
+
+def _labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe(phase, seconds, **labels):
+    """Records how long a phase took"""
+    key = (PHASE_METRIC, _labels_key({'phase': phase, **labels}))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+    _log({'type': 'span', 'phase': phase, 'seconds': round(seconds, 4), **labels})
+
+
+def inc(metric, amount=1, **labels):
+    """Increments a counter, e.g. of requests by outcome"""
+    with _lock:
+        _counters[(metric, _labels_key(labels))] += amount
+    _log({'type': 'count', 'metric': metric, 'amount': amount, **labels})
+
+
+@contextlib.contextmanager
+def span(phase, **labels):
+    """Times the enclosed block as a phase. Yields a dict that holds the duration in 'seconds' afterwards"""
+    timing = {}
+    started = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing['seconds'] = time.perf_counter() - started
+        observe(phase, timing['seconds'], **labels)
+
+
+def _log(record):
+    global _log_file
+    if not _log_path:
+        return
+    line = json.dumps({'time': time.time(), **record}, default=str) + '\n'
+    with _log_lock:
+        if _log_file is None:
+            _log_file = open(_log_path, 'a', buffering=1, encoding='utf-8')
+        _log_file.write(line)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format"""
+    with _lock:
+        histograms = sorted((key, (list(buckets), total)) for key, (buckets, total) in _histograms.items())
+        counters = sorted(_counters.items())
+
+    lines = []
+    typed = set()
+    for (metric, labels), (buckets, total) in histograms:
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} histogram")
+            typed.add(metric)
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), buckets):
+            cumulative += count
+            lines.append(f"{metric}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {cumulative}")
+    for (metric, labels), value in counters:
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port):
+    """Serves /metrics on a background thread, once per process however often it is called"""
+    global _http_server
+    with _http_server_lock:
+        if _http_server is None:
+            _http_server = http.server.ThreadingHTTPServer(('', port), _MetricsHandler)
+            threading.Thread(target=_http_server.serve_forever, name='metrics', daemon=True).start()
+    return _http_server
@@ -0,0 +1,188 @@
+"""Local stand-in for the OpenAI API, for development and benchmarks without a key or network.
+
+    python mock_server.py --port 8099 --latency 0.5 --error-rate 0.05 --rpm 600
+    OPENAI_API_BASE=http://localhost:8099/v1 OPENAI_API_KEY=sk-mock streamlit run lo-builder.py
+
+Serves /v1/models, /v1/moderations, /v1/chat/completions and /v1/completions, including streamed
+completions. Responses wait for a configurable latency, requests beyond the per-key requests per
+minute are answered with 429 and a retry-after-ms header, and a share of requests fail with 500.
+Moderation flags inputs that contain any of the flagged words.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import threading
+import time
+
+from aiohttp import web
+
+DEFAULT_RESPONSE = (
+    "1. Describe the stages of the cell cycle and the events that occur in each stage.\n"
+    "2. Compare mitosis and meiosis in terms of their purpose and outcomes.\n"
+    "3. Explain how checkpoints regulate cell division.\n"
+    "4. Analyze how uncontrolled cell division can lead to cancer."
+)
+MODELS = ('gpt-3.5-turbo', 'gpt-4')
+
+
+class MockOpenAI:
+    """Settings and request counters of a mock server"""
+
+    def __init__(self, latency=0.0, jitter=0.0, token_latency=0.0, rpm=None, error_rate=0.0, flagged_words=('flagme',), response=DEFAULT_RESPONSE, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_latency = token_latency
+        self.rpm = rpm
+        self.error_rate = error_rate
+        self.flagged_words = flagged_words
+        self.response = response
+        self.stats = collections.Counter()
+        self._random = random.Random(seed)
+        self._requests_by_key = collections.defaultdict(collections.deque)
+
+
+    def create_app(self):
+        app = web.Application()
+        app.add_routes([
+            web.get('/v1/models', self.handle_models),
+            web.post('/v1/moderations', self.handle_moderations),
+            web.post('/v1/chat/completions', self.handle_completions),
+            web.post('/v1/completions', self.handle_completions)
+        ])
+        return app
+
+
+    async def handle_models(self, request):
+        self.stats['models'] += 1
+        return web.json_response({'object': 'list', 'data': [{'id': model, 'object': 'model'} for model in MODELS]})
+
+
+    async def handle_moderations(self, request):
+        body = await request.json()
+        error = await self._delay_or_error(request)
+        if error is not None:
+            return error
+        self.stats['moderations'] += 1
+        flagged = any(word in body['input'] for word in self.flagged_words)
+        return web.json_response({'results': [{'flagged': flagged, 'categories': {'hate': flagged}}]})
+
+
+    async def handle_completions(self, request):
+        body = await request.json()
+        error = await self._delay_or_error(request)
+        if error is not None:
+            return error
+        self.stats['completions'] += 1
+
+        chat = 'messages' in body
+        n = body.get('n', 1)
+        words = self.response.split(' ')[:body.get('max_tokens') or None]
+        prompt = ' '.join(message['content'] for message in body['messages']) if chat else body['prompt']
+        prompt_tokens = len(prompt) // 4 + 1
+
+        if not body.get('stream'):
+            text = ' '.join(words)
+            choices = [
+                {'index': i, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'} if chat else {'index': i, 'text': text, 'finish_reason': 'stop'}
+                for i in range(n)
+            ]
+            return web.json_response({
+                'object': 'chat.completion' if chat else 'text_completion',
+                'model': body['model'],
+                'choices': choices,
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words) * n, 'total_tokens': prompt_tokens + len(words) * n}
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for index, word in enumerate(words):
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            piece = word if index == 0 else ' ' + word
+            for i in range(n):
+                choice = {'index': i, 'delta': {'content': piece}} if chat else {'index': i, 'text': piece}
+                await response.write(('data: ' + json.dumps({'model': body['model'], 'choices': [choice]}) + '\n\n').encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+
+    async def _delay_or_error(self, request):
+        """Waits for the configured latency, or returns the injected error response"""
+        key = request.headers.get('Authorization', '')
+        now = time.monotonic()
+        if self.rpm:
+            recent = self._requests_by_key[key]
+            while recent and now - recent[0] > 60:
+                recent.popleft()
+            if len(recent) >= self.rpm:
+                self.stats['rate_limited'] += 1
+                retry_after = 60 - (now - recent[0])
+                return self._error(429, 'Rate limit reached for requests', 'requests', {'retry-after-ms': str(int(retry_after * 1000))})
+            recent.append(now)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return self._error(500, 'The server had an error while processing your request.', 'server_error')
+
+        latency = self.latency + self._random.uniform(0, self.jitter)
+        if latency:
+            await asyncio.sleep(latency)
+        return None
+
+
+    def _error(self, status, message, error_type, headers=None):
+        return web.json_response({'error': {'message': message, 'type': error_type, 'param': None, 'code': None}}, status=status, headers=headers)
+
+
+def start_in_thread(mock, host='127.0.0.1', port=0):
+    """Runs the mock server on a background thread, returning its API base URL"""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    base_url = []
+
+    async def start():
+        runner = web.AppRunner(mock.create_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        base_url.append(f"http://{host}:{runner.addresses[0][1]}/v1")
+        started.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    threading.Thread(target=run, name='mock_openai', daemon=True).start()
+    started.wait()
+    return base_url[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenAI API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds before each response starts")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra latency of up to this many seconds")
+    parser.add_argument('--token-latency', type=float, default=0.02, help="seconds between streamed words")
+    parser.add_argument('--rpm', type=int, default=None, help="requests per minute per key before answering 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 500 error")
+    parser.add_argument('--flagged-word', action='append', help="moderation flags inputs containing this word, can be repeated (default flagme)")
+    args = parser.parse_args()
+
+    mock = MockOpenAI(
+        latency=args.latency,
+        jitter=args.jitter,
+        token_latency=args.token_latency,
+        rpm=args.rpm,
+        error_rate=args.error_rate,
+        flagged_words=tuple(args.flagged_word or ['flagme'])
+    )
+    web.run_app(mock.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import os
+import re
+
+import alignment_util
+import prompt_util as prompt
+
+# whether generated objectives that fail validation are repaired with a follow-up request
+REPAIR_OBJECTIVES = os.getenv('LO_BUILDER_REPAIR_OBJECTIVES', '0') == '1'
+# response budget per objective of a repair request, they are one line each
+REPAIR_TOKENS_PER_OBJECTIVE = 80
+
+_LIST_ITEM = re.compile(r"^\s*(?:[-*•]|\(?[0-9]+[.):]|\(?[a-zA-Z][.)])\s+")
+_MARKDOWN = re.compile(r"[*_`]+")
+
+
+def parse_objectives(message):
+    """Structured objectives of a model reply: {'text', 'verb', 'level'} for each item of its numbered
+    or bulleted list. Introductions and closing remarks around the list are left out, as are indented
+    sub-items, and a reply without any list is read one objective per line"""
+    lines = [line.expandtabs(4) for line in message.splitlines() if line.strip()]
+    items = [line for line in lines if _LIST_ITEM.match(line)]
+    if items:
+        top_level = min(len(item) - len(item.lstrip()) for item in items)
+        items = [item for item in items if len(item) - len(item.lstrip()) == top_level]
+    else:
+        items = lines
+    objectives = []
+    for item in items:
+        text = alignment_util.clean_objective(_MARKDOWN.sub('', item))
+        if text:
+            text = text[0].upper() + text[1:]
+            verb, level = alignment_util.classify_verb(text)
+            objectives.append({'text': text, 'verb': verb, 'level': level})
+    return objectives
+
+
+def validate(objectives, lo_quantity, cognition_goals):
+    """Problems of each objective, in order, as a list of reasons (empty when it is fine). Objectives
+    beyond lo_quantity are not checked, they are dropped"""
+    # the levels are only checked when the user picked some of them, like the prompt does
+    focus = set(cognition_goals) if 0 < len(cognition_goals) < len(prompt.COGNITION_GOALS) else None
+    seen = set()
+    problems = []
+    for objective in objectives[:lo_quantity]:
+        reasons = []
+        if objective['verb'] in alignment_util.VAGUE_VERBS:
+            reasons.append(f"\"{objective['verb']}\" can't be observed or measured")
+        elif objective['level'] is None:
+            reasons.append("it doesn't start with a verb from Bloom's taxonomy")
+        elif focus is not None and objective['level'] not in focus:
+            reasons.append(f"its verb is on the {objective['level']} level, not one of {', '.join(sorted(focus))}")
+        key = objective['text'].lower().rstrip('.')
+        if key in seen:
+            reasons.append("it repeats another objective")
+        seen.add(key)
+        problems.append(reasons)
+    return problems
+
+
+def build_repair_prompt(lo_request, objectives, problems, missing):
+    """Small follow-up prompt asking for replacements of the failing objectives only, and for the
+    missing ones when there were too few"""
+    focus = [goal for goal in lo_request['cognition_goals'] if goal in prompt.COGNITION_GOALS]
+    verbs = ', '.join(verb for goal in (focus or prompt.COGNITION_GOALS) for verb in alignment_util.BLOOM_VERBS[goal][:5])
+    kept = [objective['text'] for objective, reasons in zip(objectives, problems) if not reasons]
+    failing = [(objective['text'], reasons) for objective, reasons in zip(objectives, problems) if reasons]
+
+    lines = []
+    if lo_request['module_title']:
+        lines.append(f"These are learning objectives for the course \"{lo_request['module_title']}\".")
+    if kept:
+        lines.append("These objectives are fine and stay as they are:")
+        lines.extend(f"- {text}" for text in kept)
+    if failing:
+        lines.append("Rewrite each of these objectives so it keeps its topic but fixes the problem:")
+        lines.extend(f"- {text} (problem: {'; '.join(reasons)})" for text, reasons in failing)
+    if missing:
+        lines.append(f"Also write {missing} new learning objective{'s' if missing > 1 else ''} on other topics of the course.")
+    lines.append(f"Start every objective with one of these verbs: {verbs}.")
+    lines.append(f"Answer with exactly {len(failing) + missing} numbered lines, one objective per line, and nothing else.")
+    return "\n".join(lines) + "\n"
+
+
+def format_objectives(objectives):
+    return "\n".join(f"{number}. {objective['text']}" for number, objective in enumerate(objectives, start=1))
+
+
+def repair_response(o, model_config_dict, lo_request, b_r, use_cache=True):
+    """Validates a generated response and repairs only what fails: extra objectives are dropped, and
+    objectives with a problem are rewritten, and missing ones written, by one short follow-up request.
+    Returns the response with the repaired message, 'objectives', the number of objectives 'repaired',
+    and the token usage of both requests. Responses that pass are returned as they were"""
+    if lo_request['request'] == prompt.REQUEST_VALIDATE:
+        return b_r
+    message = b_r['messages'][-1]['message']
+    objectives = parse_objectives(message)
+    problems = validate(objectives, lo_request['lo_quantity'], lo_request['cognition_goals'])
+    objectives = objectives[:lo_request['lo_quantity']]
+    missing = lo_request['lo_quantity'] - len(objectives)
+    failing = sum(1 for reasons in problems if reasons)
+    if not failing and not missing:
+        if len(objectives) == len(parse_objectives(message)):
+            return {**b_r, 'objectives': objectives, 'repaired': 0}
+        return _with_message(b_r, format_objectives(objectives), objectives, 0)
+
+    repair_config_dict = {**model_config_dict, 'max_tokens': REPAIR_TOKENS_PER_OBJECTIVE * (failing + missing), 'n': 1}
+    repair_prompt = build_repair_prompt(lo_request, objectives, problems, missing)
+    try:
+        repair = o.get_ai_response(repair_config_dict, repair_prompt, [], use_cache)
+    except Exception:
+        # the unrepaired response is still better than none
+        return {**b_r, 'objectives': objectives, 'repaired': 0}
+
+    replacements = parse_objectives(repair['messages'][-1]['message'])
+    repaired = []
+    for objective, reasons in zip(objectives, problems):
+        if reasons and replacements:
+            objective = replacements.pop(0)
+        repaired.append(objective)
+    repaired.extend(replacements[:missing])
+
+    b_r = _with_message(b_r, format_objectives(repaired), repaired, failing + min(missing, len(replacements)))
+    return _add_repair_usage(b_r, repair)
+
+
+def repair_stream(o, model_config_dict, lo_request, events, use_cache=True):
+    """Passes response events through, with the final 'done' event repaired like repair_response"""
+    for event in events:
+        if 'done' in event:
+            event = repair_response(o, model_config_dict, lo_request, event, use_cache)
+        yield event
+
+
+def _with_message(b_r, message, objectives, repaired):
+    messages = b_r['messages'][:-1] + [{**b_r['messages'][-1], 'message': message}]
+    b_r = {**b_r, 'messages': messages, 'objectives': objectives, 'repaired': repaired}
+    if 'variants' in b_r:
+        # only the first of several alternatives is repaired
+        b_r['variants'] = [message] + b_r['variants'][1:]
+    return b_r
+
+
+def _add_repair_usage(b_r, repair):
+    """Token usage of a response and its repair. Tokens of a cached part were not billed, so a
+    cached response only counts the tokens of its repair"""
+    if repair['cached']:
+        return b_r
+    if b_r['cached']:
+        return {**b_r, 'total_tokens': repair['total_tokens'], 'prompt_tokens': repair['prompt_tokens'], 'completion_tokens': repair['completion_tokens'], 'cached': False}
+    return {
+        **b_r,
+        'total_tokens': b_r['total_tokens'] + repair['total_tokens'],
+        'prompt_tokens': b_r['prompt_tokens'] + repair['prompt_tokens'],
+        'completion_tokens': b_r['completion_tokens'] + repair['completion_tokens']
+    }
@@ -0,0 +1,125 @@
+import functools
+import string
+
+REQUEST_CONTENT = "Provide learning objectives based on the content"
+REQUEST_TITLE = "Suggest learning objectives based on the title"
+REQUEST_VALIDATE = "Validate alignment between learning content and objectives"
+REQUEST_OPTIONS = [REQUEST_CONTENT, REQUEST_TITLE, REQUEST_VALIDATE]
+
+COGNITION_GOALS = ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]
+
+
+def suggest_request(module_title, learning_content, learning_objectives):
+    """Picks the most likely request for the fields that were filled in"""
+    request = REQUEST_CONTENT
+    if learning_content and learning_objectives:
+        request = REQUEST_VALIDATE
+    elif learning_content and module_title and not learning_objectives:
+        request = REQUEST_CONTENT
+    elif learning_content and not learning_objectives:
+        request = REQUEST_CONTENT
+    elif module_title and not learning_objectives:
+        request = REQUEST_TITLE
+    elif module_title and learning_objectives:
+        request = REQUEST_TITLE
+    return request
+
+
+def _compile(fragment):
+    """Splits a str.format fragment once into (literal text, field name or None) pieces"""
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(fragment))
+
+
+def _compile_template(parts):
+    return tuple((condition, _compile(fragment)) for condition, fragment in parts)
+
+
+# each template is a sequence of (condition, fragment): a fragment is only included when the value
+# named by its condition is truthy (None: always), and its {fields} are filled with the request values
+_OBJECTIVES_PARTS = (
+    (None, "Provide learning objectives that are specific, measurable, easy to understand, and suitable for an online course. \n"),
+    ('focus_cognition_goals', "Focus specifically on these cognitive goals: {cognition_goals}\n"),
+    (None, "Start each learning objective with a verb from Bloom's taxonomy. Avoid verbs like \"understand\", \"learn\", or \"know\".\n"),
+    ('learning_preferences', "Try to engage a variety of learning modalities (e.g. Visual, Auditory, Kinesthetic) \n"),
+    ('relevance', "Try to provide learning objectives that are relevant in the real world. \n"),
+    ('module_title', "Here is the title of the course: {module_title}\n"),
+    ('learning_content', "Here is the content: \n===============\n{learning_content}"),
+)
+
+TEMPLATES = {
+    REQUEST_CONTENT: _compile_template((
+        (None, "Please write {lo_quantity} learning objectives based on the provided content. \n"),
+    ) + _OBJECTIVES_PARTS),
+    REQUEST_TITLE: _compile_template((
+        (None, "Please suggest {lo_quantity} learning objectives for the provided course. \n"),
+    ) + _OBJECTIVES_PARTS),
+    REQUEST_VALIDATE: _compile_template((
+        (None, "Please validate the alignment between the provided learning content and the learning objectives provided.\n"
+            "Be extremely strict and make sure that A) specific content exists that can be assessed to meet the learning objective and B) the learning objective is reasonable for an online course."),
+        ('learning_objectives', "Here are my learning objectives: \n{learning_objectives}\n"),
+        ('learning_content', "Here is the content: \n===============\n{learning_content}\n"),
+    )),
+}
+
+
+def render_template(template, values):
+    """Assembles a compiled template for the given values"""
+    parts = []
+    for condition, pieces in template:
+        if condition is None or values[condition]:
+            for literal, field in pieces:
+                parts.append(literal)
+                if field is not None:
+                    parts.append(values[field])
+    return ''.join(parts)
+
+
+def build_lo_prompt(request, lo_quantity, cognition_goals, learning_preferences, relevance, module_title, learning_content, learning_objectives):
+    """Builds the prompt sent to the models for a learning objectives request. Every entry point
+    uses this, and identical requests (e.g. Streamlit reruns) are answered from a memo"""
+    return _build_lo_prompt(request, lo_quantity, tuple(cognition_goals), learning_preferences, relevance, module_title, learning_content, learning_objectives)
+
+
+@functools.lru_cache(maxsize=64)
+def _build_lo_prompt(request, lo_quantity, cognition_goals, learning_preferences, relevance, module_title, learning_content, learning_objectives):
+    values = {
+        'lo_quantity': str(lo_quantity),
+        'cognition_goals': ''.join(label + "; " for label in cognition_goals),
+        'focus_cognition_goals': 0 < len(cognition_goals) < len(COGNITION_GOALS),
+        'learning_preferences': learning_preferences,
+        'relevance': relevance,
+        'module_title': module_title,
+        'learning_content': learning_content,
+        'learning_objectives': learning_objectives
+    }
+    return render_template(TEMPLATES.get(request, TEMPLATES[REQUEST_CONTENT]), values)
+
+
+def build_section_prompt(lo_request, section, index, total):
+    """Prompt for one section of content too long to send at once (the map step of a chunked request)"""
+    if lo_request['request'] == REQUEST_VALIDATE:
+        return (
+            "Here are my learning objectives: \n"
+            + lo_request['learning_objectives'] + "\n"
+            + "Below is section " + str(index + 1) + " of " + str(total) + " of the learning content. "
+            + "For each learning objective, briefly quote the specific passages of this section that could be assessed to meet it, or answer \"none\".\n"
+            + "Here is the content: \n"
+            + "===============\n"
+            + section + "\n"
+        )
+    return build_lo_prompt(**{**lo_request, 'request': REQUEST_CONTENT, 'learning_content': section})
+
+
+def build_merge_prompt(lo_request, section_results):
+    """Prompt combining the answers for every section into the final answer (the reduce step of a chunked request)"""
+    if lo_request['request'] == REQUEST_VALIDATE:
+        lo_prompt = build_lo_prompt(**{**lo_request, 'learning_content': ''})
+        lo_prompt += "The content is too long to include, so it was read in " + str(len(section_results)) + " sections. Here is the supporting content found in each section for every learning objective: \n"
+    else:
+        lo_prompt = build_lo_prompt(**{**lo_request, 'request': REQUEST_CONTENT, 'learning_content': ''})
+        lo_prompt += "The content is too long to include, so learning objectives were drafted separately for each of its " + str(len(section_results)) + " sections. Merge these drafts and remove duplicates, keeping the " + str(lo_request['lo_quantity']) + " learning objectives that best cover the content as a whole. \n"
+
+    return lo_prompt + ''.join(
+        "Section " + str(index + 1) + ": \n" + "===============\n" + section_result + "\n"
+        for index, section_result in enumerate(section_results)
+    )
@@ -0,0 +1,102 @@
+import os
+import threading
+
+try:
+    import llama_cpp
+except ImportError:
+    llama_cpp = None
+
+# a quantized GGUF model run on the CPU next to the OpenAI models, e.g. a 4-bit 3B instruct model
+LOCAL_MODEL_PATH = os.getenv('LO_BUILDER_LOCAL_MODEL')
+LOCAL_MODEL_NAME = os.getenv('LO_BUILDER_LOCAL_MODEL_NAME', 'local')
+LOCAL_CONTEXT_SIZE = int(os.getenv('LO_BUILDER_LOCAL_CONTEXT', '4096'))
+LOCAL_THREADS = int(os.getenv('LO_BUILDER_LOCAL_THREADS', '0')) or None
+
+_local_provider = None
+_local_provider_lock = threading.Lock()
+
+
+class Provider:
+    """A model backend. complete() takes the messages of a request as {'role', 'message'} dicts and
+    answers in the shape of the OpenAI API: {'choices': [{'message': {'content'}} or {'text'}], 'usage'},
+    or with stream=True an iterator of chunks with choices[0]['delta'] or choices[0]['text']"""
+
+    # whether requests wait for a slot of the request scheduler, backends with limits of their own don't
+    scheduled = True
+
+
+    def models(self):
+        """Ids of the models this backend serves"""
+        raise NotImplementedError
+
+
+    def complete(self, model_config_dict, messages, stream=False, timings=None):
+        raise NotImplementedError
+
+
+class LocalProvider(Provider):
+    """A small quantized model run in-process on the CPU with llama.cpp. No network, rate limits or
+    per-token cost. The model is loaded once per process and shared by all sessions; it runs one request
+    at a time, so requests wait on its lock instead of the request scheduler"""
+
+    scheduled = False
+
+    def __init__(self, model_path, name=LOCAL_MODEL_NAME, context_size=LOCAL_CONTEXT_SIZE, threads=LOCAL_THREADS):
+        self.name = name
+        self.context_size = context_size
+        self._llama = llama_cpp.Llama(model_path=model_path, n_ctx=context_size, n_threads=threads, verbose=False)
+        self._lock = threading.Lock()
+
+
+    def models(self):
+        return frozenset((self.name,))
+
+
+    def complete(self, model_config_dict, messages, stream=False, timings=None):
+        params = {
+            'messages': [{'role': message['role'], 'content': message['message']} for message in messages],
+            'max_tokens': model_config_dict['max_tokens'],
+            'temperature': model_config_dict['temperature'],
+            'top_p': model_config_dict['top_p'],
+            'frequency_penalty': model_config_dict['frequency_penalty'],
+            'presence_penalty': model_config_dict['presence_penalty']
+        }
+        # llama.cpp answers one choice per call, n alternatives are generated one after the other
+        n = model_config_dict.get('n', 1)
+        if not stream:
+            with self._lock:
+                completions = [self._llama.create_chat_completion(**params) for _ in range(n)]
+            return {
+                'choices': [{**completion['choices'][0], 'index': index} for index, completion in enumerate(completions)],
+                'usage': {
+                    'prompt_tokens': completions[0]['usage']['prompt_tokens'],
+                    'completion_tokens': sum(completion['usage']['completion_tokens'] for completion in completions),
+                    'total_tokens': completions[0]['usage']['prompt_tokens'] + sum(completion['usage']['completion_tokens'] for completion in completions)
+                }
+            }
+        return self._stream(params, n)
+
+
+    def _stream(self, params, n):
+        # the lock is held until the stream is read to the end or abandoned
+        with self._lock:
+            for index in range(n):
+                for chunk in self._llama.create_chat_completion(stream=True, **params):
+                    yield {**chunk, 'choices': [{**chunk['choices'][0], 'index': index}]}
+
+
+def get_local_provider():
+    """The process-wide local model, loaded on first use. None when LO_BUILDER_LOCAL_MODEL isn't set
+    or llama-cpp-python isn't installed"""
+    global _local_provider
+    if not LOCAL_MODEL_PATH or llama_cpp is None:
+        return None
+    with _local_provider_lock:
+        if _local_provider is None:
+            _local_provider = LocalProvider(LOCAL_MODEL_PATH)
+    return _local_provider
+
+
+def local_models():
+    """Ids of the models the local provider would serve, without loading it"""
+    return frozenset((LOCAL_MODEL_NAME,)) if LOCAL_MODEL_PATH and llama_cpp is not None else frozenset()
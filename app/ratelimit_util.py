@@ -0,0 +1,227 @@
+import os
+import random
+import threading
+import time
+
+# default (requests per minute, tokens per minute) per model, override with
+# LO_BUILDER_RATE_LIMITS="gpt-4=200/40000,gpt-3.5-turbo=3500/90000"
+DEFAULT_RATE_LIMITS = {
+    'gpt-3.5-turbo': (3500, 90000),
+    'gpt-4': (200, 40000),
+    'default': (3000, None)
+}
+
+MAX_RETRY_AFTER = 60
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at rate_per_minute. Callers reserve tokens
+    up front and sleep off any debt, so concurrent callers are spread out instead of bursting together"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def reserve(self, amount=1):
+        """Takes amount tokens and returns how many seconds the caller has to wait before using them"""
+        with self._lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / (self.rate_per_minute / 60.0)
+
+
+    def acquire(self, amount=1):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+    def headroom(self):
+        """Share of the bucket currently available, between 0 and 1"""
+        with self._lock:
+            self._refill()
+            return max(0.0, self.tokens / self.capacity)
+
+
+    def set_rate(self, rate_per_minute):
+        with self._lock:
+            self._refill()
+            self.rate_per_minute = rate_per_minute
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate_per_minute / 60.0)
+        self._updated = now
+
+
+class CircuitBreaker:
+    """Stops sending requests for reset_timeout seconds after failure_threshold consecutive failures,
+    then lets a single probe request through to decide whether to close again"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+
+    def check(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._probing:
+                raise CircuitOpenError(f"Too many failed requests, new requests are paused for {max(1, int(remaining))}s")
+            self._probing = threading.get_ident()
+
+
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() < self._opened_at + self.reset_timeout
+
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+    def end_probe(self):
+        """Lets another probe through after one that ended without telling whether the service recovered,
+        e.g. on a bad request. Without it, the circuit would stay open for good. Only the thread sending
+        the probe ends it"""
+        with self._lock:
+            if self._probing == threading.get_ident():
+                self._probing = False
+
+
+class ApiLimiter:
+    """Request and token budgets plus a circuit breaker for one (key, model) pair. The budgets adapt:
+    they are halved on every rate limit error and slowly grow back to the configured limits"""
+
+    def __init__(self, rpm, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv('LO_BUILDER_BREAKER_FAILURES', '5')),
+            reset_timeout=int(os.getenv('LO_BUILDER_BREAKER_TIMEOUT', '30'))
+        )
+
+
+    def acquire(self, tokens=0):
+        """Blocks until a request with this many tokens fits in the budgets, returns the seconds waited"""
+        self.breaker.check()
+        wait = self.requests.reserve(1)
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+    def headroom(self):
+        """Share of the budgets currently available, 0 while the circuit is open"""
+        if self.breaker.is_open():
+            return 0.0
+        headroom = self.requests.headroom()
+        if self.tokens is not None:
+            headroom = min(headroom, self.tokens.headroom())
+        return headroom
+
+
+    def record_success(self):
+        self.breaker.record_success()
+        self._scale(1.05)
+
+
+    def record_failure(self, rate_limited=False):
+        self.breaker.record_failure()
+        if rate_limited:
+            self._scale(0.5)
+
+
+    def end_probe(self):
+        self.breaker.end_probe()
+
+
+    def _scale(self, factor):
+        buckets = [(self.requests, self.rpm), (self.tokens, self.tpm)]
+        for bucket, limit in buckets:
+            if bucket is not None:
+                bucket.set_rate(max(limit * 0.05, min(limit, bucket.rate_per_minute * factor)))
+
+
+def _configured_limits():
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in os.getenv('LO_BUILDER_RATE_LIMITS', '').split(','):
+        if '=' in item:
+            model, _, values = item.partition('=')
+            rpm, _, tpm = values.partition('/')
+            limits[model.strip()] = (int(rpm), int(tpm) if tpm else None)
+    return limits
+
+
+def get_limiter(key_fingerprint, model):
+    """Process-wide limiter shared by every session using the same key and model"""
+    with _limiters_lock:
+        limiter = _limiters.get((key_fingerprint, model))
+        if limiter is None:
+            limits = _configured_limits()
+            rpm, tpm = limits.get(model, limits['default'])
+            limiter = _limiters[(key_fingerprint, model)] = ApiLimiter(rpm, tpm)
+        return limiter
+
+
+def retry_after(e):
+    """Seconds the server asked to wait in the error's retry-after headers, None when it didn't say"""
+    headers = getattr(e, 'headers', None) or {}
+    retry_after = headers.get('retry-after-ms')
+    if retry_after is not None:
+        try:
+            return min(MAX_RETRY_AFTER, float(retry_after) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after is not None:
+        try:
+            return min(MAX_RETRY_AFTER, float(retry_after))
+        except ValueError:
+            pass
+    return None
+
+
+def retry_delay(e, attempt, initial_backoff=1, max_backoff=30):
+    """Seconds to wait before retry number attempt: the server's retry-after when it sent one,
+    otherwise exponential backoff with full jitter"""
+    delay = retry_after(e)
+    if delay is not None:
+        return delay
+    return random.uniform(0, min(max_backoff, initial_backoff * 2 ** attempt))
@@ -0,0 +1,172 @@
+import os
+import threading
+
+import api_util as api
+import chunk_util
+import metrics_util as metrics
+import objective_util
+import prompt_util as prompt
+
+# the model name under which routed responses are shown and stored
+ROUTER_MODEL = 'auto'
+# models the router picks from, least capable and cheapest first
+ROUTE_MODELS = ('gpt-3.5-turbo', 'gpt-4')
+# the least capable model each request type starts with. Validation verdicts can't be checked
+# locally, so there is nothing to escalate on and they start with the strictest model
+MIN_TIER = {prompt.REQUEST_TITLE: 0, prompt.REQUEST_CONTENT: 0, prompt.REQUEST_VALIDATE: 1}
+# what a second of waiting is worth in USD, when weighing latency against cost
+LATENCY_WEIGHT = float(os.getenv('LO_BUILDER_ROUTER_LATENCY_WEIGHT', '0.002'))
+# expected response length, generated objectives are about this many tokens each
+TOKENS_PER_OBJECTIVE = 40
+# seconds per completion token assumed until responses of the model were seen
+DEFAULT_TOKEN_LATENCY = {'gpt-3.5-turbo': 0.02, 'gpt-4': 0.06}
+
+_token_latency = dict(DEFAULT_TOKEN_LATENCY)
+_token_latency_lock = threading.Lock()
+
+
+def observe(model, b_r):
+    """Learns the model's latency from a response it wrote, as a moving average of seconds per token"""
+    timings = b_r.get('timings')
+    if b_r['cached'] or b_r.get('shared') or not timings or not b_r['completion_tokens']:
+        return
+    seconds_per_token = (timings['total'] - timings['queue'] - timings['retry_wait']) / b_r['completion_tokens']
+    with _token_latency_lock:
+        _token_latency[model] = 0.8 * _token_latency.get(model, seconds_per_token) + 0.2 * seconds_per_token
+
+
+def expected_latency(model, completion_tokens):
+    with _token_latency_lock:
+        return _token_latency.get(model, max(DEFAULT_TOKEN_LATENCY.values())) * completion_tokens
+
+
+def candidates(available_models, request_type, prompt_tokens, max_tokens):
+    """Route models the key can use, at or above the request type's tier and with room for the request"""
+    models = [model for model in ROUTE_MODELS if model in available_models]
+    tiered = [model for model in models if ROUTE_MODELS.index(model) >= MIN_TIER.get(request_type, 0)] or models[-1:]
+    return [model for model in tiered if prompt_tokens + min(max_tokens, api.MIN_COMPLETION_TOKENS) <= api.MODEL_CONTEXT_SIZES.get(model, api.DEFAULT_CONTEXT_SIZE)]
+
+
+def choose_model(available_models, request_type, prompt_tokens, max_tokens, lo_quantity):
+    """The model with the lowest expected cost plus latency (weighted by LATENCY_WEIGHT) for the request"""
+    models = candidates(available_models, request_type, prompt_tokens, max_tokens)
+    if not models:
+        raise api.open_ai.BadRequest(f"The prompt is too long for any of {', '.join(ROUTE_MODELS)}. Please shorten the content.")
+    completion_tokens = min(max_tokens, TOKENS_PER_OBJECTIVE * lo_quantity)
+    return min(models, key=lambda model: api.estimate_cost(model, prompt_tokens, completion_tokens) + LATENCY_WEIGHT * expected_latency(model, completion_tokens))
+
+
+def _stronger_model(model, available_models, prompt_tokens, max_tokens, request_type):
+    models = candidates(available_models, request_type, prompt_tokens, max_tokens)
+    stronger = [candidate for candidate in models if ROUTE_MODELS.index(candidate) > ROUTE_MODELS.index(model)]
+    return stronger[0] if stronger else None
+
+
+def _passes(lo_request, b_r):
+    """Whether the answer has the shape asked for: at least lo_quantity objectives, none repeated.
+    Verb choice is left to repair, a stronger model costs more than fixing a line. Validation verdicts always pass"""
+    if lo_request['request'] == prompt.REQUEST_VALIDATE:
+        return True
+    objectives = objective_util.parse_objectives(b_r['messages'][-1]['message'])
+    if len(objectives) < lo_request['lo_quantity']:
+        return False
+    return len({objective['text'].lower().rstrip('.') for objective in objectives[:lo_request['lo_quantity']]}) == lo_request['lo_quantity']
+
+
+def _billed(b_r):
+    return (0, 0) if b_r['cached'] else (b_r['prompt_tokens'], b_r['completion_tokens'])
+
+
+class _Route:
+    """Models tried for one routed request, and the tokens and cost of all their responses"""
+
+    def __init__(self, o, model_config_dict, lo_request, init_prompt_msg, messages):
+        self.available_models = o.get_available_models()
+        self.prompt_tokens = api.count_message_tokens([{'role': 'system', 'message': init_prompt_msg}] + messages)
+        self.max_tokens = model_config_dict['max_tokens']
+        self.request_type = lo_request['request']
+        self.model = choose_model(self.available_models, self.request_type, self.prompt_tokens, self.max_tokens, lo_request['lo_quantity'])
+        self.tried = []
+        self.usage = {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached': True}
+        self.cost = 0.0
+
+
+    def add(self, b_r):
+        observe(self.model, b_r)
+        self.tried.append(self.model)
+        for field in ('total_tokens', 'prompt_tokens', 'completion_tokens'):
+            self.usage[field] += b_r[field]
+        self.usage['cached'] = self.usage['cached'] and b_r['cached']
+        self.cost += api.estimate_cost(self.model, *_billed(b_r))
+
+
+    def escalate(self, lo_request, b_r):
+        """Moves on to the next stronger model when the response is unusable. False when it passed or there is none"""
+        if _passes(lo_request, b_r):
+            return False
+        stronger = _stronger_model(self.model, self.available_models, self.prompt_tokens, self.max_tokens, self.request_type)
+        if stronger is None:
+            return False
+        metrics.inc('lo_builder_router_escalations_total', model=self.model, to=stronger)
+        self.model = stronger
+        return True
+
+
+    def finish(self, o, model_config_dict, lo_request, b_r, use_cache, repair):
+        """The final response, repaired with the model that wrote it when asked for, with the usage of every attempt"""
+        if repair:
+            billed = _billed(b_r)
+            repaired = objective_util.repair_response(o, {**model_config_dict, 'model': self.model}, lo_request, b_r, use_cache)
+            repaired_billed = _billed(repaired)
+            self.cost += api.estimate_cost(self.model, repaired_billed[0] - billed[0], repaired_billed[1] - billed[1])
+            for field in ('total_tokens', 'prompt_tokens', 'completion_tokens'):
+                self.usage[field] += repaired[field] - b_r[field]
+            b_r = repaired
+        metrics.inc('lo_builder_router_requests_total', model=self.model, request=self.request_type)
+        return {**b_r, **self.usage, 'model': ROUTER_MODEL, 'routed_model': self.model, 'escalated': len(self.tried) > 1, 'cost': self.cost}
+
+
+def get_response(o, lo_request, model_config_dict, init_prompt_msg, messages, use_cache=True, queued_at=None, repair=False):
+    """open_ai.get_ai_response for the router: the cheapest suitable model answers, and a stronger one
+    only when that answer doesn't have the objectives asked for. The response tells which model answered ('routed_model'),
+    whether it was 'escalated', and its 'cost' and token usage summed over all attempts"""
+    route = _Route(o, model_config_dict, lo_request, init_prompt_msg, messages)
+    while True:
+        # a stronger model's request starts when the previous answer failed, not when the first was queued
+        b_r = o.get_ai_response({**model_config_dict, 'model': route.model}, init_prompt_msg, messages, use_cache, None if route.tried else queued_at)
+        route.add(b_r)
+        if not route.escalate(lo_request, b_r):
+            return route.finish(o, model_config_dict, lo_request, b_r, use_cache, repair)
+
+
+def stream_response(o, lo_request, model_config_dict, init_prompt_msg, messages, use_cache=True, queued_at=None, repair=False):
+    """open_ai.stream_ai_response for the router. Events are those of the chosen model under ROUTER_MODEL.
+    When its answer is unusable, a {'progress', 'status', 'restart'} event tells that the text so far
+    is replaced by the answer of a stronger model"""
+    route = _Route(o, model_config_dict, lo_request, init_prompt_msg, messages)
+    while True:
+        done = None
+        for event in o.stream_ai_response({**model_config_dict, 'model': route.model}, init_prompt_msg, messages, use_cache, None if route.tried else queued_at):
+            if 'done' in event:
+                done = event
+            else:
+                yield {**event, 'model': ROUTER_MODEL}
+        route.add(done)
+        previous_model = route.model
+        if not route.escalate(lo_request, done):
+            yield {**route.finish(o, model_config_dict, lo_request, done, use_cache, repair), 'done': True}
+            return
+        yield {'model': ROUTER_MODEL, 'progress': 0.0, 'status': f"The {previous_model} answer had too few objectives, asking {route.model}", 'restart': True}
+
+
+def stream_map_reduce(o, model_config_dict, lo_request, messages, use_cache=True, repair=False):
+    """chunk_util.stream_map_reduce for the router, with the model chosen for the size of a section"""
+    available_models = o.get_available_models()
+    model = choose_model(available_models, lo_request['request'], chunk_util.CHUNK_TOKENS, model_config_dict['max_tokens'], lo_request['lo_quantity'])
+    for event in chunk_util.stream_map_reduce(o, {**model_config_dict, 'model': model}, lo_request, messages, use_cache):
+        if 'done' in event:
+            if repair:
+                event = objective_util.repair_response(o, {**model_config_dict, 'model': model}, lo_request, event, use_cache)
+            metrics.inc('lo_builder_router_requests_total', model=model, request=lo_request['request'])
+            event = {**event, 'routed_model': model, 'escalated': False, 'cost': api.estimate_cost(model, *_billed(event))}
+        yield {**event, 'model': ROUTER_MODEL}
@@ -0,0 +1,149 @@
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# model requests sent to the API at once across all sessions
+MAX_CONCURRENT = int(os.getenv('LO_BUILDER_MAX_WORKERS', '8'))
+# how long a request is assumed to hold its slot before any has finished
+INITIAL_SERVICE_TIME = 5.0
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class Ticket:
+    """A request's place in the scheduler queue"""
+    __slots__ = ('session', 'cost', 'tag', 'seq', 'granted', 'started', 'done')
+
+    def __init__(self, session, cost, tag, seq):
+        self.session = session
+        self.cost = cost
+        self.tag = tag
+        self.seq = seq
+        self.granted = threading.Event()
+        self.started = None
+        self.done = False
+
+    def wait(self, timeout=None):
+        return self.granted.wait(timeout)
+
+
+class Scheduler:
+    """Caps how many requests run at once across all sessions, and decides who goes next when
+    a slot frees up. Sessions take turns by weighted fair queuing: each request is tagged with the
+    cost its session has queued so far, so a session sending many requests can't starve the others,
+    and among sessions that used the same share, cheaper requests go first"""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self._queue = []
+        self._queued = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        # finish tag of the last queued request of each session, and the tag of the last started request
+        self._last_tag = {}
+        self._virtual_time = 0.0
+        self._service_time = INITIAL_SERVICE_TIME
+
+
+    def enqueue(self, session, cost):
+        """Queues a request, returning its ticket. Wait on the ticket for a slot, then release it"""
+        with self._lock:
+            tag = max(self._virtual_time, self._last_tag.get(session, 0.0)) + cost
+            self._last_tag[session] = tag
+            ticket = Ticket(session, cost, tag, next(self._seq))
+            heapq.heappush(self._queue, (tag, ticket.seq, ticket))
+            self._queued += 1
+            self._grant()
+        return ticket
+
+
+    def release(self, ticket):
+        """Frees the ticket's slot, or takes it out of the queue when it wasn't granted one yet"""
+        with self._lock:
+            if ticket.done:
+                return
+            ticket.done = True
+            if ticket.started is None:
+                # still queued, it is skipped when it reaches the front
+                self._queued -= 1
+                return
+            self.running -= 1
+            # a moving average of how long requests hold a slot, for the wait estimates
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.perf_counter() - ticket.started)
+            self._grant()
+
+
+    @contextlib.contextmanager
+    def slot(self, session, cost):
+        """Holds a slot for the enclosed block, waiting in the queue for one first"""
+        ticket = self.enqueue(session, cost)
+        try:
+            ticket.wait()
+            yield ticket
+        finally:
+            self.release(ticket)
+
+
+    def position(self, ticket):
+        """1 for the next request to start, 0 once the ticket holds a slot"""
+        with self._lock:
+            if ticket.started is not None or ticket.done:
+                return 0
+            return 1 + sum(1 for tag, seq, queued in self._queue if not queued.done and (tag, seq) < (ticket.tag, ticket.seq))
+
+
+    def estimate_wait(self, position):
+        """Seconds until the request at this queue position is likely to start"""
+        if position <= 0:
+            return 0.0
+        return self._service_time * position / self.max_concurrent
+
+
+    def status(self, session):
+        """(position, estimated wait) of the session's first queued request, None when it has none queued"""
+        with self._lock:
+            waiting = sorted((tag, seq, ticket.session) for tag, seq, ticket in self._queue if not ticket.done)
+        for position, (_, _, queued_session) in enumerate(waiting, start=1):
+            if queued_session == session:
+                return position, self.estimate_wait(position)
+        return None
+
+
+    def _grant(self):
+        """Starts queued requests while slots are free. Called with the lock held"""
+        while self.running < self.max_concurrent and self._queue:
+            tag, _, ticket = heapq.heappop(self._queue)
+            if ticket.done:
+                continue
+            self._queued -= 1
+            self.running += 1
+            self._virtual_time = max(self._virtual_time, tag - ticket.cost)
+            ticket.started = time.perf_counter()
+            ticket.granted.set()
+
+        if not self._queue:
+            # with nobody waiting, earlier usage no longer counts against anyone
+            self._last_tag.clear()
+        elif len(self._last_tag) > 4 * self._queued + 64:
+            self._last_tag = {session: tag for session, tag in self._last_tag.items() if tag > self._virtual_time}
+
+
+def get_scheduler():
+    """Process-wide scheduler shared by all sessions"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+    return _scheduler
+
+
+def format_wait(position, seconds):
+    """Queue position and wait for display, e.g. "Queued: 3 requests ahead, about 12 s" """
+    ahead = max(position - 1, 0)
+    place = "next in line" if not ahead else f"{ahead} request{'' if ahead == 1 else 's'} ahead"
+    return f"Queued: {place}, about {max(1, round(seconds))} s"
@@ -0,0 +1,338 @@
+"""Headless HTTP API for learning objective generation, for integrations such as an LMS.
+
+    OPENAI_API_KEY=sk-... python server.py --port 8080
+
+Every endpoint takes a JSON object and answers with JSON:
+
+    POST /generate   learning objectives based on the learning_content
+    POST /suggest    learning objectives based on the module_title
+    POST /validate   alignment between the learning_content and the learning_objectives
+    GET  /health
+    GET  /metrics    Prometheus-style metrics of all requests
+
+Request fields are module_title, learning_content, learning_objectives, lo_quantity (default 4),
+cognition_goals (default all), learning_preferences, relevance, models (default ["gpt-3.5-turbo"]),
+max_tokens, temperature, top_p, frequency_penalty, presence_penalty, n (default 1), use_cache (default true),
+repair (default false) and stream. The OpenAI key is read from an "Authorization: Bearer" header,
+falling back to the server's keys.
+
+Without "stream" the answer is {"request", "results": {model: {"response", *_tokens, "cost", "cached",
+"timings", "objectives", "repaired"}}}, with {"error"} in place of the result of a model that failed.
+With "stream": true the answer is newline-delimited JSON events as the models write: {"model", "delta"}
+for each piece of text, {"model", "progress", "status"} while waiting in the queue or while long content
+is read in sections, then {"model", "done", ...} with the same fields as a result, or {"model", "error"}.
+
+With "n" above 1 each model writes that many alternative answers in one request. The result has them all
+in "variants", the first is also its "response", and the tokens and cost cover all of them.
+
+Generated objectives are parsed into "objectives" ({"text", "verb", "level"}). With "repair", only those
+that break the rules of the prompt are rewritten, by a short follow-up request, and counted in "repaired".
+
+/validate first checks every objective locally against the content and adds this "precheck" to the
+answer (the first event when streamed): {"objectives": [{"objective", "verb", "level", "coverage",
+"best_paragraph", "verdict", "reasons"}], "conclusive"}. When every verdict is "pass" or "fail" the
+models are not asked and "results" is empty (when streamed, the precheck is the only event), unless
+the request sets "fast_path": false.
+
+The model "auto" is answered by the router: the cheapest and fastest suitable model is asked first, and
+a stronger one only when it wrote too few distinct objectives. Its result tells which model answered
+("routed_model"), whether it was "escalated", and the cost of all the requests.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import threading
+
+from aiohttp import web
+
+import alignment_util
+import api_util as api
+import cache_util
+import chunk_util
+import keypool_util
+import objective_util
+import metrics_util as metrics
+import prompt_util as prompt
+import router_util
+
+MODEL_DEFAULTS = {'max_tokens': 1000, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0, 'n': 1}
+MAX_LO_QUANTITY = 8
+
+# the OpenAI client blocks, so its calls run on these threads while the event loop keeps serving other callers
+_blocking_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('LO_BUILDER_SERVER_WORKERS', '64')),
+    thread_name_prefix='server'
+)
+
+
+def _run_blocking(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(_blocking_executor, functools.partial(fn, *args))
+
+
+async def _iterate_blocking(events):
+    """Async iteration over a blocking generator, which is driven by a worker thread"""
+    loop = asyncio.get_running_loop()
+    events_queue = asyncio.Queue()
+    end = object()
+    stopped = threading.Event()
+
+    def pump():
+        try:
+            for event in events:
+                if stopped.is_set():
+                    break
+                loop.call_soon_threadsafe(events_queue.put_nowait, event)
+        except Exception as e:
+            loop.call_soon_threadsafe(events_queue.put_nowait, e)
+        finally:
+            events.close()
+            loop.call_soon_threadsafe(events_queue.put_nowait, end)
+
+    _blocking_executor.submit(pump)
+    try:
+        while True:
+            event = await events_queue.get()
+            if event is end:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+    finally:
+        # the caller went away, stop reading further events
+        stopped.set()
+
+
+def _error(status, message):
+    return web.json_response({'error': message}, status=status)
+
+
+def parse_request(body, request_type):
+    """Validates a request body, returning the build_lo_prompt arguments and the model configs"""
+    if not isinstance(body, dict):
+        raise ValueError("The request body must be a JSON object")
+
+    lo_request = {
+        'request': request_type,
+        'lo_quantity': int(body.get('lo_quantity', 4)),
+        'cognition_goals': body.get('cognition_goals') or prompt.COGNITION_GOALS,
+        'learning_preferences': bool(body.get('learning_preferences', False)),
+        'relevance': bool(body.get('relevance', False)),
+        'module_title': body.get('module_title') or '',
+        'learning_content': body.get('learning_content') or '',
+        'learning_objectives': body.get('learning_objectives') or ''
+    }
+    for field in ('module_title', 'learning_content', 'learning_objectives'):
+        if not isinstance(lo_request[field], str):
+            raise ValueError(f"{field} must be a string")
+    if not 1 <= lo_request['lo_quantity'] <= MAX_LO_QUANTITY:
+        raise ValueError(f"lo_quantity must be between 1 and {MAX_LO_QUANTITY}")
+    unknown_goals = [goal for goal in lo_request['cognition_goals'] if goal not in prompt.COGNITION_GOALS]
+    if unknown_goals:
+        raise ValueError(f"Unknown cognition goals: {', '.join(map(str, unknown_goals))}. Use any of {', '.join(prompt.COGNITION_GOALS)}")
+
+    if request_type == prompt.REQUEST_CONTENT and not lo_request['learning_content']:
+        raise ValueError("learning_content is required")
+    if request_type == prompt.REQUEST_TITLE and not lo_request['module_title']:
+        raise ValueError("module_title is required")
+    if request_type == prompt.REQUEST_VALIDATE and not (lo_request['learning_content'] and lo_request['learning_objectives']):
+        raise ValueError("learning_content and learning_objectives are required")
+
+    models = body.get('models') or ['gpt-3.5-turbo']
+    if not isinstance(models, list) or not all(isinstance(model, str) for model in models):
+        raise ValueError("models must be a list of model names")
+    model_config_dicts = [
+        {'model': model, **{field: type(default)(body.get(field, default)) for field, default in MODEL_DEFAULTS.items()}}
+        for model in dict.fromkeys(models)
+    ]
+    if not 1 <= model_config_dicts[0]['n'] <= api.MAX_VARIANTS:
+        raise ValueError(f"n must be between 1 and {api.MAX_VARIANTS}")
+    return lo_request, model_config_dicts
+
+
+def _result(model, b_r):
+    """JSON result for a model's response"""
+    return {
+        'response': b_r['messages'][-1]['message'],
+        'total_tokens': b_r['total_tokens'],
+        'prompt_tokens': b_r['prompt_tokens'],
+        'completion_tokens': b_r['completion_tokens'],
+        'cost': b_r['cost'] if 'cost' in b_r else 0 if b_r['cached'] else api.estimate_cost(model, b_r['prompt_tokens'], b_r['completion_tokens']),
+        'cached': b_r['cached'],
+        'timings': b_r.get('timings'),
+        'objectives': b_r.get('objectives'),
+        'repaired': b_r.get('repaired', 0),
+        **({'variants': b_r['variants']} if 'variants' in b_r else {}),
+        **({'routed_model': b_r['routed_model'], 'escalated': b_r['escalated']} if 'routed_model' in b_r else {})
+    }
+
+
+def _event_json(event):
+    if 'done' in event:
+        return {'model': event['model'], 'done': True, **_result(event['model'], event)}
+    if 'error' in event:
+        return {'model': event['model'], 'error': str(event['error'])}
+    return event
+
+
+def _repaired(o, model_config_dict, lo_request, stream_factory, use_cache):
+    return lambda: objective_util.repair_stream(o, model_config_dict, lo_request, stream_factory(), use_cache)
+
+
+def _get_response(o, model_config_dict, lo_prompt, lo_request, use_cache, repair):
+    if model_config_dict['model'] == router_util.ROUTER_MODEL:
+        return router_util.get_response(o, lo_request, model_config_dict, lo_prompt, [], use_cache, repair=repair)
+    b_r = o.get_ai_response(model_config_dict, lo_prompt, [], use_cache)
+    if repair:
+        b_r = objective_util.repair_response(o, model_config_dict, lo_request, b_r, use_cache)
+    return b_r
+
+
+async def _handle(request, request_type):
+    try:
+        body = await request.json()
+        lo_request, model_config_dicts = parse_request(body, request_type)
+    except (TypeError, ValueError) as e:
+        return _error(400, str(e))
+
+    precheck = None
+    if request_type == prompt.REQUEST_VALIDATE:
+        precheck = await _run_blocking(alignment_util.check_alignment, lo_request['learning_content'], lo_request['learning_objectives'])
+        if precheck['conclusive'] and body.get('fast_path', alignment_util.FAST_PATH):
+            if body.get('stream'):
+                response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+                await response.prepare(request)
+                await response.write((json.dumps({'precheck': precheck}) + '\n').encode('utf-8'))
+                await response.write_eof()
+                return response
+            return web.json_response({'request': request_type, 'precheck': precheck, 'results': {}})
+
+    authorization = request.headers.get('Authorization', '')
+    api_key = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else request.app['api_key']
+    # requests without a key of their own are balanced over the server's key pool, and take turns
+    # in the scheduler by client address instead of by key
+    key_pool = keypool_util.get_key_pool() if not api_key else None
+    if not api_key and key_pool is None:
+        return _error(401, "An OpenAI API key is required, send it as an \"Authorization: Bearer\" header")
+
+    o = api.open_ai(api_key=api_key, restart_sequence='|UR|', stop_sequence='|SP|', cache=cache_util.get_response_cache(), key_pool=key_pool, session=request.remote if key_pool is not None else None)
+    try:
+        # verified keys are cached, so this is usually free
+        available_models = await _run_blocking(o.get_available_models)
+    except Exception as e:
+        return _error(401, str(e))
+    unavailable_models = [cfg['model'] for cfg in model_config_dicts if cfg['model'] not in available_models and cfg['model'] != router_util.ROUTER_MODEL]
+    if unavailable_models:
+        return _error(400, f"The key has no access to {', '.join(unavailable_models)}")
+
+    use_cache = bool(body.get('use_cache', True))
+    repair = request_type != prompt.REQUEST_VALIDATE and bool(body.get('repair', objective_util.REPAIR_OBJECTIVES))
+    lo_prompt = prompt.build_lo_prompt(**lo_request)
+
+    # long content is read section by section, and each section is moderated on its own
+    use_map_reduce = chunk_util.needs_chunking(lo_request['learning_content'])
+    if use_map_reduce:
+        stream_factories = {
+            cfg['model']: functools.partial(chunk_util.stream_map_reduce, o, cfg, lo_request, [], use_cache)
+            if cfg['model'] != router_util.ROUTER_MODEL else functools.partial(router_util.stream_map_reduce, o, cfg, lo_request, [], use_cache, repair)
+            for cfg in model_config_dicts
+        }
+    else:
+        try:
+            moderation_result = await _run_blocking(o.get_moderation, lo_prompt)
+        except Exception as e:
+            return _error(502, str(e))
+        if moderation_result['flagged']:
+            return _error(400, f"The request has been flagged by OpenAI's content moderation endpoint due to the following categories: {', '.join(moderation_result['flagged_categories'])}.")
+        stream_factories = {
+            cfg['model']: functools.partial(o.stream_ai_response, cfg, lo_prompt, [], use_cache)
+            if cfg['model'] != router_util.ROUTER_MODEL else functools.partial(router_util.stream_response, o, lo_request, cfg, lo_prompt, [], use_cache, repair=repair)
+            for cfg in model_config_dicts
+        }
+
+    if repair:
+        # objectives that break the rules of the prompt are rewritten once the response is complete,
+        # the router does that itself with the model that wrote them
+        stream_factories = {
+            model: _repaired(o, cfg, lo_request, stream_factory, use_cache) if model != router_util.ROUTER_MODEL else stream_factory
+            for (model, stream_factory), cfg in zip(stream_factories.items(), model_config_dicts)
+        }
+
+    if body.get('stream'):
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        if precheck is not None:
+            await response.write((json.dumps({'precheck': precheck}) + '\n').encode('utf-8'))
+        async for event in _iterate_blocking(api.merge_streams(stream_factories)):
+            await response.write((json.dumps(_event_json(event)) + '\n').encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    results = {}
+    if use_map_reduce:
+        async for event in _iterate_blocking(api.merge_streams(stream_factories)):
+            if 'done' in event or 'error' in event:
+                results[event['model']] = {key: value for key, value in _event_json(event).items() if key not in ('model', 'done')}
+    else:
+        # one-shot completions report the exact token usage
+        responses = await asyncio.gather(
+            *(_run_blocking(_get_response, o, cfg, lo_prompt, lo_request, use_cache, repair) for cfg in model_config_dicts),
+            return_exceptions=True
+        )
+        for cfg, b_r in zip(model_config_dicts, responses):
+            results[cfg['model']] = {'error': str(b_r)} if isinstance(b_r, Exception) else _result(cfg['model'], b_r)
+    answer = {'request': request_type, 'results': results}
+    if precheck is not None:
+        answer['precheck'] = precheck
+    return web.json_response(answer)
+
+
+async def handle_generate(request):
+    return await _handle(request, prompt.REQUEST_CONTENT)
+
+
+async def handle_suggest(request):
+    return await _handle(request, prompt.REQUEST_TITLE)
+
+
+async def handle_validate(request):
+    return await _handle(request, prompt.REQUEST_VALIDATE)
+
+
+async def handle_health(request):
+    return web.json_response({'status': 'ok'})
+
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render_prometheus(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+def create_app(api_key=None):
+    app = web.Application(client_max_size=int(os.getenv('LO_BUILDER_SERVER_MAX_BODY', str(8 * 1024 * 1024))))
+    app['api_key'] = api_key
+    app.add_routes([
+        web.post('/generate', handle_generate),
+        web.post('/suggest', handle_suggest),
+        web.post('/validate', handle_validate),
+        web.get('/health', handle_health),
+        web.get('/metrics', handle_metrics)
+    ])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve learning objective generation over HTTP")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--api-key', help="key used when a request sends none (default the keys in OPENAI_API_KEYS or OPENAI_API_KEY)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(args.api_key), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
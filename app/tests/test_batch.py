@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+import unittest
+
+import batch
+
+
+class FakeOpenAI:
+    """Answers every prompt at once, without an API key"""
+
+    def __init__(self):
+        self.prompts = 0
+
+    def get_moderation(self, user_message):
+        return {'flagged': False, 'flagged_categories': []}
+
+    def get_ai_response(self, model_config_dict, init_prompt_msg, messages):
+        self.prompts += 1
+        return {
+            'messages': [{'role': 'assistant', 'message': "1. Define mitosis"}],
+            'total_tokens': 10, 'prompt_tokens': 8, 'completion_tokens': 2, 'cached': False
+        }
+
+
+OPTIONS = {'lo_quantity': 1, 'cognition_goals': [], 'learning_preferences': False, 'relevance': False, 'repair': False}
+MODEL_CONFIG_DICTS = [{'model': 'm', 'max_tokens': 100, 'temperature': 0.7}]
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output_path = os.path.join(directory.name, 'results.jsonl')
+        self.modules = [
+            {'id': str(index), 'module_title': f"Module {index}", 'learning_content': '', 'learning_objectives': '', 'request': 'title'}
+            for index in range(3)
+        ]
+
+    def records(self):
+        with open(self.output_path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_resume_skips_completed_jobs(self):
+        batch.run_batch(FakeOpenAI(), self.modules[:2], MODEL_CONFIG_DICTS, self.output_path, OPTIONS, rpm=0)
+        o = FakeOpenAI()
+        stats = batch.run_batch(o, self.modules, MODEL_CONFIG_DICTS, self.output_path, OPTIONS, rpm=0)
+        self.assertEqual(o.prompts, 1)
+        self.assertEqual((stats['completed'], stats['skipped']), (1, 2))
+        self.assertEqual(sorted(record['job_id'] for record in self.records()), ['0:m', '1:m', '2:m'])
+
+    def test_resume_after_an_interrupted_write(self):
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'job_id': '0:m', 'response': "1. Define mitosis"}) + '\n')
+            f.write('{"job_id": "1:m", "resp')
+        stats = batch.run_batch(FakeOpenAI(), self.modules, MODEL_CONFIG_DICTS, self.output_path, OPTIONS, rpm=0)
+        self.assertEqual((stats['completed'], stats['skipped']), (2, 1))
+        # every line is whole again, and the interrupted job was run again
+        self.assertEqual(sorted(record['job_id'] for record in self.records()), ['0:m', '1:m', '2:m'])
+
+    def test_interrupted_first_write(self):
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            f.write('{"job_id": "0:m"')
+        batch.run_batch(FakeOpenAI(), self.modules, MODEL_CONFIG_DICTS, self.output_path, OPTIONS, rpm=0)
+        self.assertEqual(sorted(record['job_id'] for record in self.records()), ['0:m', '1:m', '2:m'])
+
+    def test_modules_are_read_from_the_file_as_they_are_run(self):
+        input_path = os.path.join(os.path.dirname(self.output_path), 'modules.jsonl')
+        with open(input_path, 'w', encoding='utf-8') as f:
+            for module in self.modules:
+                f.write(json.dumps(module) + '\n')
+        modules = batch.read_modules(input_path)
+        self.assertNotIsInstance(modules, list)
+        progress = []
+        stats = batch.run_batch(FakeOpenAI(), modules, MODEL_CONFIG_DICTS, self.output_path, OPTIONS, rpm=0, on_progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(progress[-1], (3, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import unittest
+
+import cache_util
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = cache_util.SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+        # counts callers that found the call running, before they block on it
+        self.waiting = threading.Semaphore(0)
+        wait = self.flight.wait
+
+        def counting_wait(future):
+            self.waiting.release()
+            return wait(future)
+        self.flight.wait = counting_wait
+
+    def slow_call(self, result='answer', error=None):
+        def call():
+            self.calls += 1
+            self.started.set()
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        return call
+
+    def run_in_thread(self, key, fn, results):
+        def target():
+            try:
+                results.append(self.flight.do(key, fn))
+            except Exception as e:
+                results.append(e)
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def test_callers_of_a_running_call_share_its_result(self):
+        leader_results, waiter_results = [], []
+        leader = self.run_in_thread('key', self.slow_call(), leader_results)
+        self.started.wait(5)
+        waiters = [self.run_in_thread('key', self.slow_call(), waiter_results) for _ in range(3)]
+        for _ in waiters:
+            self.assertTrue(self.waiting.acquire(timeout=5))
+        self.release.set()
+        for thread in [leader] + waiters:
+            thread.join(5)
+        self.assertEqual(leader_results, [('answer', False)])
+        self.assertEqual(waiter_results, [('answer', True)] * 3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flight.saved, 3)
+
+    def test_different_keys_run_apart(self):
+        self.release.set()
+        self.assertEqual(self.flight.do('a', self.slow_call('a')), ('a', False))
+        self.assertEqual(self.flight.do('b', self.slow_call('b')), ('b', False))
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.flight.saved, 0)
+
+    def test_a_finished_call_is_not_shared_with_later_callers(self):
+        self.release.set()
+        self.flight.do('key', self.slow_call())
+        self.assertEqual(self.flight.do('key', self.slow_call()), ('answer', False))
+        self.assertEqual(self.calls, 2)
+
+    def test_a_failed_call_is_retried_by_its_waiters(self):
+        leader_results, waiter_results = [], []
+        leader = self.run_in_thread('key', self.slow_call(error=RuntimeError("rate limited")), leader_results)
+        self.started.wait(5)
+        waiter = self.run_in_thread('key', lambda: 'retried', waiter_results)
+        self.assertTrue(self.waiting.acquire(timeout=5))
+        self.release.set()
+        leader.join(5)
+        waiter.join(5)
+        self.assertIsInstance(leader_results[0], RuntimeError)
+        self.assertEqual(waiter_results, [('retried', False)])
+        self.assertEqual(self.flight.saved, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from unittest import mock
+
+import api_util as api
+import chunk_util
+
+
+class SplitContentTest(unittest.TestCase):
+
+    def test_sections_stay_within_the_token_limit(self):
+        text = "\n\n".join(f"Paragraph {index}. " + "Cells divide and grow. " * 20 for index in range(20))
+        sections = chunk_util.split_content(text, max_tokens=200)
+        self.assertGreater(len(sections), 1)
+        for section in sections:
+            self.assertLessEqual(api.count_tokens(section), 200)
+
+    def test_repeated_calls_reuse_the_sections(self):
+        text = "\n\n".join("Mitosis has several phases. " * 30 for _ in range(10))
+        sections = chunk_util.split_content(text, max_tokens=150)
+        with mock.patch.object(chunk_util.api, 'count_tokens', side_effect=AssertionError("tokenized again")):
+            self.assertEqual(chunk_util.split_content(text, max_tokens=150), sections)
+
+    def test_needs_chunking_counts_each_content_once(self):
+        text = "Meiosis halves the chromosome count. " * 400
+        first = chunk_util.needs_chunking(text)
+        with mock.patch.object(chunk_util.api, 'count_tokens', side_effect=AssertionError("tokenized again")):
+            self.assertEqual(chunk_util.needs_chunking(text), first)
+
+    def test_different_limits_are_cached_apart(self):
+        text = "\n\n".join("Photosynthesis makes sugar from light. " * 10 for _ in range(10))
+        self.assertNotEqual(len(chunk_util.split_content(text, max_tokens=100)), len(chunk_util.split_content(text, max_tokens=1000)))
+
+
+if __name__ == '__main__':
+    unittest.main()
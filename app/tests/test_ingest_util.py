@@ -0,0 +1,68 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import ingest_util
+
+
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(ingest_util, 'INGEST_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, name, text):
+        return ingest_util.ingest(name, io.BytesIO(text.encode('utf-8')))
+
+    def test_the_same_file_is_read_once(self):
+        first = self.upload('notes.txt', "Mitosis divides a cell.\n\nMeiosis makes gametes.")
+        second = self.upload('copy.txt', "Mitosis divides a cell.\n\nMeiosis makes gametes.")
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertEqual(second.text_path, first.text_path)
+        self.assertEqual(ingest_util.load_text(first.text_path), "Mitosis divides a cell.\n\nMeiosis makes gametes.")
+        # only the text and its page count are left behind
+        self.assertEqual(sorted(os.listdir(self.directory)), [first.digest + '.txt', first.digest + '.txt.json'])
+
+    def test_evicted_text_is_extracted_again(self):
+        document = self.upload('notes.txt', "Photosynthesis makes sugar.")
+        os.remove(document.text_path)
+        self.assertFalse(self.upload('notes.txt', "Photosynthesis makes sugar.").cached)
+
+    def test_least_recently_uploaded_texts_are_evicted(self):
+        with mock.patch.object(ingest_util, 'INGEST_MAX_BYTES', 60):
+            old = self.upload('old.txt', "a" * 40)
+            os.utime(old.text_path, (time.time() - 60, time.time() - 60))
+            new = self.upload('new.txt', "b" * 40)
+        self.assertFalse(os.path.exists(old.text_path))
+        self.assertFalse(os.path.exists(old.text_path + '.json'))
+        self.assertTrue(os.path.exists(new.text_path))
+
+    def test_uploads_being_read_are_not_evicted(self):
+        digest, source_path = ingest_util.spill(io.BytesIO(b"Cells divide."))
+        self.assertFalse(source_path.endswith('.txt'))
+        with mock.patch.object(ingest_util, 'INGEST_MAX_BYTES', 0):
+            ingest_util.evict()
+        self.assertTrue(os.path.exists(source_path))
+
+    def test_stale_temporary_files_are_removed(self):
+        stale = os.path.join(self.directory, 'tmpleftover.pdf')
+        fresh = os.path.join(self.directory, 'tmpreading.pdf')
+        for path in (stale, fresh):
+            with open(path, 'w') as f:
+                f.write('partial')
+        os.utime(stale, (time.time() - 2 * ingest_util.STALE_SECONDS,) * 2)
+        ingest_util.evict()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+
+if __name__ == '__main__':
+    unittest.main()
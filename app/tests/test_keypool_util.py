@@ -0,0 +1,85 @@
+import time
+import unittest
+from unittest import mock
+
+import openai
+
+import api_util as api
+import keypool_util
+import ratelimit_util as ratelimit
+
+
+class KeyPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = keypool_util.KeyPool([('sk-pool-a', None), ('sk-pool-b', 'org-1')])
+        self.first, self.second = self.pool.keys
+
+    def test_parse_keys(self):
+        self.assertEqual(keypool_util.parse_keys("sk-a:org-1, sk-b,,"), [('sk-a', 'org-1'), ('sk-b', None)])
+
+    def test_pick_prefers_the_key_with_more_headroom(self):
+        model = 'pool-headroom-model'
+        ratelimit.get_limiter(self.first.fingerprint, model).acquire()
+        self.assertIs(self.pool.pick(model), self.second)
+
+    def test_cooling_keys_are_skipped(self):
+        self.pool.cool_down(self.first, 60)
+        self.assertEqual(self.pool.available(), 1)
+        for _ in range(10):
+            self.assertIs(self.pool.pick('pool-cooldown-model'), self.second)
+
+    def test_when_all_keys_cool_down_the_first_back_is_picked(self):
+        self.pool.cool_down(self.first, 60)
+        self.pool.cool_down(self.second, 30)
+        self.assertEqual(self.pool.available(), 0)
+        self.assertIs(self.pool.pick('pool-cooldown-model'), self.second)
+
+    def test_cool_down_never_shortens_a_cooldown(self):
+        self.pool.cool_down(self.first, 60)
+        self.pool.cool_down(self.first, 1)
+        self.assertGreater(self.first.cooldown_until - time.monotonic(), 50)
+
+
+class FailoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = keypool_util.KeyPool([('sk-failover-a', None), ('sk-failover-b', None)])
+        self.o = api.open_ai(api_key=None, restart_sequence='|UR|', stop_sequence='|SP|', key_pool=self.pool)
+        self.calls = []
+        patcher = mock.patch.object(api.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def rate_limited(self, **headers):
+        return openai.error.RateLimitError("rate limited", headers=headers)
+
+    def test_moves_to_another_key_and_cools_the_first_down(self):
+        def call(api_key, **params):
+            self.calls.append(api_key)
+            if len(self.calls) == 1:
+                raise self.rate_limited()
+            return 'ok'
+
+        self.assertEqual(self.o._invoke_call(call, model='failover-model'), 'ok')
+        self.assertEqual(len(set(self.calls)), 2)
+        first = next(key for key in self.pool.keys if key.api_key == self.calls[0])
+        # without a retry-after header the key sits out for KEY_COOLDOWN
+        self.assertGreater(first.cooldown_until - time.monotonic(), keypool_util.KEY_COOLDOWN - 5)
+
+    def test_max_tries_bounds_failovers(self):
+        def call(api_key, **params):
+            self.calls.append(api_key)
+            # the keys are back at once, so nothing but the bound stops the failovers
+            raise self.rate_limited(**{'retry-after-ms': '0'})
+
+        with self.assertRaises(self.o.OpenAIError):
+            self.o._invoke_call(call, max_tries=3, model='failover-bound-model')
+        # each try goes round the pool once
+        self.assertEqual(len(self.calls), 4 * len(self.pool))
+        for key in self.pool.keys:
+            self.assertFalse(ratelimit.get_limiter(key.fingerprint, 'failover-bound-model').breaker.is_open())
+
+
+if __name__ == '__main__':
+    unittest.main()
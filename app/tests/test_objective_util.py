@@ -0,0 +1,55 @@
+import unittest
+
+import objective_util
+
+
+class ParseObjectivesTest(unittest.TestCase):
+
+    def test_only_top_level_items_are_objectives(self):
+        message = (
+            "Here are the learning objectives:\n"
+            "1. Describe the phases of mitosis\n"
+            "   - prophase and metaphase\n"
+            "   a. anaphase\n"
+            "2. Compare mitosis and meiosis\n"
+            "\t- chromosome count\n"
+            "I hope these help!"
+        )
+        objectives = objective_util.parse_objectives(message)
+        self.assertEqual([objective['text'] for objective in objectives], ["Describe the phases of mitosis", "Compare mitosis and meiosis"])
+
+    def test_verbs_after_adverbs_and_level_labels(self):
+        message = (
+            "1. Critically evaluate the theory of evolution\n"
+            "2. Remember: Define natural selection\n"
+            "3. Synthesize findings from two studies\n"
+            "4. Analyse the data"
+        )
+        objectives = objective_util.parse_objectives(message)
+        self.assertEqual([(objective['verb'], objective['level']) for objective in objectives], [
+            ('evaluate', 'Evaluate'), ('define', 'Remember'), ('synthesize', 'Create'), ('analyse', 'Analyze')
+        ])
+        self.assertEqual(objective_util.validate(objectives, 4, []), [[], [], [], []])
+
+    def test_inflected_and_british_verbs(self):
+        message = (
+            "1. Discusses the theory\n"
+            "2. Assesses risk\n"
+            "3. Practise skills\n"
+            "4. Identifies the causes\n"
+            "5. Explains the result\n"
+            "6. Criticises the method"
+        )
+        objectives = objective_util.parse_objectives(message)
+        self.assertEqual([objective['level'] for objective in objectives], ['Understand', 'Evaluate', 'Apply', 'Remember', 'Understand', 'Evaluate'])
+        self.assertEqual(objective_util.validate(objectives, 6, []), [[]] * 6)
+
+    def test_vague_verbs_fail_validation(self):
+        objectives = objective_util.parse_objectives("1. Understand photosynthesis\n2. Explain photosynthesis")
+        problems = objective_util.validate(objectives, 2, [])
+        self.assertTrue(problems[0])
+        self.assertFalse(problems[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
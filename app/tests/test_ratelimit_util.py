@@ -0,0 +1,189 @@
+import threading
+import unittest
+from unittest import mock
+
+import openai
+
+import api_util as api
+import ratelimit_util as ratelimit
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ratelimit.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reserve_is_free_within_capacity(self):
+        bucket = ratelimit.TokenBucket(60)
+        self.assertEqual(bucket.reserve(60), 0)
+
+    def test_reserve_beyond_capacity_waits_for_the_refill(self):
+        bucket = ratelimit.TokenBucket(60)
+        bucket.reserve(60)
+        # one token per second
+        self.assertAlmostEqual(bucket.reserve(1), 1.0)
+        self.assertAlmostEqual(bucket.reserve(1), 2.0)
+
+    def test_refill_is_capped_at_capacity(self):
+        bucket = ratelimit.TokenBucket(60)
+        bucket.reserve(30)
+        self.clock.now += 3600
+        self.assertEqual(bucket.headroom(), 1.0)
+
+    def test_set_rate_changes_the_refill(self):
+        bucket = ratelimit.TokenBucket(60)
+        bucket.reserve(60)
+        bucket.set_rate(120)
+        self.clock.now += 1
+        self.assertAlmostEqual(bucket.headroom(), 2 / 60)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ratelimit.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = ratelimit.CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    def open_circuit(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.check()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open())
+        with self.assertRaises(ratelimit.CircuitOpenError):
+            self.breaker.check()
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.check()
+
+    def test_lets_one_probe_through_after_the_timeout(self):
+        self.open_circuit()
+        self.clock.now += 10
+        self.breaker.check()
+        with self.assertRaises(ratelimit.CircuitOpenError):
+            self.breaker.check()
+        self.breaker.record_success()
+        self.breaker.check()
+
+    def test_failed_probe_opens_the_circuit_again(self):
+        self.open_circuit()
+        self.clock.now += 10
+        self.breaker.check()
+        self.breaker.record_failure()
+        with self.assertRaises(ratelimit.CircuitOpenError):
+            self.breaker.check()
+        self.clock.now += 10
+        self.breaker.check()
+
+    def test_ended_probe_lets_the_next_one_through(self):
+        self.open_circuit()
+        self.clock.now += 10
+        self.breaker.check()
+        self.breaker.end_probe()
+        self.breaker.check()
+
+    def test_only_the_probing_thread_ends_the_probe(self):
+        self.open_circuit()
+        self.clock.now += 10
+        self.breaker.check()
+        thread = threading.Thread(target=self.breaker.end_probe)
+        thread.start()
+        thread.join()
+        with self.assertRaises(ratelimit.CircuitOpenError):
+            self.breaker.check()
+
+
+class ApiLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ratelimit.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rate_limits_halve_the_budgets_down_to_a_floor(self):
+        limiter = ratelimit.ApiLimiter(rpm=100, tpm=1000)
+        limiter.record_failure(rate_limited=True)
+        self.assertEqual(limiter.requests.rate_per_minute, 50)
+        self.assertEqual(limiter.tokens.rate_per_minute, 500)
+        for _ in range(10):
+            limiter.record_failure(rate_limited=True)
+        self.assertEqual(limiter.requests.rate_per_minute, 5)
+
+    def test_successes_grow_the_budgets_back_to_the_limits(self):
+        limiter = ratelimit.ApiLimiter(rpm=100)
+        limiter.record_failure(rate_limited=True)
+        for _ in range(50):
+            limiter.record_success()
+        self.assertEqual(limiter.requests.rate_per_minute, 100)
+
+    def test_headroom_is_zero_while_the_circuit_is_open(self):
+        limiter = ratelimit.ApiLimiter(rpm=100)
+        for _ in range(limiter.breaker.failure_threshold):
+            limiter.record_failure()
+        self.assertEqual(limiter.headroom(), 0.0)
+        with self.assertRaises(ratelimit.CircuitOpenError):
+            limiter.acquire()
+
+
+class RetryDelayTest(unittest.TestCase):
+
+    def error(self, **headers):
+        return openai.error.RateLimitError("rate limited", headers=headers)
+
+    def test_retry_after_headers(self):
+        self.assertEqual(ratelimit.retry_after(self.error(**{'retry-after-ms': '1500'})), 1.5)
+        self.assertEqual(ratelimit.retry_after(self.error(**{'retry-after': '7'})), 7.0)
+        self.assertEqual(ratelimit.retry_after(self.error(**{'retry-after': '9999'})), ratelimit.MAX_RETRY_AFTER)
+        self.assertIsNone(ratelimit.retry_after(self.error()))
+
+    def test_backoff_without_retry_after(self):
+        for attempt in range(8):
+            self.assertLessEqual(ratelimit.retry_delay(self.error(), attempt, initial_backoff=1, max_backoff=30), min(30, 2 ** attempt))
+
+
+class InvokeCallProbeTest(unittest.TestCase):
+    """A half-open probe that fails with an error that isn't retried must not leave the circuit open"""
+
+    def test_non_retryable_probe_failure_lets_later_calls_through(self):
+        o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|')
+        model = 'probe-test-model'
+        limiter = ratelimit.get_limiter(o.fingerprint, model)
+        limiter.breaker.reset_timeout = 0
+        for _ in range(limiter.breaker.failure_threshold):
+            limiter.record_failure()
+
+        def bad_request(**params):
+            raise openai.error.InvalidRequestError("bad request", param=None)
+
+        with self.assertRaises(o.OpenAIError) as raised:
+            o._invoke_call(bad_request, model=model)
+        self.assertEqual(raised.exception.error_type, 'InvalidRequestError')
+
+        # the next call probes again instead of being refused for good
+        self.assertEqual(o._invoke_call(lambda **params: 'ok', model=model), 'ok')
+        self.assertFalse(limiter.breaker.is_open())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+import prompt_util as prompt
+import router_util
+
+
+def response(message):
+    return {'messages': [{'role': 'assistant', 'message': message}]}
+
+
+class PassesTest(unittest.TestCase):
+
+    lo_request = {'request': prompt.REQUEST_CONTENT, 'lo_quantity': 3, 'cognition_goals': []}
+
+    def test_weak_verbs_do_not_escalate(self):
+        answer = response("1. Synthesize the findings\n2. Critically evaluate the theory\n3. Understand the method")
+        self.assertTrue(router_util._passes(self.lo_request, answer))
+
+    def test_too_few_objectives_escalate(self):
+        self.assertFalse(router_util._passes(self.lo_request, response("1. Define mitosis\n2. Define meiosis")))
+
+    def test_repeated_objectives_escalate(self):
+        answer = response("1. Define mitosis\n2. Define mitosis.\n3. Define meiosis")
+        self.assertFalse(router_util._passes(self.lo_request, answer))
+
+    def test_validation_verdicts_pass(self):
+        self.assertTrue(router_util._passes({**self.lo_request, 'request': prompt.REQUEST_VALIDATE}, response("")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+import scheduler_util
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler_util.Scheduler(max_concurrent=1)
+
+    def granted(self, tickets):
+        return [ticket for ticket in tickets if ticket.granted.is_set()]
+
+    def test_requests_beyond_the_limit_wait_for_a_slot(self):
+        scheduler = scheduler_util.Scheduler(max_concurrent=2)
+        tickets = [scheduler.enqueue('a', 1) for _ in range(3)]
+        self.assertEqual(self.granted(tickets), tickets[:2])
+        self.assertEqual(scheduler.running, 2)
+        scheduler.release(tickets[0])
+        self.assertEqual(self.granted(tickets), tickets)
+
+    def test_sessions_take_turns(self):
+        running = self.scheduler.enqueue('a', 1)
+        busy = [self.scheduler.enqueue('a', 1) for _ in range(3)]
+        other = self.scheduler.enqueue('b', 1)
+        self.scheduler.release(running)
+        # b's first request goes ahead of a's second, third and fourth
+        self.assertEqual(self.granted(busy + [other]), [busy[0]])
+        self.scheduler.release(busy[0])
+        self.assertEqual(self.granted(busy + [other]), [busy[0], other])
+
+    def test_cheaper_requests_of_an_equal_share_go_first(self):
+        running = self.scheduler.enqueue('a', 1)
+        expensive = self.scheduler.enqueue('b', 10)
+        cheap = self.scheduler.enqueue('c', 2)
+        self.scheduler.release(running)
+        self.assertTrue(cheap.granted.is_set())
+        self.assertFalse(expensive.granted.is_set())
+
+    def test_released_queued_tickets_are_skipped(self):
+        running = self.scheduler.enqueue('a', 1)
+        abandoned = self.scheduler.enqueue('b', 1)
+        waiting = self.scheduler.enqueue('c', 1)
+        self.scheduler.release(abandoned)
+        self.assertEqual(self.scheduler.position(waiting), 1)
+        self.scheduler.release(running)
+        self.assertFalse(abandoned.granted.is_set())
+        self.assertTrue(waiting.granted.is_set())
+        self.assertEqual(self.scheduler.running, 1)
+
+    def test_releasing_twice_frees_one_slot(self):
+        first = self.scheduler.enqueue('a', 1)
+        second = self.scheduler.enqueue('b', 1)
+        self.scheduler.release(first)
+        self.scheduler.release(first)
+        self.assertEqual(self.scheduler.running, 1)
+        self.assertTrue(second.granted.is_set())
+
+    def test_position_and_status(self):
+        running = self.scheduler.enqueue('a', 1)
+        first = self.scheduler.enqueue('b', 1)
+        second = self.scheduler.enqueue('c', 1)
+        self.assertEqual(self.scheduler.position(running), 0)
+        self.assertEqual(self.scheduler.position(first), 1)
+        self.assertEqual(self.scheduler.position(second), 2)
+        position, wait = self.scheduler.status('c')
+        self.assertEqual(position, 2)
+        self.assertAlmostEqual(wait, 2 * scheduler_util.INITIAL_SERVICE_TIME)
+        self.assertIsNone(self.scheduler.status('a'))
+
+    def test_slot_releases_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.scheduler.slot('a', 1):
+                raise RuntimeError("request failed")
+        self.assertEqual(self.scheduler.running, 0)
+
+
+class FormatWaitTest(unittest.TestCase):
+
+    def test_format_wait(self):
+        self.assertEqual(scheduler_util.format_wait(1, 0.2), "Queued: next in line, about 1 s")
+        self.assertEqual(scheduler_util.format_wait(3, 12.4), "Queued: 2 requests ahead, about 12 s")
+
+
+if __name__ == '__main__':
+    unittest.main()